@@ -22,37 +22,92 @@
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
 import json
-import os.path
+import bisect
+import threading
+import time
+import uuid
 
-from collections import namedtuple
+from collections import namedtuple, MutableMapping
+from multiprocessing.pool import ThreadPool
 
+from pycstbox import log
 from pycstbox.evtmgr import EventManagerObject
 from pycstbox.log import Loggable
 from pycstbox.events import DataKeys
+from pycstbox.homeautomation.storage import open_store, CompiledCache
+from pycstbox.homeautomation.scheduling import parse_rule
+from pycstbox.homeautomation.triggers import parse_trigger
+from pycstbox.homeautomation.index import ActionsIndex
 
 
-class Scenario(Loggable):
+class Scenario(object):
     """ A scenario is a sequence of basic actions.
 
     A scenario can be executed.
+
+    Actions are organized in steps, executed one after the other. By default each
+    action is a step by itself, which means that actions are executed sequentially.
+    An action flagged as parallel joins the step of the preceding one, and is thus
+    executed concurrently with it.
+
+    Besides basic actions, a scenario can reference other scenarios (see :py:class:`ScenarioRef`).
+    Such a composite scenario is executed according to a plan in which the references are
+    replaced by the actions of the referenced scenarios. The plan is computed by the
+    scenarios directory (see :py:class:`ScenariosManager`), and kept up to date when the
+    referenced scenarios are modified.
+
+    A scenario can also be given a schedule, i.e. a list of rules defining when it
+    must be executed automatically (see :py:mod:`pycstbox.homeautomation.scheduling`),
+    and triggers defining the events it reacts to (see :py:mod:`pycstbox.homeautomation.triggers`).
+
+    Since large installations can define thousands of scenarios, instances are kept
+    as small as possible : attributes are slotted and the logger is shared.
     """
+    __slots__ = ('_label', '_actions', '_parallel', '_ui_verb', '_schedule', '_triggers', '_compiled')
+
+    logger = log.getLogger('homeautomation.scenario')
+
     KEY_LABEL = 'label'
     KEY_ACTIONS = 'actions'
     KEY_UI_VERB = 'ui_verb'
+    KEY_PARALLEL = 'parallel'
+    KEY_SCHEDULE = 'schedule'
+    KEY_TRIGGERS = 'triggers'
 
     DEFAULT_VERB = 'Execute'
 
-    def __init__(self, label, actions=None, ui_verb=None):
+    def __init__(self, label, actions=None, ui_verb=None, parallel=None, schedule=None, triggers=None):
         """
         :param str label: a human readable label
         :param actions: the list of actions of the scenario
         :type actions: list of [BasicAction]
         :param str ui_verb: the verb to be displayed on the UI
+        :param parallel: the parallel flags of the actions (default: all sequential)
+        :type parallel: list of [bool]
+        :param schedule: the rules triggering the execution of the scenario
+        :type schedule: list of [CronRule or SunRule]
+        :param triggers: the rules matching the events triggering the execution of the scenario
+        :type triggers: list of [TriggerRule]
         """
         self._label = label
         self._actions = actions[:] if actions else []
+        self._parallel = self._check_parallel_flags(self._actions, parallel)
         self._ui_verb = ui_verb
-        super(Scenario, self).__init__()
+        self._schedule = tuple(schedule) if schedule else None
+        self._triggers = tuple(triggers) if triggers else None
+        self._compiled = None
+
+    @staticmethod
+    def _check_parallel_flags(actions, parallel):
+        """ Returns the normalized parallel flags, None standing for all sequential.
+        """
+        if parallel is None:
+            return None
+        if len(parallel) != len(actions):
+            raise ValueError("parallel flags and actions count mismatch")
+        # the first action cannot join a previous step
+        flags = [False] + [bool(flag) for flag in parallel[1:]] if parallel else []
+        return flags if any(flags) else None
 
     @property
     def label(self):
@@ -62,79 +117,330 @@ class Scenario(Loggable):
     def ui_verb(self):
         return self._ui_verb
 
+    @property
+    def schedule(self):
+        """ Returns the rules triggering the execution of the scenario
+        :rtype: tuple of [CronRule or SunRule]
+        """
+        return self._schedule or ()
+
+    @property
+    def triggers(self):
+        """ Returns the rules matching the events triggering the execution of the scenario
+        :rtype: tuple of [TriggerRule]
+        """
+        return self._triggers or ()
+
     @property
     def actions(self):
         """ Returns the sequence of actions
-        :rtype: list of [BasicAction]
+        :rtype: list of [BasicAction or ScenarioRef]
         """
         return self._actions
 
-    def add_action(self, action):
+    @property
+    def parallel_flags(self):
+        """ Returns the parallel flags of the actions.
+        :rtype: list of [bool]
+        """
+        return self._parallel or [False] * len(self._actions)
+
+    @property
+    def is_composite(self):
+        """ Tells if the scenario references other scenarios.
+        """
+        return any(isinstance(action, ScenarioRef) for action in self._actions)
+
+    @property
+    def references(self):
+        """ Returns the ids of the scenarios directly referenced by this one, without duplicates.
+        :rtype: list of [str]
+        """
+        refs = []
+        for action in self._actions:
+            if isinstance(action, ScenarioRef) and action.scenario not in refs:
+                refs.append(action.scenario)
+        return refs
+
+    @property
+    def needs_plan(self):
+        """ Tells if the scenario is a composite one whose plan is not available.
+        """
+        return self._compiled is None and self.is_composite
+
+    @property
+    def plan(self):
+        """ Returns the actions actually executed, i.e. the actions of the scenario in
+        which the references have been replaced by the actions of the referenced scenarios.
+        :rtype: tuple of [BasicAction]
+        :raise: ValueError if the references of a composite scenario are not resolved
+        """
+        return self._get_compiled()[0]
+
+    @property
+    def steps(self):
+        """ Returns the sequence of steps, each one being the list of the actions
+        executed concurrently.
+        :rtype: list of [list of [BasicAction]]
+        """
+        actions, _, steps = self._get_compiled()
+        if steps is None:
+            return [[action] for action in actions]
+        return [list(actions[start:end]) for start, end in steps]
+
+    def add_action(self, action, parallel=False):
         """ Appends an action to the sequence.
-        :param BasicAction action: the action to be added
+        :param action: the action to be added
+        :type action: BasicAction or ScenarioRef
+        :param bool parallel: if True, the action is executed concurrently with the
+        preceding one
         """
         if not action:
             raise ValueError('parameter is mandatory')
-        if not isinstance(action, BasicAction):
+        if not isinstance(action, (BasicAction, ScenarioRef)):
             raise TypeError('action parameter type mismatch')
         self._actions.append(action)
+        parallel = bool(parallel) and len(self._actions) > 1
+        if parallel and self._parallel is None:
+            self._parallel = [False] * (len(self._actions) - 1)
+        if self._parallel is not None:
+            self._parallel.append(parallel)
+        self._compiled = None
 
-    def update_actions(self, actions):
+    def update_actions(self, actions, parallel=None):
         """ Replaces the action sequence by a copy of the provided one.
         :param actions: the new list of actions
         :type actions: list of [BasicAction]
+        :param parallel: the parallel flags of the actions (default: all sequential)
+        :type parallel: list of [bool]
         """
         if not actions:
             raise ValueError("parameter 'actions' is mandatory")
+        self._parallel = self._check_parallel_flags(actions, parallel)
         self._actions = actions[:]
+        self._compiled = None
 
     def clear(self):
         """ Empties the action list
         """
-        self._actions.clear()
+        del self._actions[:]
+        self._parallel = None
+        self._compiled = None
 
-    def execute(self, event_manager):
+    def _get_compiled(self):
+        """ Returns the ready-to-emit form of the scenario, compiling it if needed.
+
+        :return: a tuple containing the actions, the list of their events and the
+        list of steps as (start, end) index ranges (None if all actions are sequential)
+        :rtype: tuple
+        :raise: ValueError if the references of a composite scenario are not resolved
+        """
+        compiled = self._compiled
+        if compiled is None:
+            if self.is_composite:
+                raise ValueError('scenario references are not resolved')
+            compiled = self._compiled = self._compile(tuple(self._actions), self._parallel)
+        return compiled
+
+    @staticmethod
+    def _compile(actions, parallel):
+        steps = None
+        if parallel and any(parallel):
+            steps = []
+            for i, flag in enumerate(parallel):
+                if flag and steps:
+                    steps[-1] = (steps[-1][0], i + 1)
+                else:
+                    steps.append((i, i + 1))
+        return actions, [action.as_event() for action in actions], steps
+
+    def set_plan(self, actions, parallel):
+        """ Sets the execution plan of a composite scenario.
+
+        The plan is discarded as soon as the scenario is modified.
+
+        :param actions: the basic actions resulting from the resolution of the references
+        :type actions: list of [BasicAction]
+        :param parallel: the parallel flags of the actions
+        :type parallel: list of [bool]
+        """
+        self._compiled = self._compile(tuple(actions), parallel)
+
+    def execute(self, event_manager, progress=None, state_cache=None, force=False, on_skip=None):
         """ Executes the actions of the scenario in the order they have
-        been recorded.
+        been recorded, actions of a same step being executed concurrently.
+
+        Control events are emitted in batches if the event manager supports it
+        (see :py:class:`EventEmitter`).
 
-        :param EventManagerObject event_manager: the event manager to be used by actions
+        If provided, the progress callback is invoked after each action with the
+        index of the action, the action itself and the exception it raised if any.
+        Execution stops at the end of the first step including a failure.
+
+        If a device state cache is provided, the actions whose target is already in the
+        requested state are skipped, unless the execution is forced.
+
+        :param event_manager: the event manager to be used by actions, or an emitter wrapping it
+        :type event_manager: EventManagerObject or EventEmitter
+        :param callable progress: optional progress callback
+        :param DeviceStateCache state_cache: optional device state cache
+        :param bool force: if True, all the actions are executed whatever the state of their target
+        :param callable on_skip: optional callback invoked with the index of each skipped
+        action and the action itself
         """
         if not event_manager:
             raise ValueError("parameter 'event_manager' is mandatory")
+        temporary = not isinstance(event_manager, EventEmitter)
+        emitter = EventEmitter(event_manager) if temporary else event_manager
 
-        for action in self._actions:
-            self.log_info("executing %s", action)
-            action.execute(event_manager)
+        actions, events, steps = self._get_compiled()
+        indices = None
+        if state_cache is not None and not force:
+            indices = [i for i, event in enumerate(events) if not state_cache.is_in_state(*event)]
+            if len(indices) == len(events):
+                indices = None
+            else:
+                kept = set(indices)
+                for i, action in enumerate(actions):
+                    if i not in kept:
+                        self.logger.info("skipping %s (target already in state)", action)
+                        if on_skip:
+                            on_skip(i, action)
+                events = [events[i] for i in indices]
+                steps = self._filter_steps(steps, indices)
+
+        for i in (indices if indices is not None else xrange(len(actions))):
+            self.logger.info("executing %s", actions[i])
+
+        def notify(j, error):
+            i = indices[j] if indices is not None else j
+            progress(i, actions[i], error)
+
+        try:
+            emitter.emit(events, notify if progress else None, steps)
+        finally:
+            if temporary:
+                # its threads would never be reused
+                emitter.close()
+
+    @staticmethod
+    def _filter_steps(steps, indices):
+        """ Returns the steps of a subset of the actions.
+
+        :param list steps: the (start, end) bounds of the steps of all the actions
+        :param list indices: the sorted indices of the kept actions
+        :return: the steps, expressed as bounds in the list of the kept actions
+        """
+        if steps is None:
+            return None
+        position = {i: j for j, i in enumerate(indices)}
+        filtered = []
+        for start, end in steps:
+            kept = [position[i] for i in xrange(start, end) if i in position]
+            if kept:
+                filtered.append((kept[0], kept[-1] + 1))
+        return filtered
 
     def as_dict(self):
-        return {
+        actions = [a._asdict() for a in self._actions]
+        if self._parallel:
+            for d, parallel in zip(actions, self._parallel):
+                if parallel:
+                    d[self.KEY_PARALLEL] = True
+        d = {
             self.KEY_LABEL: self._label,
-            self.KEY_ACTIONS: [a._asdict() for a in self._actions],
+            self.KEY_ACTIONS: actions,
             self.KEY_UI_VERB: self.ui_verb
         }
+        if self._schedule:
+            d[self.KEY_SCHEDULE] = [rule.as_dict() for rule in self._schedule]
+        if self._triggers:
+            d[self.KEY_TRIGGERS] = [rule.as_dict() for rule in self._triggers]
+        return d
 
-    def update(self, d):
+    def update(self, d, pool=None):
         """ Updates the scenario definition from provided settings.
         :param dict d: new settings
+        :param ActionsPool pool: optional pool used for sharing identical actions and strings
+        """
+        self.assign(self.from_dict(d, pool))
+
+    def assign(self, new_s):
+        """ Replaces the scenario definition by the one of another scenario, keeping
+        the UI verb unchanged.
+        :param Scenario new_s: the scenario providing the new definition
         """
-        new_s = self.from_dict(d)
         self._label = new_s._label
         self._actions = new_s._actions
+        self._parallel = new_s._parallel
+        self._schedule = new_s._schedule
+        self._triggers = new_s._triggers
+        self._compiled = None
+
+    def as_record(self):
+        """ Returns the scenario as a tuple made of built-in types only, for storing it
+        in the compiled cache (see :py:class:`pycstbox.homeautomation.storage.CompiledCache`).
+        """
+        schedule = [rule.as_dict() for rule in self._schedule] if self._schedule else None
+        triggers = [rule.as_dict() for rule in self._triggers] if self._triggers else None
+        return self._label, self._ui_verb, [tuple(a) for a in self._actions], self._parallel, schedule, triggers
 
     @classmethod
-    def from_dict(cls, d):
+    def from_record(cls, record, pool=None):
+        """ Creates a scenario from a tuple returned by :py:meth:`as_record`.
+
+        The record has been produced from a valid scenario, so that its content is
+        not validated again.
+
+        :param tuple record: the record
+        :param ActionsPool pool: optional pool used for sharing identical actions and strings
+        """
+        label, ui_verb, actions, parallel, schedule, triggers = record
+        if pool is not None:
+            # references are recorded as pairs
+            actions = [pool.get_action(*a) if len(a) != 2 else pool.get_reference(*a) for a in actions]
+            ui_verb = pool.intern(ui_verb)
+        else:
+            actions = [tuple.__new__(BasicAction if len(a) != 2 else ScenarioRef, a) for a in actions]
+        if schedule:
+            schedule = [parse_rule(d) for d in schedule]
+        if triggers:
+            triggers = [parse_trigger(d) for d in triggers]
+        return cls(
+            label, actions=actions, ui_verb=ui_verb, parallel=parallel, schedule=schedule, triggers=triggers
+        )
+
+    @classmethod
+    def from_dict(cls, d, pool=None):
+        """ Creates a scenario from its settings.
+
+        :param dict d: the settings
+        :param ActionsPool pool: optional pool used for sharing identical actions and strings
+        """
         label = d[cls.KEY_LABEL]
         ui_verb = d.get(cls.KEY_UI_VERB, cls.DEFAULT_VERB)
         actions_cfg = d[cls.KEY_ACTIONS]
+        make_action = pool.get_action if pool is not None else BasicAction
+        make_reference = pool.get_reference if pool is not None else ScenarioRef
         actions = [
-            BasicAction(
+            make_action(
                 action['verb'],
                 action['target'],
                 action.get('data', None),
                 action.get('label', None)
+            ) if ScenarioRef.KEY_SCENARIO not in action else make_reference(
+                action[ScenarioRef.KEY_SCENARIO],
+                action.get('label', None)
             ) for action in actions_cfg
         ]
-        return Scenario(label=label, actions=actions, ui_verb=ui_verb)
+        parallel = [action.get(cls.KEY_PARALLEL, False) for action in actions_cfg]
+        schedule = [parse_rule(rule) for rule in d.get(cls.KEY_SCHEDULE) or []]
+        triggers = [parse_trigger(rule) for rule in d.get(cls.KEY_TRIGGERS) or []]
+        if pool is not None:
+            ui_verb = pool.intern(ui_verb)
+        return Scenario(
+            label=label, actions=actions, ui_verb=ui_verb, parallel=parallel, schedule=schedule, triggers=triggers
+        )
 
 
 class BasicAction(namedtuple('BasicAction', 'verb target data label')):
@@ -146,7 +452,11 @@ class BasicAction(namedtuple('BasicAction', 'verb target data label')):
 
      The data attribute can be either a simple value, or a dictionary as
      defined for events (see :py:class:`pycstbox.events.BasicEvent).
+
+     When no label is provided, it is generated when accessed.
     """
+    __slots__ = ()
+
     def __new__(cls, verb, target, data=None, label=None):
         """
         :param str verb: the type of the event emitted to realize the action
@@ -157,9 +467,28 @@ class BasicAction(namedtuple('BasicAction', 'verb target data label')):
         """
         if not verb or not target:
             raise ValueError("parameters 'verb' and 'target' are mandatory")
+        if not isinstance(verb, basestring) or not isinstance(target, basestring):
+            raise TypeError("parameters 'verb' and 'target' must be strings")
         if not label:
-            label = verb + ' ' + target + ' ' + cls._interpret_param(verb, data)
-        return super(BasicAction, cls).__new__(cls, verb, target, data, label)
+            # the label is not stored, but building it checks that the data match the verb
+            cls._default_label(verb, target, data)
+        return super(BasicAction, cls).__new__(cls, verb, target, data, label or None)
+
+    @property
+    def label(self):
+        label = tuple.__getitem__(self, 3)
+        if label is None:
+            label = self._default_label(self.verb, self.target, self.data)
+        return label
+
+    @classmethod
+    def _default_label(cls, verb, target, data):
+        return verb + ' ' + target + ' ' + cls._interpret_param(verb, data)
+
+    def _asdict(self):
+        d = super(BasicAction, self)._asdict()
+        d['label'] = self.label
+        return d
 
     @classmethod
     def from_dict(cls, d):
@@ -176,19 +505,30 @@ class BasicAction(namedtuple('BasicAction', 'verb target data label')):
         else:
             return parameter
 
-    def execute(self, event_manager):
-        """ Execute the action by sending the associated event, based on its
-        verb and target.
+    def as_event(self):
+        """ Returns the control event realizing the action.
 
-        :param EventManagerObject event_manager: the event manager used for sending
-        the action event
+        Actions being slotted, the event is not cached here but in the compiled form
+        of the scenarios containing the action.
+
+        :return: the event, as a (var_type, var_name, data) tuple, data being JSON encoded
+        :rtype: tuple
         """
         # convert the action data as a event data dictionary if not already the case
         if isinstance(self.data, dict):
             payload = self.data
         else:
             payload = {DataKeys.VALUE: self.data}
-        event_manager.emitEvent(self.verb, self.target, json.dumps(payload))
+        return self.verb, self.target, json.dumps(payload)
+
+    def execute(self, event_manager):
+        """ Execute the action by sending the associated event, based on its
+        verb and target.
+
+        :param EventManagerObject event_manager: the event manager used for sending
+        the action event
+        """
+        event_manager.emitEvent(*self.as_event())
 
     def __str__(self):
         return("%s(%s, %s, %s)" %
@@ -196,29 +536,577 @@ class BasicAction(namedtuple('BasicAction', 'verb target data label')):
         )
 
 
+class ScenarioRef(namedtuple('ScenarioRef', 'scenario label')):
+    """ A reference to another scenario, used as an action of a composite scenario.
+
+    It is stored as an action with a "scenario" attribute instead of the verb and target :
+
+        {"scenario": "all_lights_off", "label": "...", "parallel": false}
+
+    When flagged as parallel, the first step of the referenced scenario joins the
+    preceding step.
+    """
+    __slots__ = ()
+
+    KEY_SCENARIO = 'scenario'
+
+    def __new__(cls, scenario, label=None):
+        """
+        :param str scenario: the id of the referenced scenario
+        :param str label: an optional human friendly label
+        """
+        if not scenario:
+            raise ValueError("parameter 'scenario' is mandatory")
+        return super(ScenarioRef, cls).__new__(cls, scenario, label or None)
+
+    @property
+    def label(self):
+        label = tuple.__getitem__(self, 1)
+        if label is None:
+            label = 'scenario ' + self.scenario
+        return label
+
+    def _asdict(self):
+        d = super(ScenarioRef, self)._asdict()
+        d['label'] = self.label
+        return d
+
+    def __str__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.scenario)
+
+
+class ActionsPool(object):
+    """ Shares identical actions and strings between scenarios, for reducing the
+    memory used by large sets of scenarios.
+    """
+    def __init__(self):
+        self._strings = {}
+        self._actions = {}
+
+    def intern(self, s):
+        """ Returns the shared instance of a string.
+        """
+        if s is None:
+            return s
+        return self._strings.setdefault(s, s)
+
+    def get_action(self, verb, target, data=None, label=None):
+        """ Returns the shared instance of an action, creating it if needed.
+
+        The parameters are the same as for :py:class:`BasicAction`.
+        """
+        try:
+            hash(data)
+            data_key = data
+        except TypeError:
+            data_key = json.dumps(data, sort_keys=True)
+        key = (verb, target, type(data), data_key, label or None)
+        try:
+            return self._actions[key]
+        except KeyError:
+            if isinstance(data, basestring):
+                data = self.intern(data)
+            action = self._actions[key] = BasicAction(
+                self.intern(verb), self.intern(target), data, self.intern(label)
+            )
+            return action
+
+    def get_reference(self, scenario, label=None):
+        """ Returns the shared instance of a scenario reference, creating it if needed.
+
+        The parameters are the same as for :py:class:`ScenarioRef`.
+        """
+        key = (scenario, label or None)
+        try:
+            return self._actions[key]
+        except KeyError:
+            ref = self._actions[key] = ScenarioRef(self.intern(scenario), self.intern(label))
+            return ref
+
+    def __len__(self):
+        return len(self._actions)
+
+
+class EventEmitter(Loggable):
+    """ Emits control events on behalf of actions.
+
+    When the event manager provides the `emitEvents` batch method, events are sent
+    in batches of at most `batch_size` events, which reduces the number of IPC round
+    trips to a few ones per scenario. Otherwise, or if the remote object turns out not
+    to support it, events are sent one at a time using `emitEvent`.
+
+    Events can be organized in steps, separated by barriers. When sent one at a time,
+    the events of a same step are emitted concurrently by a pool of threads, and the
+    next step is started only when all of them are sent. Batches need no special
+    processing since the event manager handles their content in order.
+
+    Emitters are meant to be long lived, so that the batch support detection is
+    done once for all, and the threads pool is reused.
+
+    An optional tracer can be provided for instrumentation purpose. It is invoked after
+    each call to the event manager, with the list of the events sent, the duration
+    of the call (in seconds) and the exception raised if any.
+    """
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_CONCURRENCY = 8
+
+    DBUS_UNKNOWN_METHOD = 'org.freedesktop.DBus.Error.UnknownMethod'
+
+    def __init__(self, event_manager, batch_size=DEFAULT_BATCH_SIZE, concurrency=DEFAULT_CONCURRENCY,
+                 tracer=None):
+        """
+        :param EventManagerObject event_manager: the event manager used for sending events
+        :param int batch_size: the maximum number of events sent in a single call
+        :param int concurrency: the maximum number of events of a step sent concurrently
+        :param callable tracer: optional tracer
+        """
+        if not event_manager:
+            raise ValueError("parameter 'event_manager' is mandatory")
+        if batch_size < 1:
+            raise ValueError("invalid batch size : %s" % batch_size)
+        if concurrency < 1:
+            raise ValueError("invalid concurrency : %s" % concurrency)
+
+        super(EventEmitter, self).__init__()
+
+        self._evtmgr = event_manager
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._tracer = tracer
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # D-Bus proxies accept any attribute, so this is only a first guess for them
+        self._batch_supported = hasattr(event_manager, 'emitEvents')
+
+    @property
+    def event_manager(self):
+        return self._evtmgr
+
+    @property
+    def batch_supported(self):
+        return self._batch_supported
+
+    def emit(self, events, progress=None, steps=None):
+        """ Emits a sequence of events, preserving their order.
+
+        If provided, the progress callback is invoked for each event after it has been
+        sent, with the index of the event and the exception raised if any. If a batch
+        fails, the error is reported on its first event. Emission stops at the end of
+        the first step including a failure, and the exception is propagated.
+
+        :param events: the events, as (var_type, var_name, data) tuples
+        :param callable progress: optional progress callback
+        :param steps: optional list of steps, as (start, end) index ranges covering the
+        events sequence (default: each event is a step by itself)
+        """
+        step_starts = [start for start, _ in steps] if steps else None
+        start = 0
+        while start < len(events):
+            if self._batch_supported:
+                batch = events[start:start + self._batch_size]
+                try:
+                    self._emit_batch(batch)
+                except _BatchNotSupported:
+                    continue
+                except Exception as e:
+                    if progress:
+                        progress(start, e)
+                    raise
+                if progress:
+                    for i in xrange(start, start + len(batch)):
+                        progress(i, None)
+                start += len(batch)
+
+            else:
+                # we can be in the middle of a step if batch emission failed
+                end = steps[bisect.bisect_right(step_starts, start) - 1][1] if steps else start + 1
+                if end - start > 1:
+                    self._emit_concurrently(events, start, end, progress)
+                else:
+                    self._emit_single(events, start, progress)
+                start = end
+
+    def _emit_single(self, events, i, progress):
+        event = events[i]
+        t0 = time.time()
+        try:
+            self._evtmgr.emitEvent(*event)
+        except Exception as e:
+            if self._tracer:
+                self._tracer([event], time.time() - t0, e)
+            if progress:
+                progress(i, e)
+            raise
+        if self._tracer:
+            self._tracer([event], time.time() - t0, None)
+        if progress:
+            progress(i, None)
+
+    def _emit_concurrently(self, events, start, end, progress):
+        def emit_one(i):
+            try:
+                self._emit_single(events, i, progress)
+            except Exception as e:
+                return e
+
+        errors = [e for e in self._get_pool().map(emit_one, xrange(start, end)) if e]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        """ Stops the threads used for emitting events concurrently, if any.
+
+        The emitter can still be used afterwards, the threads being started again
+        when needed.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.close()
+            pool.join()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if not self._pool:
+                self._pool = ThreadPool(self._concurrency)
+            return self._pool
+
+    def _emit_batch(self, batch):
+        t0 = time.time()
+        try:
+            self._evtmgr.emitEvents(batch)
+        except Exception as e:
+            get_dbus_name = getattr(e, 'get_dbus_name', None)
+            if get_dbus_name and get_dbus_name() == self.DBUS_UNKNOWN_METHOD:
+                self.log_info('event manager does not support batches, falling back to single events')
+                self._batch_supported = False
+                raise _BatchNotSupported()
+            if self._tracer:
+                self._tracer(batch, time.time() - t0, e)
+            raise
+        if self._tracer:
+            self._tracer(batch, time.time() - t0, None)
+
+
+class _BatchNotSupported(Exception):
+    pass
+
+
+class LazyScenarios(MutableMapping):
+    """ A mapping of scenarios, which are built from their stored definition the first
+    time they are accessed.
+
+    Definitions are read from an indexed document (see
+    :py:class:`pycstbox.homeautomation.storage.IndexedDocument`), the changes recorded in
+    the storage journal taking precedence.
+    """
+    def __init__(self, document, changes=None, pool=None):
+        """
+        :param IndexedDocument document: the indexed definitions
+        :param dict changes: the definitions which override the ones of the document,
+        None for removed scenarios
+        :param ActionsPool pool: the pool used for building the actions, if any
+        """
+        self._document = document
+        self._pool = pool
+        self._ids = set(document.keys())
+        # definitions not yet built, which are not stored in the document
+        self._pending = {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+        for id_, settings in (changes or {}).iteritems():
+            if settings is None:
+                self._ids.discard(id_)
+            else:
+                self._ids.add(id_)
+                self._pending[id_] = settings
+
+    @property
+    def loaded_count(self):
+        """ The number of scenarios built so far.
+        """
+        return len(self._loaded)
+
+    def get_settings(self, id_):
+        """ Returns the definition of a scenario as a dictionary, without building it if
+        not done yet.
+
+        :raise: KeyError if not found
+        """
+        try:
+            return self._loaded[id_].as_dict()
+        except KeyError:
+            pass
+        if id_ not in self._ids:
+            raise KeyError(id_)
+        try:
+            return self._pending[id_]
+        except KeyError:
+            return self._document.get(id_)
+
+    def get_loaded(self, id_):
+        """ Returns a scenario if it has already been built, None otherwise.
+        """
+        return self._loaded.get(id_)
+
+    def __getitem__(self, id_):
+        try:
+            return self._loaded[id_]
+        except KeyError:
+            pass
+        with self._lock:
+            if id_ in self._loaded:
+                return self._loaded[id_]
+            if id_ not in self._ids:
+                raise KeyError(id_)
+            settings = self._pending.pop(id_, None)
+            if settings is None:
+                settings = self._document.get(id_)
+            scenario = self._loaded[id_] = Scenario.from_dict(settings, self._pool)
+            return scenario
+
+    def __setitem__(self, id_, scenario):
+        with self._lock:
+            self._ids.add(id_)
+            self._pending.pop(id_, None)
+            self._loaded[id_] = scenario
+
+    def __delitem__(self, id_):
+        with self._lock:
+            self._ids.remove(id_)
+            self._pending.pop(id_, None)
+            self._loaded.pop(id_, None)
+
+    def __contains__(self, id_):
+        return id_ in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+
 class ScenariosManager(Loggable):
     """ Manages all known scenarios and their persistence in storage.
 
     It is organized on a directory keeping track of the definitions of available scenarios.
+
+    Modifications done with :py:meth:`add_scenario`, :py:meth:`update_scenario`,
+    :py:meth:`remove_scenario` and :py:meth:`apply_batch` are tracked, so that :py:meth:`save_changes` can persist
+    them incrementally, possibly deferring the write to coalesce a burst of edits.
+
+    The directory revision is incremented by each modification. Values derived from
+    the definitions can be cached until the next one (see :py:meth:`cached`).
+
+    Listeners can be registered for being notified of modifications. They are called
+    with the kind of modification (one of the SCENARIO_xxx constants) and the id of the
+    concerned scenario (None when the whole directory has been reloaded).
+
+    The references of composite scenarios are resolved when the definitions are loaded,
+    into flattened execution plans (see :py:meth:`Scenario.set_plan`). The scenarios
+    reached by each plan are indexed, so that only the plans depending on a modified
+    scenario are recompiled. Modifications introducing reference cycles or unknown
+    references are rejected. In lazy mode, plans are resolved when the composite
+    scenarios are accessed for the first time.
+
+    The actions of the scenarios are indexed by target and by verb the first time the index
+    is queried (see :py:meth:`find_target`), and the index is then kept up to date.
     """
     DEFAULT_STORAGE_PATH = "/etc/cstbox/home-automation-scenarios.cfg"
 
-    def __init__(self):
+    SCENARIO_ADDED = 'scenario_added'
+    SCENARIO_UPDATED = 'scenario_updated'
+    SCENARIO_REMOVED = 'scenario_removed'
+    SCENARIOS_RELOADED = 'scenarios_reloaded'
+
+    def __init__(self, compact=False, lazy=False, use_cache=False):
+        """
+        :param bool compact: if True, identical actions and strings are shared between
+        the loaded scenarios, for reducing the memory footprint of large sets of scenarios
+        :param bool lazy: if True, the storage file is only indexed when loading, and
+        scenarios are built the first time they are accessed (see :py:class:`LazyScenarios`)
+        :param bool use_cache: if True, the loaded scenarios are cached in compiled form
+        next to the storage file, and loaded from there while the storage file is not
+        modified (not used in lazy mode)
+        """
         super(ScenariosManager, self).__init__()
 
+        self._compact = compact
+        self._lazy = lazy
+        self._use_cache = use_cache and not lazy
+        self._pool = ActionsPool() if compact else None
         self._scenarios = {}
+        self._sorted_ids = []
+        self._revision = 0
+        self._last_modified = time.time()
+        # distinguishes the revisions of successive instances (e.g. across restarts)
+        self._instance_tag = uuid.uuid4().hex[:8]
+        self._cache = {}
+        self._store = None
+        self._store_signature = None
+        self._changes = set()
+        self._flush_timer = None
+        self._lock = threading.RLock()
+        self._listeners = []
+        # scenario id -> ids of the composite scenarios whose plan includes it
+        self._dependents = {}
+        # composite scenario id -> ids of the scenarios included by its plan
+        self._plan_refs = {}
+        # built on first use
+        self._index = None
 
     @property
     def scenarios(self):
         """ Returns the list of available scenarios, as pairs composed of the scenario id
         and the scenario definition.
 
-        The list is sorted by scenario names.
+        The list is sorted by scenario names. It is shared between callers and must
+        not be modified. In lazy loading mode, all the scenarios are built, and
+        :py:attr:`summaries` should be preferred when only their labels are needed.
 
         :return: the list of scenarios
         :rtype: list of [Scenario]
         """
-        return sorted(self._scenarios.items())
+        return self.cached('scenarios', self._build_scenarios_list)
+
+    def _build_scenarios_list(self):
+        return [(id_, self._scenarios[id_]) for id_ in self._sorted_ids]
+
+    @property
+    def summaries(self):
+        """ Returns the id, label and UI verb of the available scenarios, sorted by id.
+
+        Unlike :py:attr:`scenarios`, it does not build the scenarios in lazy loading mode.
+        It is shared between callers and must not be modified.
+
+        :rtype: list of [tuple]
+        """
+        return self.cached('summaries', self._build_summaries)
+
+    def _build_summaries(self):
+        if not isinstance(self._scenarios, LazyScenarios):
+            return [(id_, scenario.label, scenario.ui_verb) for id_, scenario in self.scenarios]
+        summaries = []
+        for id_ in self._sorted_ids:
+            scenario = self._scenarios.get_loaded(id_)
+            if scenario is not None:
+                summaries.append((id_, scenario.label, scenario.ui_verb))
+            else:
+                d = self._scenarios.get_settings(id_)
+                summaries.append((id_, d[Scenario.KEY_LABEL], d.get(Scenario.KEY_UI_VERB, Scenario.DEFAULT_VERB)))
+        return summaries
+
+    def iter_schedules(self):
+        """ Iterates over the schedules of the scenarios.
+
+        In lazy loading mode, the scenarios are not built for that purpose, the rules of
+        the ones not used yet being parsed from their stored settings.
+
+        :return: (scenario id, schedule rules) pairs, for the scenarios having a schedule
+        """
+        return self._iter_rules(Scenario.KEY_SCHEDULE, parse_rule)
+
+    def iter_triggers(self):
+        """ Iterates over the triggers of the scenarios.
+
+        As for :py:meth:`iter_schedules`, lazily loaded scenarios are not built.
+
+        :return: (scenario id, trigger rules) pairs, for the scenarios having triggers
+        """
+        return self._iter_rules(Scenario.KEY_TRIGGERS, parse_trigger)
+
+    def _iter_rules(self, key, parse):
+        # the settings key of the rules is also the name of the scenario attribute
+        scenarios = self._scenarios
+        lazy = isinstance(scenarios, LazyScenarios)
+        for id_ in list(self._sorted_ids):
+            scenario = scenarios.get_loaded(id_) if lazy else scenarios.get(id_)
+            if scenario is not None:
+                rules = getattr(scenario, key)
+            elif not lazy:
+                continue
+            else:
+                try:
+                    settings = scenarios.get_settings(id_)
+                except KeyError:
+                    # removed meanwhile
+                    continue
+                try:
+                    rules = [parse(d) for d in settings.get(key) or []]
+                except (KeyError, TypeError, ValueError) as e:
+                    self.log_error('invalid %s of scenario %s : %s', key, id_, e)
+                    continue
+            if rules:
+                yield id_, rules
+
+    @property
+    def revision(self):
+        """ The revision of the directory, incremented each time it is modified.
+        """
+        return self._revision
+
+    @property
+    def version(self):
+        """ An opaque string identifying the current revision of the directory, unique
+        across manager instances.
+        """
+        return '%s-%d' % (self._instance_tag, self._revision)
+
+    @property
+    def last_modified(self):
+        """ The time of the last modification of the directory, as a timestamp.
+        """
+        return self._last_modified
+
+    def cached(self, key, build):
+        """ Returns a value derived from the scenario definitions, building it only if
+        it has not been yet since the last modification of the directory.
+
+        :param key: the key identifying the value
+        :param callable build: the function building the value
+        :return: the value
+        """
+        with self._lock:
+            try:
+                return self._cache[key]
+            except KeyError:
+                value = self._cache[key] = build()
+                return value
+
+    def add_listener(self, listener):
+        """ Registers a listener of the directory modifications.
+
+        :param callable listener: the listener, called with the kind of modification
+        and the scenario id
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, what, id_=None):
+        for listener in self._listeners:
+            try:
+                listener(what, id_)
+            except Exception as e:
+                self.log_exception(e)
+
+    def _changed(self, id_=None):
+        """ Records a modification of the directory.
+
+        :param str id_: the id of the modified scenario, if the modification needs to be persisted
+        """
+        self._revision += 1
+        self._last_modified = time.time()
+        self._cache.clear()
+        if id_:
+            self._changes.add(id_)
+
+    @property
+    def has_pending_changes(self):
+        return bool(self._changes)
 
     def __contains__(self, name):
         return name in self._scenarios
@@ -230,7 +1118,11 @@ class ScenariosManager(Loggable):
         :rtype: Scenario
         :raise: KeyError if not found
         """
-        return self._scenarios[id_]
+        scenario = self._scenarios[id_]
+        if self._lazy and scenario.needs_plan:
+            with self._lock:
+                self._compile_plan(id_, scenario)
+        return scenario
 
     def add_scenario(self, id_, scenario):
         """ Adds a scenario to the directory
@@ -242,16 +1134,372 @@ class ScenariosManager(Loggable):
         if not isinstance(scenario, Scenario):
             raise TypeError("parameter 'scenario' type mismatch")
 
-        self._scenarios[id_] = scenario
+        with self._lock:
+            self._check_references({id_: scenario})
+            if id_ in self._scenarios:
+                what = self.SCENARIO_UPDATED
+            else:
+                what = self.SCENARIO_ADDED
+                bisect.insort(self._sorted_ids, id_)
+            self._scenarios[id_] = scenario
+            self._refresh_plans([id_])
+            self._reindex([id_])
+            self._changed(id_)
+        self._notify(what, id_)
+
+    def update_scenario(self, id_, settings):
+        """ Updates the definition of a scenario.
+        :param str id_: the id of the scenario to be updated
+        :param dict settings: the new settings of the scenario
+        :raise: KeyError if not found
+        :raise: ValueError if the new settings are invalid, or introduce a reference cycle or
+        an unknown reference
+        """
+        with self._lock:
+            scenario = self._scenarios[id_]
+            new_s = self._build_scenario(id_, settings)
+            self._check_references({id_: new_s})
+            scenario.assign(new_s)
+            self._refresh_plans([id_])
+            self._reindex([id_])
+            self._changed(id_)
+        self._notify(self.SCENARIO_UPDATED, id_)
 
     def remove_scenario(self, id_):
         """ Removes a scenario from the directory
         :param str id_: the id of the scenario to be removed
         :raise: KeyError if not found
+        :raise: ValueError if the scenario is referenced by other ones
         """
         if not id_:
             raise ValueError("parameter 'id_' is mandatory")
-        del self._scenarios[id_]
+        with self._lock:
+            if id_ not in self._scenarios:
+                raise KeyError(id_)
+            self._check_references({id_: None})
+            del self._scenarios[id_]
+            del self._sorted_ids[bisect.bisect_left(self._sorted_ids, id_)]
+            self._refresh_plans([id_])
+            self._reindex([id_])
+            self._changed(id_)
+        self._notify(self.SCENARIO_REMOVED, id_)
+
+    def apply_batch(self, create=None, update=None, delete=None):
+        """ Applies a set of modifications at once.
+
+        The whole batch is validated before being applied, so that either all the
+        modifications are done or none of them. The directory revision is incremented
+        only once, and the modifications are persisted by a single call to :py:meth:`save_changes`.
+
+        :param dict create: the settings of the scenarios to be added, keyed by id
+        :param dict update: the new settings of existing scenarios, keyed by id
+        :param list delete: the ids of the scenarios to be removed
+        :return: the applied modifications, as (kind of modification, id) pairs
+        :rtype: list of [tuple]
+        :raise: KeyError if a scenario to be updated or removed does not exist,
+        ValueError if ids are not non empty strings, if settings are invalid, if a
+        scenario to be created already exists, if a scenario is concerned by more than
+        one modification or if the result would contain reference cycles or unknown
+        references
+        """
+        create = create or {}
+        update = update or {}
+        delete = delete or []
+        ids = list(create) + list(update) + list(delete)
+        if not all(id_ and isinstance(id_, basestring) for id_ in ids):
+            raise ValueError('scenario ids must be non empty strings')
+        if len(set(ids)) != len(ids):
+            raise ValueError('scenarios cannot be modified more than once in a batch')
+
+        # settings are parsed before locking the directory
+        created = {id_: self._build_scenario(id_, d) for id_, d in create.iteritems()}
+        updated = {id_: self._build_scenario(id_, d) for id_, d in update.iteritems()}
+        return self._apply(created, updated, delete)
+
+    def _apply(self, created, updated, delete):
+        """ Applies a batch of modifications (see :py:meth:`apply_batch`).
+
+        :param dict created: the scenarios to be added, keyed by id
+        :param dict updated: the scenarios providing the new definitions, keyed by id
+        :param list delete: the ids of the scenarios to be removed
+        """
+        ids = list(created) + list(updated) + list(delete)
+        modifications = []
+        with self._lock:
+            for id_ in created:
+                if id_ in self._scenarios:
+                    raise ValueError('scenario already exists : %s' % id_)
+            for id_ in list(updated) + list(delete):
+                if id_ not in self._scenarios:
+                    raise KeyError(id_)
+            overrides = dict(created, **updated)
+            overrides.update((id_, None) for id_ in delete)
+            self._check_references(overrides)
+
+            for id_, scenario in created.iteritems():
+                self._scenarios[id_] = scenario
+                modifications.append((self.SCENARIO_ADDED, id_))
+            for id_, new_s in updated.iteritems():
+                self._scenarios[id_].assign(new_s)
+                modifications.append((self.SCENARIO_UPDATED, id_))
+            for id_ in delete:
+                del self._scenarios[id_]
+                modifications.append((self.SCENARIO_REMOVED, id_))
+            if created or delete:
+                self._sorted_ids = sorted(self._scenarios)
+            self._refresh_plans(ids)
+            self._reindex(ids)
+            if modifications:
+                self._changed()
+                self._changes.update(ids)
+
+        for what, id_ in modifications:
+            self._notify(what, id_)
+        return modifications
+
+    def find_target(self, target):
+        """ Returns the scenarios acting on a target.
+
+        :param str target: the target
+        :return: the indices of the actions acting on the target, keyed by scenario id
+        :rtype: dict
+        """
+        with self._lock:
+            return self._get_index().by_target(target)
+
+    def find_verb(self, verb):
+        """ Returns the ids of the scenarios using a verb.
+
+        :rtype: list of [str]
+        """
+        with self._lock:
+            return self._get_index().by_verb(verb)
+
+    def rename_target(self, target, new_target):
+        """ Replaces a target by another one in all the actions using it.
+
+        The modifications are applied as a single batch (see :py:meth:`apply_batch`).
+        Actions without explicit label get a label matching their new target.
+
+        :param str target: the current target
+        :param str new_target: the new target
+        :return: the ids of the modified scenarios
+        :rtype: list of [str]
+        :raise: ValueError if the new target is not a non empty string
+        """
+        if not new_target or not isinstance(new_target, basestring):
+            raise ValueError("parameter 'new_target' must be a non empty string")
+        with self._lock:
+            updated = {}
+            for id_, indices in self._get_index().by_target(target).iteritems():
+                scenario = self._scenarios[id_]
+                actions = scenario.actions[:]
+                for i in indices:
+                    action = actions[i]._replace(target=new_target)
+                    actions[i] = self._pool.get_action(*action) if self._pool is not None else action
+                updated[id_] = Scenario(
+                    scenario.label, actions, ui_verb=scenario.ui_verb, parallel=scenario.parallel_flags,
+                    schedule=scenario.schedule, triggers=scenario.triggers
+                )
+            self._apply({}, updated, [])
+        return sorted(updated)
+
+    def _get_index(self):
+        if self._index is None:
+            index = ActionsIndex()
+            if isinstance(self._scenarios, LazyScenarios):
+                # don't build scenarios only for indexing them
+                for id_ in self._scenarios:
+                    index.add(id_, [
+                        (d['verb'], d['target']) if ScenarioRef.KEY_SCENARIO not in d else None
+                        for d in self._scenarios.get_settings(id_)[Scenario.KEY_ACTIONS]
+                    ])
+            else:
+                for id_, scenario in self._scenarios.iteritems():
+                    index.add(id_, self._index_entries(scenario))
+            self._index = index
+        return self._index
+
+    @staticmethod
+    def _index_entries(scenario):
+        return [
+            (action.verb, action.target) if isinstance(action, BasicAction) else None
+            for action in scenario.actions
+        ]
+
+    def _reindex(self, ids):
+        """ Updates the index after the modification of scenarios.
+        """
+        if self._index is None:
+            return
+        for id_ in ids:
+            scenario = self._lookup(id_)
+            if scenario is None:
+                self._index.remove(id_)
+            else:
+                self._index.add(id_, self._index_entries(scenario))
+
+    def _resolve(self, id_, scenario, lookup, reached):
+        """ Flattens a composite scenario.
+
+        The references are replaced by the actions of the referenced scenarios, recursively.
+        Actions requesting the state already requested by the previous action on the same
+        target are dropped.
+
+        :param str id_: the id of the scenario
+        :param Scenario scenario: the scenario
+        :param callable lookup: returns a scenario given its id, None if it does not exist
+        :param set reached: updated with the ids of the scenarios reached by the resolution
+        :return: the actions of the plan and their parallel flags
+        :rtype: tuple
+        :raise: ValueError in case of reference cycle or unknown reference
+        """
+        actions, parallel = [], []
+        requested = {}
+        # set when a dropped action started a step, so that the next one starts it instead
+        state = {'new_step': False}
+
+        def expand(scen, path, join):
+            for i, (action, flag) in enumerate(zip(scen.actions, scen.parallel_flags)):
+                if i == 0:
+                    flag = join
+                if isinstance(action, ScenarioRef):
+                    ref = action.scenario
+                    if ref in path:
+                        raise ValueError('reference cycle : %s' % ' -> '.join(path + [ref]))
+                    reached.add(ref)
+                    sub = lookup(ref)
+                    if sub is None:
+                        raise ValueError('unknown scenario : %s' % ref)
+                    expand(sub, path + [ref], flag)
+                    continue
+
+                key = action.verb, action.target
+                if key in requested and requested[key] == action.data:
+                    state['new_step'] = state['new_step'] or not flag
+                    continue
+                requested[key] = action.data
+                actions.append(action)
+                parallel.append(flag and not state['new_step'])
+                state['new_step'] = False
+
+        expand(scenario, [id_], False)
+        return actions, parallel
+
+    def _lookup(self, id_):
+        return self._scenarios[id_] if id_ in self._scenarios else None
+
+    def _compile_plan(self, id_, scenario):
+        """ Computes the plan of a composite scenario and indexes the scenarios it reaches.
+
+        Errors are logged, the scenario being left without plan.
+        """
+        self._unregister_plan(id_)
+        reached = set()
+        try:
+            scenario.set_plan(*self._resolve(id_, scenario, self._lookup, reached))
+        except ValueError as e:
+            self.log_error('cannot resolve references of scenario %s : %s', id_, e)
+        finally:
+            # unknown references are indexed too, so that the plan is recompiled when they are added
+            self._plan_refs[id_] = reached
+            for ref in reached:
+                self._dependents.setdefault(ref, set()).add(id_)
+
+    def _register_references(self, scenarios):
+        """ Indexes the scenarios reached by the lazily loaded composite scenarios, using
+        their stored settings.
+
+        This way, the modifications of the scenarios they depend on are checked even if
+        they have not been built yet. Their plans are computed when they are first used.
+
+        :param LazyScenarios scenarios: the scenarios
+        """
+        direct = {}
+        for id_ in scenarios:
+            refs = [
+                d[ScenarioRef.KEY_SCENARIO]
+                for d in scenarios.get_settings(id_).get(Scenario.KEY_ACTIONS) or []
+                if ScenarioRef.KEY_SCENARIO in d
+            ]
+            if refs:
+                direct[id_] = refs
+        for id_, refs in direct.iteritems():
+            reached = set()
+            pending = list(refs)
+            while pending:
+                ref = pending.pop()
+                if ref not in reached:
+                    reached.add(ref)
+                    pending.extend(direct.get(ref, ()))
+            self._plan_refs[id_] = reached
+            for ref in reached:
+                self._dependents.setdefault(ref, set()).add(id_)
+
+    def _unregister_plan(self, id_):
+        for ref in self._plan_refs.pop(id_, ()):
+            dependents = self._dependents.get(ref)
+            if dependents:
+                dependents.discard(id_)
+                if not dependents:
+                    del self._dependents[ref]
+
+    def _affected_plans(self, ids):
+        """ Returns the ids of the modified scenarios and of the composite ones depending on them.
+        """
+        affected = set(ids)
+        for id_ in ids:
+            affected.update(self._dependents.get(id_, ()))
+        return affected
+
+    def _check_references(self, overrides):
+        """ Checks that modifications would not introduce reference cycles or unknown references.
+
+        :param dict overrides: the new scenarios, keyed by id, None meaning that the scenario is removed
+        :raise: ValueError if the references of a scenario could not be resolved
+        """
+        def lookup(ref):
+            return overrides[ref] if ref in overrides else self._lookup(ref)
+
+        for id_ in self._affected_plans(overrides):
+            scenario = lookup(id_)
+            if scenario is not None and scenario.is_composite:
+                try:
+                    self._resolve(id_, scenario, lookup, set())
+                except ValueError as e:
+                    raise ValueError('invalid references of scenario %s : %s' % (id_, e))
+
+    def _refresh_plans(self, ids):
+        """ Recompiles the plans affected by the modification of scenarios.
+        """
+        for id_ in self._affected_plans(ids):
+            scenario = self._lookup(id_)
+            if scenario is not None and scenario.is_composite:
+                self._compile_plan(id_, scenario)
+            else:
+                self._unregister_plan(id_)
+
+    def _build_scenario(self, id_, settings):
+        try:
+            return Scenario.from_dict(settings, self._pool)
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            raise ValueError('invalid settings of scenario %s : %s' % (id_, e))
+
+    def export_scenarios(self, ids=None):
+        """ Returns the settings of scenarios.
+
+        :param ids: the ids of the exported scenarios (default: all of them)
+        :type ids: list of [str]
+        :return: the settings, keyed by scenario id
+        :rtype: dict
+        :raise: KeyError if one of the scenarios does not exist
+        """
+        with self._lock:
+            if ids is None:
+                return self._as_dicts()
+            if isinstance(self._scenarios, LazyScenarios):
+                return {k: self._scenarios.get_settings(k) for k in ids}
+            return {k: self._scenarios[k].as_dict() for k in ids}
 
     def load_scenarios(self, path=None):
         """ Loads the scenario definitions from a given file.
@@ -262,11 +1510,33 @@ class ScenariosManager(Loggable):
                 "label" : "...",
                 "ui_verb": "...",
                 "actions" : [
-                    {"label": "...", "label": "...", "verb": "....", "target": "...", "data": "..."},
+                    {"label": "...", "verb": "....", "target": "...", "data": "...", "parallel": false},
+                    {"label": "...", "scenario": "...", "parallel": false},
                     ...
                 ]
             }
         }
+
+        The "parallel" action attribute is optional. When true, the action is executed
+        concurrently with the preceding one.
+
+        Actions with a "scenario" attribute are references to other scenarios. They are
+        resolved once all the definitions are loaded, unresolvable ones being reported
+        in the log.
+
+        In lazy mode, the file is only indexed, and the definitions are decoded when the
+        scenarios are accessed for the first time.
+
+        Changes recorded in the journal file stored next to it are applied
+        (see :py:class:`pycstbox.homeautomation.storage.JSONFileStore`).
+
+        Definitions can also be stored in a SQLite database, one row per scenario, which
+        is the case if the path has one of the extensions listed by
+        :py:attr:`pycstbox.homeautomation.storage.SQLiteStore.SUFFIXES`.
+
+        If the compiled cache is used, the scenarios are loaded from it when it is up
+        to date, and it is rebuilt otherwise.
+
         :param str path: the data file path (default: DEFAULT_STORAGE_PATH)
         :raise: ValueError if file not found
         :raise: json.JSONError if file content is not valid
@@ -274,25 +1544,169 @@ class ScenariosManager(Loggable):
         if not path:
             path = self.DEFAULT_STORAGE_PATH
 
-        if not os.path.isfile(path):
-            raise ValueError("path '%s' not found or is not a file" % path)
-
+        store = open_store(path)
         self.log_info('loading scenario definitions from %s', path)
-        self._scenarios = {}
-        for k, v in json.load(file(path, "rt")).iteritems():
-            self._scenarios[k] = Scenario.from_dict(v)
+        # signature is taken before reading, so that a modification occurring while
+        # we are loading will be detected by the next check
+        signature = store.signature()
+        # a new pool is used, so that actions of the previous definitions are released
+        pool = ActionsPool() if self._compact else None
+        if self._lazy:
+            document, changes = store.load_indexed()
+            scenarios = LazyScenarios(document, changes, pool)
+        elif self._use_cache:
+            scenarios = self._load_through_cache(store, signature, pool)
+        else:
+            scenarios = self._load_from_store(store, pool)
+
+        with self._lock:
+            self._pool = pool
+            self._cancel_flush()
+            self._scenarios = scenarios
+            self._sorted_ids = sorted(scenarios)
+            self._dependents.clear()
+            self._plan_refs.clear()
+            self._index = None
+            if not self._lazy:
+                for id_, scenario in scenarios.iteritems():
+                    if scenario.is_composite:
+                        self._compile_plan(id_, scenario)
+            else:
+                self._register_references(scenarios)
+            self._changes.clear()
+            self._changed()
+            self._store = store
+            self._store_signature = signature
+        self._notify(self.SCENARIOS_RELOADED)
+
+    @staticmethod
+    def _load_from_store(store, pool):
+        scenarios = {}
+        for k, v in store.iter_items():
+            scenarios[k] = Scenario.from_dict(v, pool)
+        return scenarios
+
+    def _load_through_cache(self, store, signature, pool):
+        cache = CompiledCache(store.path)
+        records = cache.load(signature)
+        if records is not None:
+            self.log_info('loading compiled scenarios from %s', cache.path)
+            # the journal is not read, but its size must be known for compacting it
+            store.count_journal()
+            return {k: Scenario.from_record(r, pool) for k, r in records.iteritems()}
+
+        scenarios = self._load_from_store(store, pool)
+        # the cache is built only if the files have not been modified while being read
+        if store.signature() == signature:
+            cache.save(signature, {k: v.as_record() for k, v in scenarios.iteritems()})
+        return scenarios
+
+    def reload_if_changed(self):
+        """ Reloads the scenario definitions if the file they have been loaded from
+        has been modified since the last load or save.
+
+        The check is based on the file modification time and size, which costs a single
+        stat call per file. Nothing is done if no definitions have been loaded yet, or
+        if there are local changes not yet saved.
+
+        :return: True if the definitions have been reloaded
+        :rtype: bool
+        """
+        if not self._store or self._changes:
+            return False
+
+        signature = self._store.signature()
+        if signature[0] is None or signature == self._store_signature:
+            return False
+
+        self.log_info('storage file has been modified')
+        self.load_scenarios(self._store.path)
+        return True
 
     def save_scenarios(self, path=None):
         """ Stores the scenario definitions in the indicated file.
 
-        :param str path: target file path (default: DEFAULT_STORAGE_PATH)
+        The file is replaced atomically. The storage backend depends on the extension
+        of the file, so that this can be used for converting the definitions from a
+        backend to another.
+
+        :param str path: target file path (default: the path the definitions have been
+        loaded from if any, DEFAULT_STORAGE_PATH otherwise)
         """
-        if not path:
-            path = self.DEFAULT_STORAGE_PATH
+        with self._lock:
+            if not path:
+                path = self._store.path if self._store else self.DEFAULT_STORAGE_PATH
+
+            self.log_info('storing scenario definitions to %s', path)
+            if self._store and path == self._store.path:
+                store = self._store
+            else:
+                store = open_store(path)
+            store.write_all(self._as_dicts())
+
+            if not self._store:
+                self._store = store
+            if store is self._store:
+                self._cancel_flush()
+                self._changes.clear()
+                # don't reload what we have just written
+                self._store_signature = store.signature()
+
+    def save_changes(self, delay=0):
+        """ Persists the changes done since the last load or save.
 
-        self.log_info('storing scenario definitions to %s', path)
-        out = {
+        Changes are appended to the storage journal rather than rewriting the whole
+        file. When a delay is given, the write is deferred so that the changes done
+        meanwhile are coalesced in a single write.
+
+        :param float delay: the delay (in seconds) before writing the changes
+        """
+        with self._lock:
+            if delay <= 0:
+                self._cancel_flush()
+                self.flush_changes()
+            elif not self._flush_timer:
+                self._flush_timer = threading.Timer(delay, self._on_flush_timer)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush_changes(self):
+        """ Writes the pending changes if any.
+        """
+        with self._lock:
+            if not self._changes:
+                return
+            if not self._store:
+                self.save_scenarios()
+                return
+
+            changes = {
+                id_: self._scenarios[id_].as_dict() if id_ in self._scenarios else None
+                for id_ in self._changes
+            }
+            self.log_info('storing %d change(s) to %s', len(changes), self._store.path)
+            self._store.write_changes(changes, self._as_dicts)
+            self._changes.clear()
+            self._store_signature = self._store.signature()
+
+    def _on_flush_timer(self):
+        with self._lock:
+            self._flush_timer = None
+            try:
+                self.flush_changes()
+            except Exception as e:
+                self.log_exception(e)
+
+    def _cancel_flush(self):
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _as_dicts(self):
+        if isinstance(self._scenarios, LazyScenarios):
+            # don't build scenarios only for storing them back
+            return {k: self._scenarios.get_settings(k) for k in self._scenarios}
+        return {
             k: v.as_dict()
             for k, v in self._scenarios.iteritems()
         }
-        json.dump(out, file(path, 'wt'), indent=4)
\ No newline at end of file
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Cache of the last known state of the devices.
+
+The cache is fed by the events observed on the event bus and by the control events
+emitted by the scenarios. It is used for skipping the actions which would not change
+the state of their target (see :py:meth:`pycstbox.homeautomation.core.Scenario.execute`).
+
+States are identified by the (var_type, var_name) pair of the events, which is the
+same as the (verb, target) pair of the actions controlling the devices.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import json
+import time
+
+from pycstbox.log import Loggable
+from pycstbox.events import DataKeys
+from pycstbox.homeautomation.triggers import EVENT_SIGNAL
+
+
+def decode_value(data):
+    """ Returns the value carried by JSON encoded event data.
+
+    :param str data: the event data
+    :return: the value, or the whole data if they don't include a value
+    :raise: ValueError if the data are not valid JSON
+    """
+    payload = json.loads(data) if data else None
+    if isinstance(payload, dict) and DataKeys.VALUE in payload:
+        return payload[DataKeys.VALUE]
+    return payload
+
+
+class DeviceStateCache(Loggable):
+    """ The last known state of the devices.
+
+    Since devices can be operated by other means than events, states can be given
+    a maximum age past which they are considered as unknown.
+    """
+    def __init__(self, max_age=None, clock=time.time):
+        """
+        :param float max_age: the time (in seconds) after which a state is ignored
+        (default: states don't expire)
+        :param callable clock: returns the current time
+        """
+        super(DeviceStateCache, self).__init__()
+        self._max_age = max_age
+        self._clock = clock
+        # (var_type, var_name) -> (value, time)
+        self._states = {}
+
+        self.hits_count = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def clear(self):
+        self._states.clear()
+
+    def update(self, var_type, var_name, value):
+        """ Records the current state of a device.
+        """
+        self._states[(var_type, var_name)] = (value, self._clock())
+
+    def get(self, var_type, var_name, default=None):
+        """ Returns the current state of a device, or the default value if unknown.
+        """
+        state = self._states.get((var_type, var_name))
+        if state is None or (self._max_age is not None and self._clock() - state[1] > self._max_age):
+            return default
+        return state[0]
+
+    def is_in_state(self, verb, target, data):
+        """ Tells if a control event would leave its target in its current state.
+
+        :param str verb: the event var_type
+        :param str target: the event var_name
+        :param str data: the JSON encoded event data
+        :rtype: bool
+        """
+        unknown = self
+        current = self.get(verb, target, unknown)
+        if current is unknown:
+            return False
+        try:
+            in_state = decode_value(data) == current
+        except ValueError:
+            return False
+        if in_state:
+            self.hits_count += 1
+        return in_state
+
+    def record_events(self, events):
+        """ Records the states set by control events.
+
+        :param events: the events, as (var_type, var_name, data) tuples
+        """
+        for var_type, var_name, data in events:
+            try:
+                self.update(var_type, var_name, decode_value(data))
+            except ValueError:
+                self._states.pop((var_type, var_name), None)
+
+    def trace_emission(self, events, duration, error):
+        """ Emitter tracer (see :py:class:`pycstbox.homeautomation.core.EventEmitter`),
+        recording the states set by the events successfully emitted.
+        """
+        if not error:
+            self.record_events(events)
+
+    def on_event_signal(self, timestamp, var_type, var_name, data):
+        """ Handler of the event manager signal.
+        """
+        self.record_events([(var_type, var_name, data)])
+
+    def attach(self, event_manager):
+        """ Subscribes to the events of an event manager channel.
+
+        :return: the signal match, which can be used for unsubscribing
+        """
+        return event_manager.connect_to_signal(EVENT_SIGNAL, self.on_event_signal)
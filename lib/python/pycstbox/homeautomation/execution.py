@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Asynchronous execution of scenarios.
+
+Scenarios are executed by a pool of worker threads, so that the caller (typically a
+web service request handler) does not have to wait for all the control events to be
+emitted. Each execution is tracked by a job which can be queried for its progress.
+
+The control events of concurrent executions can be coalesced, so that devices don't
+receive redundant commands when overlapping scenarios are run at the same time.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from Queue import Queue
+
+from pycstbox.log import Loggable
+from pycstbox.homeautomation.core import EventEmitter
+from pycstbox.homeautomation.ratelimit import RateLimiter
+
+
+class ExecutionJob(object):
+    """ The execution of a scenario, as submitted to the executor.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    # notifications of the execution progress
+    STARTED = 'execution_started'
+    ACTION_DONE = 'execution_action_done'
+    FINISHED = 'execution_finished'
+
+    def __init__(self, scen_id, scenario, force=False):
+        """
+        :param str scen_id: the id of the executed scenario
+        :param Scenario scenario: the executed scenario
+        :param bool force: if True, actions are executed even if their target is already
+        in the requested state
+        """
+        self._id = uuid.uuid4().hex
+        self._scen_id = scen_id
+        self._scenario = scenario
+        self._force = force
+        self._status = self.PENDING
+        self._error = None
+        self._actions = []
+        self._submitted = time.time()
+        self._started = self._ended = None
+        self._terminated = threading.Event()
+        self._notify = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def scen_id(self):
+        return self._scen_id
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def force(self):
+        return self._force
+
+    @property
+    def duration(self):
+        """ The execution duration in seconds, None if not terminated yet.
+        """
+        if self._started is None or self._ended is None:
+            return None
+        return self._ended - self._started
+
+    @property
+    def terminated(self):
+        return self._terminated.is_set()
+
+    def wait(self, timeout=None):
+        """ Waits for the job to be terminated.
+
+        :param float timeout: maximum wait time in seconds (default: no limit)
+        :return: True if the job is terminated
+        :rtype: bool
+        """
+        self._terminated.wait(timeout)
+        return self._terminated.is_set()
+
+    def run(self, event_manager, notify=None, state_cache=None):
+        """ Executes the scenario, keeping track of the progress.
+
+        Errors are not propagated, but recorded in the job status.
+
+        If provided, the notification callback is invoked when the execution starts,
+        after each action and when the execution is finished, with the kind of
+        notification, the job and a dictionary providing details.
+
+        :param event_manager: the event manager used by actions, or an emitter wrapping it
+        :type event_manager: EventManagerObject or EventEmitter
+        :param callable notify: optional notification callback
+        :param DeviceStateCache state_cache: optional device state cache, used for skipping
+        the actions which would not change the state of their target
+        """
+        self._notify = notify
+        # progress is tracked on the actions of the plan, in which the references to
+        # other scenarios have been replaced by their actions
+        try:
+            plan = self._scenario.plan
+        except ValueError:
+            # reported as an execution failure below
+            plan = ()
+        self._actions = [
+            {'label': action.label, 'status': self.PENDING, 'error': None, 'ended': None}
+            for action in plan
+        ]
+        self._started = time.time()
+        self._status = self.RUNNING
+        if notify:
+            notify(self.STARTED, self, {'actions': len(self._actions)})
+        try:
+            self._scenario.execute(
+                event_manager, progress=self._on_progress,
+                state_cache=state_cache, force=self._force, on_skip=self._on_skip
+            )
+        except Exception as e:
+            self._error = str(e)
+            self._status = self.FAILED
+        else:
+            self._status = self.DONE
+        finally:
+            self._ended = time.time()
+            if notify:
+                notify(self.FINISHED, self, {'status': self._status, 'error': self._error})
+            self._terminated.set()
+
+    def _on_progress(self, index, action, error):
+        # the action list could have been modified since we started
+        if index >= len(self._actions):
+            return
+        if error:
+            self._actions[index].update(status=self.FAILED, error=str(error))
+        else:
+            self._actions[index]['status'] = self.DONE
+        self._actions[index]['ended'] = time.time()
+        if self._notify:
+            self._notify(self.ACTION_DONE, self, dict(self._actions[index], index=index))
+
+    def _on_skip(self, index, action):
+        if index >= len(self._actions):
+            return
+        self._actions[index].update(status=self.SKIPPED, ended=time.time())
+        if self._notify:
+            self._notify(self.ACTION_DONE, self, dict(self._actions[index], index=index))
+
+    def as_dict(self):
+        return {
+            'id': self._id,
+            'scenario': self._scen_id,
+            'status': self._status,
+            'error': self._error,
+            'submitted': self._submitted,
+            'started': self._started,
+            'ended': self._ended,
+            'actions': [a.copy() for a in self._actions]
+        }
+
+
+class ActionCoalescer(Loggable):
+    """ Coalesces the control events sent to a same device within a time window.
+
+    It is used in place of the event manager, and forwards the events to an emitter
+    wrapping the real one. Events are identified by their (verb, target) pair :
+
+    - the first event for a given pair is forwarded immediately
+    - an event repeating the value last sent for its pair less than a window ago is dropped
+    - an event changing the value is held until the end of the window, and is replaced by
+      the ones received for the same pair meanwhile, so that only the last value is sent
+      (and is dropped too if it is the same as the one last sent)
+
+    Held events are sent by a timer thread, and failures are only logged since the
+    executions which produced them are already over.
+    """
+    DEFAULT_WINDOW = 0.2
+
+    # past this count, the values sent more than a window ago are forgotten
+    MAX_TRACKED = 1000
+
+    def __init__(self, emitter, window=DEFAULT_WINDOW, clock=time.time):
+        """
+        :param EventEmitter emitter: the emitter used for sending the events
+        :param float window: the coalescing window, in seconds
+        :param callable clock: returns the current time
+        """
+        if window <= 0:
+            raise ValueError("invalid window : %s" % window)
+        super(ActionCoalescer, self).__init__()
+
+        self._emitter = emitter
+        self._window = window
+        self._clock = clock
+        # (verb, target) -> (data, time) of the last sent events
+        self._sent = {}
+        # (verb, target) -> data of the held events
+        self._held = OrderedDict()
+        self._timer = None
+        self._lock = threading.Lock()
+        # held events are sent in order, even if timers overlap
+        self._flush_lock = threading.Lock()
+
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.failures_count = 0
+
+    @property
+    def held_count(self):
+        return len(self._held)
+
+    def emitEvent(self, var_type, var_name, data):
+        self.emitEvents([(var_type, var_name, data)])
+
+    def emitEvents(self, events):
+        """ Processes a sequence of events, forwarding immediately the ones which can be.
+        """
+        now = self._clock()
+        forwarded = []
+        with self._lock:
+            if len(self._sent) > self.MAX_TRACKED:
+                self._forget(now)
+            for event in events:
+                verb, target, data = event
+                key = (verb, target)
+                if key in self._held:
+                    self._held[key] = data
+                    self.coalesced_count += 1
+                    continue
+                last = self._sent.get(key)
+                if last is not None and now - last[1] < self._window:
+                    if last[0] == data:
+                        self.dropped_count += 1
+                    else:
+                        self._held[key] = data
+                        self._arm_timer()
+                    continue
+                self._sent[key] = (data, now)
+                forwarded.append(event)
+            self.sent_count += len(forwarded)
+        if forwarded:
+            self._emitter.emit(forwarded)
+
+    def _forget(self, now):
+        self._sent = {k: v for k, v in self._sent.iteritems() if now - v[1] < self._window}
+
+    def _arm_timer(self):
+        if not self._timer:
+            self._timer = threading.Timer(self._window, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """ Sends the held events.
+        """
+        with self._flush_lock:
+            now = self._clock()
+            events = []
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                held, self._held = self._held, OrderedDict()
+                for key, data in held.iteritems():
+                    last = self._sent.get(key)
+                    if last is not None and last[0] == data:
+                        self.dropped_count += 1
+                        continue
+                    self._sent[key] = (data, now)
+                    events.append(key + (data,))
+                self.sent_count += len(events)
+            if not events:
+                return
+            try:
+                self._emitter.emit(events)
+            except Exception as e:
+                self.failures_count += 1
+                self.log_error('failed to send coalesced events : %s', e)
+
+
+class ScenarioExecutor(Loggable):
+    """ Executes scenarios in a pool of worker threads.
+
+    The jobs of the most recent executions are kept for being queried after their
+    termination, up to a given count.
+
+    Listeners can be registered for being notified of the progress of executions (see
+    :py:meth:`ExecutionJob.run`). They are called from the worker threads.
+
+    If a coalescing window is given, the events of all the executions go through an
+    :py:class:`ActionCoalescer`. If rate limits are given, they go through a
+    :py:class:`pycstbox.homeautomation.ratelimit.RateLimiter` before reaching the event
+    manager. In both cases, actions are reported as done once their events have been
+    handed over, even if they are held for a while.
+
+    If a device state cache is given, it records the events actually sent, and the actions
+    whose target is already in the requested state are skipped unless the execution is forced.
+    """
+    DEFAULT_WORKERS = 2
+    DEFAULT_MAX_JOBS = 100
+
+    def __init__(self, event_manager, workers=DEFAULT_WORKERS, max_jobs=DEFAULT_MAX_JOBS, tracer=None,
+                 coalesce_window=0, rate_limits=None, state_cache=None):
+        """
+        :param EventManagerObject event_manager: the event manager used by actions
+        :param int workers: the number of worker threads
+        :param int max_jobs: the maximum number of jobs kept
+        :param callable tracer: optional events emission tracer (see :py:class:`EventEmitter`)
+        :param float coalesce_window: the window (in seconds) used for coalescing the events
+        of concurrent executions (default: no coalescing)
+        :param dict rate_limits: the keyword arguments of the rate limiter of the events
+        (default: no rate limiting)
+        :param DeviceStateCache state_cache: optional device state cache
+        """
+        if not event_manager:
+            raise ValueError("parameter 'event_manager' is mandatory")
+        if workers < 1:
+            raise ValueError("invalid workers count : %s" % workers)
+
+        super(ScenarioExecutor, self).__init__()
+
+        self._state_cache = state_cache
+        if state_cache is not None:
+            next_tracer = tracer
+
+            def tracer(events, duration, error):
+                state_cache.trace_emission(events, duration, error)
+                if next_tracer:
+                    next_tracer(events, duration, error)
+
+        emitter = EventEmitter(event_manager, tracer=tracer)
+        self._rate_limiter = None
+        if rate_limits is not None:
+            self._rate_limiter = RateLimiter(emitter, **rate_limits)
+            emitter = EventEmitter(self._rate_limiter)
+        self._coalescer = None
+        if coalesce_window > 0:
+            self._coalescer = ActionCoalescer(emitter, coalesce_window)
+            emitter = EventEmitter(self._coalescer)
+        self._emitter = emitter
+        self._max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._listeners = []
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop, name='scenario-executor-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def coalescer(self):
+        """ The events coalescer, None if events are not coalesced.
+        """
+        return self._coalescer
+
+    @property
+    def rate_limiter(self):
+        """ The events rate limiter, None if events are not rate limited.
+        """
+        return self._rate_limiter
+
+    @property
+    def state_cache(self):
+        """ The device state cache, None if actions are never skipped.
+        """
+        return self._state_cache
+
+    @property
+    def queue_depth(self):
+        """ The number of jobs waiting for a worker.
+        """
+        return self._queue.qsize()
+
+    def add_listener(self, listener):
+        """ Registers a listener of the executions progress.
+
+        :param callable listener: the listener, called with the kind of notification,
+        the job and the notification details
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, what, job, details):
+        for listener in self._listeners:
+            try:
+                listener(what, job, details)
+            except Exception as e:
+                self.log_exception(e)
+
+    def submit(self, scen_id, scenario, force=False):
+        """ Submits a scenario for execution.
+
+        :param str scen_id: the id of the scenario
+        :param Scenario scenario: the scenario
+        :param bool force: if True, the actions are executed whatever the state of their target
+        :return: the job tracking the execution
+        :rtype: ExecutionJob
+        """
+        job = ExecutionJob(scen_id, scenario, force=force)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._purge_jobs()
+        self._queue.put(job)
+        return job
+
+    def get_job(self, job_id):
+        """ Returns a job given its id.
+
+        :param str job_id: the job id
+        :rtype: ExecutionJob
+        :raise: KeyError if not found
+        """
+        with self._lock:
+            return self._jobs[job_id]
+
+    def shutdown(self, wait=True):
+        """ Stops the workers once the pending jobs are executed.
+
+        :param bool wait: if True, waits for the workers to be terminated
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+            if self._coalescer:
+                self._coalescer.flush()
+            if self._rate_limiter:
+                self._rate_limiter.close()
+        self._workers = []
+
+    def _purge_jobs(self):
+        """ Forgets the oldest terminated jobs in excess.
+        """
+        excess = len(self._jobs) - self._max_jobs
+        if excess <= 0:
+            return
+        for job_id in [k for k, job in self._jobs.iteritems() if job.terminated][:excess]:
+            del self._jobs[job_id]
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self.log_info('executing scenario %s (job=%s)', job.scen_id, job.id)
+            try:
+                job.run(self._emitter, notify=self._notify, state_cache=self._state_cache)
+            except Exception as e:
+                self.log_exception(e)
+            if job.status == ExecutionJob.FAILED:
+                self.log_error('scenario %s execution failed (job=%s)', job.scen_id, job.id)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" History of the scenario executions.
+
+The last executions are kept in memory in a fixed size ring buffer, so that the memory
+used does not depend on how often scenarios are triggered. The executions evicted from
+the buffer can be spilled to a set of rotating files, which size is bounded too.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import json
+import os
+import threading
+from array import array
+from collections import deque
+
+from pycstbox.log import Loggable
+from pycstbox.homeautomation.execution import ExecutionJob
+
+# one character per action outcome, for keeping the records compact
+_OUTCOMES = {
+    ExecutionJob.PENDING: '-',
+    ExecutionJob.DONE: 'd',
+    ExecutionJob.FAILED: 'f',
+    ExecutionJob.SKIPPED: 's',
+}
+_OUTCOME_NAMES = {code: status for status, code in _OUTCOMES.iteritems()}
+
+MAX_ERROR_LENGTH = 200
+
+
+def _truncate(error):
+    if error is None:
+        return None
+    error = str(error)
+    return error if len(error) <= MAX_ERROR_LENGTH else error[:MAX_ERROR_LENGTH - 3] + '...'
+
+
+class ExecutionRecord(object):
+    """ The compact record of a terminated scenario execution.
+
+    The outcomes of the actions are stored as a string with one character per action,
+    and their end times as offsets (in seconds) from the start of the execution.
+    """
+    __slots__ = ('job_id', 'scen_id', 'started', 'ended', 'status', 'error', 'outcomes', 'offsets', 'errors')
+
+    def __init__(self, job_id, scen_id, started, ended, status, error=None, outcomes='', offsets=None, errors=None):
+        self.job_id = job_id
+        self.scen_id = scen_id
+        self.started = started
+        self.ended = ended
+        self.status = status
+        self.error = _truncate(error)
+        self.outcomes = outcomes
+        self.offsets = offsets if offsets is not None else array('f')
+        # (action index, error) pairs of the failed actions
+        self.errors = errors
+
+    @classmethod
+    def from_job(cls, job):
+        """ Builds the record of a terminated execution job.
+
+        :param ExecutionJob job: the job
+        :rtype: ExecutionRecord
+        """
+        d = job.as_dict()
+        started = d['started'] if d['started'] is not None else d['submitted']
+        outcomes, offsets, errors = [], array('f'), []
+        for i, action in enumerate(d['actions']):
+            outcomes.append(_OUTCOMES.get(action['status'], '-'))
+            offsets.append(action['ended'] - started if action.get('ended') is not None else -1.)
+            if action['error']:
+                errors.append((i, _truncate(action['error'])))
+        return cls(
+            d['id'], d['scenario'], started, d['ended'], d['status'], d['error'],
+            ''.join(outcomes), offsets, tuple(errors) or None
+        )
+
+    @property
+    def duration(self):
+        return self.ended - self.started if self.ended is not None else None
+
+    def as_dict(self):
+        """ Returns the record as a JSON serializable dictionary.
+
+        The duration of an action is the time elapsed since the end of the previous
+        one, or since the start of the execution for the first one. It is None if the
+        action has not been run.
+        """
+        errors = dict(self.errors or ())
+        actions = []
+        last = 0.
+        for i, (outcome, offset) in enumerate(zip(self.outcomes, self.offsets)):
+            duration = None
+            if offset >= 0:
+                duration = max(offset - last, 0.)
+                last = max(last, offset)
+            actions.append({
+                'status': _OUTCOME_NAMES[outcome],
+                'duration': round(duration, 6) if duration is not None else None,
+                'error': errors.get(i)
+            })
+        return {
+            'job': self.job_id,
+            'scenario': self.scen_id,
+            'started': self.started,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error,
+            'actions': actions
+        }
+
+
+class SpillFile(Loggable):
+    """ Rotating files storing the records evicted from the history buffer.
+
+    Records are appended as JSON lines to the current file. When its size exceeds the
+    limit, it is renamed with a numbered suffix, the oldest file being dropped if there
+    are already as many of them as configured.
+    """
+    DEFAULT_MAX_SIZE = 1024 * 1024
+    DEFAULT_SEGMENTS = 2
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, segments=DEFAULT_SEGMENTS):
+        """
+        :param str path: the path of the current file
+        :param int max_size: the size (in bytes) past which the current file is rotated
+        :param int segments: the total number of files, including the current one
+        """
+        Loggable.__init__(self)
+        self._path = path
+        self._max_size = max_size
+        self._segments = max(segments, 1)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _segment_path(self, n):
+        return self._path if n == 0 else '%s.%d' % (self._path, n)
+
+    def write(self, record):
+        """ Appends a record to the current file.
+
+        :param dict record: the record, as returned by :py:meth:`ExecutionRecord.as_dict`
+        """
+        with open(self._path, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+            size = fp.tell()
+        if size >= self._max_size:
+            self._rotate()
+
+    def _rotate(self):
+        last = self._segment_path(self._segments - 1)
+        if os.path.exists(last):
+            os.remove(last)
+        for n in range(self._segments - 1, 0, -1):
+            src = self._segment_path(n - 1)
+            if os.path.exists(src):
+                os.rename(src, self._segment_path(n))
+
+    def iter_records(self):
+        """ Iterates over the stored records, the most recent first.
+
+        The files are read backwards by blocks, so that the most recent records are
+        available without loading whole segments.
+
+        Lines which can't be decoded, such as a partially written last line, are ignored.
+        """
+        for n in range(self._segments):
+            try:
+                fp = open(self._segment_path(n), 'rb')
+            except IOError:
+                continue
+            with fp:
+                for line in _reversed_lines(fp):
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        self.log_warning('invalid history line ignored in %s', self._segment_path(n))
+
+
+def _reversed_lines(fp, block_size=8192):
+    """ Yields the non empty lines of a file, starting from the last one.
+    """
+    fp.seek(0, os.SEEK_END)
+    pos = fp.tell()
+    tail = ''
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        fp.seek(pos)
+        lines = (fp.read(size) + tail).split('\n')
+        # the first line can continue in the previous block
+        tail = lines.pop(0)
+        for line in reversed(lines):
+            if line:
+                yield line
+    if tail:
+        yield tail
+
+
+class ExecutionHistory(Loggable):
+    """ The history of the scenario executions.
+
+    It is registered as a listener of the scenario executor, and records the executions
+    when they are finished.
+    """
+    DEFAULT_CAPACITY = 1000
+    DEFAULT_PAGE_SIZE = 20
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, spill=None):
+        """
+        :param int capacity: the number of executions kept in memory
+        :param SpillFile spill: optional files receiving the executions evicted from memory
+        """
+        Loggable.__init__(self)
+        self._records = deque(maxlen=capacity)
+        self._spill = spill
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def capacity(self):
+        return self._records.maxlen
+
+    @property
+    def spill(self):
+        return self._spill
+
+    def on_execution_progress(self, what, job, details):
+        if what == ExecutionJob.FINISHED:
+            self.record(ExecutionRecord.from_job(job))
+
+    def record(self, record):
+        """ Adds a record to the history, evicting the oldest one if the buffer is full.
+
+        :param ExecutionRecord record: the record
+        """
+        with self._lock:
+            evicted = self._records[0] if len(self._records) == self._records.maxlen else None
+            self._records.append(record)
+            if evicted is not None and self._spill is not None:
+                try:
+                    self._spill.write(evicted.as_dict())
+                except (IOError, OSError) as e:
+                    self.log_error('cannot spill execution history : %s', e)
+
+    def query(self, scen_id=None, offset=0, limit=DEFAULT_PAGE_SIZE):
+        """ Returns a page of the history, the most recent executions first.
+
+        The executions spilled to disk are returned after the ones kept in memory.
+
+        :param str scen_id: the id of the scenario, or None for all the scenarios
+        :param int offset: the number of executions to skip
+        :param int limit: the maximum number of executions returned
+        :return: the executions as dictionaries, and a flag telling if there are more
+        :rtype: tuple
+        """
+        wanted = offset + limit + 1
+        found = []
+        with self._lock:
+            for record in reversed(self._records):
+                if scen_id is None or record.scen_id == scen_id:
+                    found.append(record)
+                    if len(found) == wanted:
+                        break
+        page = [r.as_dict() for r in found[offset:offset + limit]]
+
+        # the spill files are read without holding the lock, so that the executions can
+        # still be recorded meanwhile. Records evicted since the snapshot are spilled
+        # again, hence the check of the job ids for not returning them twice.
+        if len(found) < wanted and self._spill is not None:
+            seen = set(r.job_id for r in found)
+            for d in self._spill.iter_records():
+                if (scen_id is not None and d.get('scenario') != scen_id) or d.get('job') in seen:
+                    continue
+                seen.add(d.get('job'))
+                found.append(d)
+                if offset <= len(found) - 1 < offset + limit:
+                    page.append(d)
+                if len(found) == wanted:
+                    break
+        return page, len(found) == wanted
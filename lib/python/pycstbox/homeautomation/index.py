@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Reverse index of the actions of the scenarios.
+
+It tells which scenarios act on a given device or use a given verb, without scanning
+all the actions of all the scenarios.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+class ActionsIndex(object):
+    """ The actions of a set of scenarios, indexed by target and by verb.
+
+    Only the basic actions of the scenarios are indexed, references to other
+    scenarios being ignored.
+    """
+    def __init__(self):
+        # target -> {scenario id: indices of the actions}
+        self._targets = {}
+        # verb -> {scenario id: number of actions}
+        self._verbs = {}
+        # scenario id -> (verb, target) pairs of its actions
+        self._entries = {}
+
+    def __len__(self):
+        """ The number of indexed scenarios.
+        """
+        return len(self._entries)
+
+    def add(self, scen_id, actions):
+        """ Indexes the actions of a scenario, replacing the previous ones if any.
+
+        :param str scen_id: the scenario id
+        :param actions: the (verb, target) pairs of the actions, None for the actions
+        which are not to be indexed
+        :type actions: list of [tuple]
+        """
+        self.remove(scen_id)
+        entries = []
+        for i, action in enumerate(actions):
+            if action is None:
+                continue
+            verb, target = action
+            self._targets.setdefault(target, {}).setdefault(scen_id, []).append(i)
+            by_verb = self._verbs.setdefault(verb, {})
+            by_verb[scen_id] = by_verb.get(scen_id, 0) + 1
+            entries.append(action)
+        if entries:
+            self._entries[scen_id] = entries
+
+    def remove(self, scen_id):
+        for verb, target in self._entries.pop(scen_id, ()):
+            for index, key in ((self._targets, target), (self._verbs, verb)):
+                scenarios = index.get(key)
+                if scenarios is not None:
+                    scenarios.pop(scen_id, None)
+                    if not scenarios:
+                        del index[key]
+
+    def clear(self):
+        self._targets.clear()
+        self._verbs.clear()
+        self._entries.clear()
+
+    def targets(self):
+        """ Returns the targets used by the indexed scenarios.
+        :rtype: list of [str]
+        """
+        return sorted(self._targets)
+
+    def by_target(self, target):
+        """ Returns the scenarios acting on a target.
+
+        :param str target: the target
+        :return: the indices of the actions acting on the target, keyed by scenario id
+        :rtype: dict
+        """
+        return {scen_id: indices[:] for scen_id, indices in self._targets.get(target, {}).iteritems()}
+
+    def by_verb(self, verb):
+        """ Returns the ids of the scenarios using a verb.
+
+        :rtype: list of [str]
+        """
+        return sorted(self._verbs.get(verb, ()))
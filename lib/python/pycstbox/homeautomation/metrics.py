@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Metrics collection, rendered using the Prometheus text exposition format.
+
+Only the metric types needed here are provided (counters, gauges and histograms),
+with support for labels.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import bisect
+import threading
+
+from pycstbox.homeautomation.execution import ExecutionJob
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """ Returns the metric instance for a given set of label values, creating it
+        if needed.
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError('labels mismatch for metric %s' % self.name)
+        try:
+            return self._children[label_values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(label_values, self._new_child())
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.TYPE)
+        ]
+        for label_values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(self.name, _format_labels(self.label_names, label_values), child))
+        return lines
+
+    def _render_child(self, name, labels, child):
+        raise NotImplementedError()
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """ A value which can only increase.
+    """
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, name, labels, child):
+        yield '%s%s %s' % (name, labels, _format_value(child.value))
+
+
+class Gauge(_Metric):
+    """ A value read from a function when the metrics are rendered.
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, func):
+        super(Gauge, self).__init__(name, documentation)
+        self._children[()] = func
+
+    def _render_child(self, name, labels, child):
+        yield '%s%s %s' % (name, labels, _format_value(child()))
+
+
+class CounterFunc(Gauge):
+    """ A counter read from a function when the metrics are rendered, for exposing the
+    counts maintained by other components.
+    """
+    TYPE = 'counter'
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is the one of the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class Histogram(_Metric):
+    """ Counts observations in configurable buckets.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, name, labels, child):
+        cumulated = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulated += count
+            bucket_labels = ('{' if not labels else labels[:-1] + ',') + 'le="%s"}' % _format_value(bound)
+            yield '%s_bucket%s %d' % (name, bucket_labels, cumulated)
+        yield '%s_sum%s %s' % (name, labels, _format_value(child.sum))
+        yield '%s_count%s %d' % (name, labels, cumulated)
+
+
+class MetricsRegistry(object):
+    """ A collection of metrics, rendered together.
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, func):
+        return self.register(Gauge(name, documentation, func))
+
+    def counter_func(self, name, documentation, func):
+        return self.register(CounterFunc(name, documentation, func))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text format.
+        :rtype: unicode
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return u'\n'.join(lines) + u'\n'
+
+
+class HomeAutomationMetrics(object):
+    """ The metrics of the home automation services, and the hooks feeding them.
+    """
+    PREFIX = 'homeautomation_'
+
+    def __init__(self, registry=None):
+        self.registry = registry = registry or MetricsRegistry()
+        p = self.PREFIX
+
+        self.scenario_duration = registry.histogram(
+            p + 'scenario_execution_seconds', 'Duration of scenario executions.', ('scenario',)
+        )
+        self.executions = registry.counter(
+            p + 'scenario_executions_total', 'Scenario executions, by outcome.', ('scenario', 'status')
+        )
+        self.action_duration = registry.histogram(
+            p + 'action_emit_seconds', 'Time taken for action events to be sent, batched or not.', ('verb', 'target')
+        )
+        self.batch_duration = registry.histogram(
+            p + 'batch_emit_seconds', 'Duration of batched action events emissions.'
+        )
+        self.emit_failures = registry.counter(
+            p + 'emit_failures_total', 'Failed action event emissions.', ('verb', 'target')
+        )
+        self.request_duration = registry.histogram(
+            p + 'http_request_seconds', 'Web services requests latency.', ('handler', 'method', 'status')
+        )
+
+    def track_queue_depth(self, executor):
+        """ Exposes the depth of an executor queue.
+        :param ScenarioExecutor executor: the executor
+        """
+        self.registry.gauge(
+            self.PREFIX + 'execution_queue_depth', 'Scenario executions waiting for a worker.',
+            lambda: executor.queue_depth
+        )
+
+    def track_coalescer(self, coalescer):
+        """ Exposes the activity of an events coalescer.
+        :param ActionCoalescer coalescer: the coalescer
+        """
+        p = self.PREFIX + 'coalescer_'
+        registry = self.registry
+        for name, documentation, func, make in (
+            ('sent_events_total', 'Events forwarded by the coalescer.', lambda: coalescer.sent_count,
+             registry.counter_func),
+            ('dropped_events_total', 'Events dropped as repeating the last value.', lambda: coalescer.dropped_count,
+             registry.counter_func),
+            ('coalesced_events_total', 'Events replaced by a later value.', lambda: coalescer.coalesced_count,
+             registry.counter_func),
+            ('held_events', 'Events waiting for the end of their window.', lambda: coalescer.held_count,
+             registry.gauge),
+        ):
+            make(p + name, documentation, func)
+
+    def track_rate_limiter(self, limiter):
+        """ Exposes the queues of an events rate limiter.
+        :param RateLimiter limiter: the rate limiter
+        """
+        p = self.PREFIX + 'rate_limiter_'
+        registry = self.registry
+        for name, documentation, func, make in (
+            ('queue_depth', 'Events waiting for being sent to their target.', lambda: limiter.queue_depth,
+             registry.gauge),
+            ('sent_events_total', 'Events sent by the rate limiter.', lambda: limiter.sent_count,
+             registry.counter_func),
+            ('dropped_events_total', 'Events dropped because the queue of their target was full.',
+             lambda: limiter.dropped_count, registry.counter_func),
+        ):
+            make(p + name, documentation, func)
+
+    def track_state_cache(self, cache):
+        """ Exposes the activity of a device state cache.
+        :param DeviceStateCache cache: the cache
+        """
+        p = self.PREFIX + 'state_cache_'
+        self.registry.gauge(p + 'devices', 'Devices whose state is known.', lambda: len(cache))
+        self.registry.counter_func(
+            p + 'skipped_actions_total', 'Actions skipped since their target was already in state.',
+            lambda: cache.hits_count
+        )
+
+    def trace_emission(self, events, duration, error):
+        """ Emitter tracer (see :py:class:`pycstbox.homeautomation.core.EventEmitter`).
+        """
+        # the events of a batch are all sent when the call returns
+        for verb, target, _ in events:
+            self.action_duration.labels(verb, target).observe(duration)
+        if len(events) > 1:
+            self.batch_duration.observe(duration)
+        if error:
+            for verb, target, _ in events:
+                self.emit_failures.labels(verb, target).inc()
+
+    def on_execution_progress(self, what, job, details):
+        """ Executor listener (see :py:class:`pycstbox.homeautomation.execution.ScenarioExecutor`).
+        """
+        if what == ExecutionJob.FINISHED:
+            self.scenario_duration.labels(job.scen_id).observe(job.duration)
+            self.executions.labels(job.scen_id, job.status).inc()
+
+    def observe_request(self, handler, method, status, duration):
+        self.request_duration.labels(handler, method, str(status)).observe(duration)
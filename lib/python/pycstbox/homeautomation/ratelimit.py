@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Rate limiting of the control events, for not overrunning slow field buses.
+
+Events are queued per target, and released according to token buckets limiting the
+rate of the events sent to each target, and optionally the overall rate of the events
+of given verbs.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import threading
+import time
+from collections import deque
+
+from pycstbox.log import Loggable
+
+
+class TokenBucket(object):
+    """ A token bucket, refilled at a given rate up to a given capacity.
+    """
+    __slots__ = ('rate', 'burst', '_tokens', '_time')
+
+    def __init__(self, rate, burst, now):
+        """
+        :param float rate: the tokens per second
+        :param int burst: the capacity of the bucket
+        :param float now: the current time
+        """
+        if rate <= 0:
+            raise ValueError("invalid rate : %s" % rate)
+        self.rate = float(rate)
+        self.burst = max(1., float(burst))
+        self._tokens = self.burst
+        self._time = now
+
+    def _refill(self, now):
+        if now > self._time:
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+
+    def delay(self, now):
+        """ Returns the time to wait before a token is available.
+        """
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class RateLimiter(Loggable):
+    """ Smooths the control events sent to the devices.
+
+    It is used in place of the event manager, and forwards the events to an emitter
+    wrapping the real one, from a dispatcher thread.
+
+    Each target has its own token bucket and its own queue, so that the order of the
+    events sent to a device is preserved, while the events sent to different devices
+    do not wait for each other. Verbs can also be given a bucket, which limits the
+    overall rate of the events using them.
+
+    Queues are bounded : when the queue of a target is full, its oldest event is dropped.
+    In addition, callers are blocked while the total number of queued events exceeds a
+    given limit, which slows down the executions instead of accumulating events.
+    """
+    DEFAULT_TARGET_RATE = 5.
+    DEFAULT_TARGET_BURST = 10
+    DEFAULT_MAX_QUEUE = 100
+    DEFAULT_MAX_PENDING = 1000
+
+    def __init__(self, emitter, target_rate=DEFAULT_TARGET_RATE, target_burst=DEFAULT_TARGET_BURST,
+                 verb_rates=None, max_queue=DEFAULT_MAX_QUEUE, max_pending=DEFAULT_MAX_PENDING,
+                 clock=time.time):
+        """
+        :param EventEmitter emitter: the emitter used for sending the events
+        :param float target_rate: the maximum rate of the events sent to a target, in events per second
+        :param int target_burst: the number of events which can be sent to a target at once
+        :param dict verb_rates: the (rate, burst) pairs limiting the events of given verbs, keyed by verb
+        :param int max_queue: the maximum number of events queued for a target
+        :param int max_pending: the number of queued events above which callers are blocked
+        :param callable clock: returns the current time
+        """
+        if target_rate <= 0:
+            raise ValueError("invalid rate : %s" % target_rate)
+        if max_queue < 1 or max_pending < 1:
+            raise ValueError("invalid queue size")
+        super(RateLimiter, self).__init__()
+
+        self._emitter = emitter
+        self._target_rate = target_rate
+        self._target_burst = target_burst
+        self._max_queue = max_queue
+        self._max_pending = max_pending
+        self._clock = clock
+
+        now = clock()
+        self._verb_buckets = {
+            verb: TokenBucket(rate, burst, now) for verb, (rate, burst) in (verb_rates or {}).iteritems()
+        }
+        self._target_buckets = {}
+        # non empty queues only, keyed by target
+        self._queues = {}
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.failures_count = 0
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='rate-limiter')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    @property
+    def queue_depth(self):
+        """ The total number of queued events.
+        """
+        return self._depth
+
+    def queue_depths(self):
+        """ Returns the number of queued events of each target having some.
+        :rtype: dict
+        """
+        with self._cond:
+            return {target: len(queue) for target, queue in self._queues.iteritems()}
+
+    def emitEvent(self, var_type, var_name, data):
+        self.emitEvents([(var_type, var_name, data)])
+
+    def emitEvents(self, events):
+        """ Queues a sequence of events, blocking while too many events are queued.
+        """
+        with self._cond:
+            for event in events:
+                while self._depth >= self._max_pending and not self._closed:
+                    self._cond.notify_all()
+                    self._cond.wait()
+                if self._closed:
+                    raise RuntimeError('rate limiter is closed')
+                target = event[1]
+                queue = self._queues.get(target)
+                if queue is None:
+                    queue = self._queues[target] = deque()
+                elif len(queue) >= self._max_queue:
+                    dropped = queue.popleft()
+                    self._depth -= 1
+                    self.dropped_count += 1
+                    self.log_error('queue of %s is full, dropping event %s', target, dropped)
+                queue.append(event)
+                self._depth += 1
+            self._cond.notify_all()
+
+    def close(self, drain=True, timeout=None):
+        """ Stops the dispatcher.
+
+        :param bool drain: if True, the queued events are sent before stopping,
+        otherwise they are dropped
+        :param float timeout: the maximum time to wait for the dispatcher to stop
+        """
+        with self._cond:
+            self._closed = True
+            if not drain:
+                self.dropped_count += self._depth
+                self._queues.clear()
+                self._depth = 0
+            self._cond.notify_all()
+        self._dispatcher.join(timeout)
+
+    def _target_bucket(self, target, now):
+        bucket = self._target_buckets.get(target)
+        if bucket is None:
+            bucket = self._target_buckets[target] = TokenBucket(self._target_rate, self._target_burst, now)
+        return bucket
+
+    def _pop_ready(self, now):
+        """ Dequeues the events which can be sent now.
+
+        :return: the events, and the delay before the next one can be sent (None if
+        there is no more queued event)
+        """
+        ready = []
+        wait = None
+        for target, queue in self._queues.items():
+            target_bucket = self._target_bucket(target, now)
+            while queue:
+                verb_bucket = self._verb_buckets.get(queue[0][0])
+                delay = target_bucket.delay(now)
+                if verb_bucket:
+                    delay = max(delay, verb_bucket.delay(now))
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                target_bucket.consume(now)
+                if verb_bucket:
+                    verb_bucket.consume(now)
+                ready.append(queue.popleft())
+                self._depth -= 1
+            if not queue:
+                del self._queues[target]
+        return ready, wait
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._depth:
+                        return
+                    ready, wait = self._pop_ready(self._clock())
+                    if ready:
+                        break
+                    self._cond.wait(wait)
+                # queues have room again
+                self._cond.notify_all()
+            try:
+                self._emitter.emit(ready)
+                self.sent_count += len(ready)
+            except Exception as e:
+                self.failures_count += 1
+                self.log_error('failed to send rate limited events : %s', e)
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Time triggered execution of scenarios.
+
+Scenarios can be given a schedule, made of rules stored with their definition :
+
+    "schedule": [
+        {"cron": "30 7 * * 1-5"},
+        {"sun": "sunset", "offset": -15}
+    ]
+
+Cron rules use the usual 5 fields (minute, hour, day of month, month, day of week),
+in local time. Sun rules trigger at sunrise or sunset, shifted by an optional offset
+expressed in minutes, and require the location of the box to be known.
+
+All the rules are served by a single timer, armed for the earliest next occurrence.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import bisect
+import calendar
+import datetime
+import heapq
+import itertools
+import math
+import time
+
+from pycstbox.log import Loggable
+
+KEY_CRON = 'cron'
+KEY_SUN = 'sun'
+KEY_OFFSET = 'offset'
+
+SUNRISE = 'sunrise'
+SUNSET = 'sunset'
+
+
+def parse_rule(d):
+    """ Creates a rule from its settings.
+
+    :param dict d: the settings
+    :return: the rule
+    :rtype: CronRule or SunRule
+    :raise: ValueError if the settings are not valid
+    """
+    if not isinstance(d, dict):
+        raise ValueError('invalid schedule rule : %s' % d)
+    if KEY_CRON in d:
+        return CronRule(d[KEY_CRON])
+    if KEY_SUN in d:
+        return SunRule(d[KEY_SUN], d.get(KEY_OFFSET, 0))
+    raise ValueError('invalid schedule rule : %s' % d)
+
+
+def _parse_field(field, lo, hi):
+    values = set()
+    for part in field.split(','):
+        step = None
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError('invalid step : %d' % step)
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = hi if step else start
+        if start < lo or end > hi or start > end:
+            raise ValueError('out of range : %s' % part)
+        values.update(xrange(start, end + 1, step or 1))
+    return tuple(sorted(values))
+
+
+class CronRule(object):
+    """ A rule defined by a cron expression (minute, hour, day of month, month, day of week).
+
+    Fields accept '*', values, ranges, lists and steps. As for cron, when both the day
+    of month and the day of week are restricted, a day matching either of them matches.
+    """
+    # in the day of week field, both 0 and 7 stand for sunday
+    FIELDS_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    # past this horizon, the rule is considered as never matching (e.g. february 30th)
+    HORIZON_DAYS = 366 * 5
+
+    def __init__(self, expr):
+        """
+        :param str expr: the cron expression
+        :raise: ValueError if not valid
+        """
+        fields = str(expr).split()
+        if len(fields) != 5:
+            raise ValueError('invalid cron expression : %s' % expr)
+        try:
+            self.minutes, self.hours, self.days, self.months, dow = (
+                _parse_field(field, lo, hi) for field, (lo, hi) in zip(fields, self.FIELDS_RANGES)
+            )
+        except ValueError as e:
+            raise ValueError('invalid cron expression : %s (%s)' % (expr, e))
+        self.weekdays = frozenset(d % 7 for d in dow)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        self.expr = expr
+
+    def _day_matches(self, dt):
+        # datetime weekdays start on monday
+        weekday = (dt.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            return dt.day in self.days and weekday in self.weekdays
+        return dt.day in self.days or weekday in self.weekdays
+
+    def next_after(self, timestamp, location=None):
+        """ Returns the time of the first occurrence strictly after a given time.
+
+        :param float timestamp: the reference time
+        :param location: not used
+        :return: the time of the occurrence, None if the rule never matches
+        :rtype: float
+        """
+        dt = datetime.datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0)
+        dt += datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=self.HORIZON_DAYS)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = dt.replace(year=dt.year + dt.month // 12, month=dt.month % 12 + 1, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            i = bisect.bisect_left(self.hours, dt.hour)
+            if i == len(self.hours):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if self.hours[i] != dt.hour:
+                dt = dt.replace(hour=self.hours[i], minute=0)
+            i = bisect.bisect_left(self.minutes, dt.minute)
+            if i == len(self.minutes):
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            dt = dt.replace(minute=self.minutes[i])
+            return time.mktime(dt.timetuple())
+        return None
+
+    def as_dict(self):
+        return {KEY_CRON: self.expr}
+
+
+def sun_event(date, latitude, longitude, rising):
+    """ Returns the time of sunrise or sunset for a given day and location.
+
+    The computation uses the algorithm of the Almanac for Computers (1990), which is
+    accurate to a couple of minutes.
+
+    :param datetime.date date: the day
+    :param float latitude: the latitude in degrees (positive North)
+    :param float longitude: the longitude in degrees (positive East)
+    :param bool rising: True for the sunrise, False for the sunset
+    :return: the time of the event, None if the sun does not rise or set that day
+    :rtype: float
+    """
+    rad, deg = math.radians, math.degrees
+    zenith = 90.833
+
+    day_of_year = date.timetuple().tm_yday
+    lng_hour = longitude / 15.
+    t = day_of_year + ((6 if rising else 18) - lng_hour) / 24.
+
+    mean_anomaly = 0.9856 * t - 3.289
+    true_lng = (mean_anomaly + 1.916 * math.sin(rad(mean_anomaly)) +
+                0.020 * math.sin(rad(2 * mean_anomaly)) + 282.634) % 360
+
+    right_asc = deg(math.atan(0.91764 * math.tan(rad(true_lng)))) % 360
+    right_asc += math.floor(true_lng / 90) * 90 - math.floor(right_asc / 90) * 90
+    right_asc /= 15.
+
+    sin_dec = 0.39782 * math.sin(rad(true_lng))
+    cos_dec = math.cos(math.asin(sin_dec))
+    cos_h = (math.cos(rad(zenith)) - sin_dec * math.sin(rad(latitude))) / (cos_dec * math.cos(rad(latitude)))
+    if not -1 <= cos_h <= 1:
+        return None
+
+    h = deg(math.acos(cos_h))
+    if rising:
+        h = 360 - h
+    local_mean_time = h / 15. + right_asc - 0.06571 * t - 6.622
+    utc_hours = (local_mean_time - lng_hour) % 24
+    return calendar.timegm(date.timetuple()) + utc_hours * 3600
+
+
+class SunRule(object):
+    """ A rule triggering at sunrise or sunset, shifted by an offset.
+    """
+    def __init__(self, event, offset=0):
+        """
+        :param str event: SUNRISE or SUNSET
+        :param int offset: the offset in minutes, negative for triggering before the event
+        :raise: ValueError if not valid
+        """
+        if event not in (SUNRISE, SUNSET):
+            raise ValueError('invalid sun event : %s' % event)
+        self.event = event
+        try:
+            self.offset = int(offset)
+        except (TypeError, ValueError):
+            raise ValueError('invalid offset : %s' % offset)
+
+    def next_after(self, timestamp, location=None):
+        """ Returns the time of the first occurrence strictly after a given time.
+
+        :param float timestamp: the reference time
+        :param tuple location: the (latitude, longitude) pair of the box, in degrees
+        :return: the time of the occurrence, None if it cannot be determined
+        :rtype: float
+        """
+        if location is None:
+            return None
+        latitude, longitude = location
+        # the offset can move the occurrence to the previous or the next day
+        day = datetime.datetime.utcfromtimestamp(timestamp).date() - datetime.timedelta(days=1)
+        # polar nights and days can last for months
+        for _ in xrange(367):
+            event_time = sun_event(day, latitude, longitude, self.event == SUNRISE)
+            if event_time is not None:
+                event_time += self.offset * 60
+                if event_time > timestamp:
+                    return event_time
+            day += datetime.timedelta(days=1)
+        return None
+
+    def as_dict(self):
+        d = {KEY_SUN: self.event}
+        if self.offset:
+            d[KEY_OFFSET] = self.offset
+        return d
+
+
+class Scheduler(Loggable):
+    """ Triggers the execution of scenarios according to their schedule.
+
+    Next occurrences of all the rules are kept in a heap, and a single IOLoop timeout
+    is armed for the earliest one. The scheduler listens to the modifications of the
+    scenarios directory, and updates the occurrences of the modified scenarios.
+
+    Except for the notifications of the directory, the methods must be called from
+    the IOLoop thread.
+    """
+    # the heap is purged of obsolete occurrences when they outnumber the valid ones
+    PURGE_MIN_SIZE = 64
+
+    def __init__(self, scenarios_mgr, trigger, ioloop=None, location=None, clock=time.time):
+        """
+        :param ScenariosManager scenarios_mgr: the scenarios directory
+        :param callable trigger: called with the scenario id when a scenario must be executed
+        :param ioloop: the IOLoop the timer is armed on (default: the global instance)
+        :param tuple location: the (latitude, longitude) pair used by sun rules
+        :param callable clock: returns the current time
+        """
+        super(Scheduler, self).__init__()
+        if ioloop is None:
+            from tornado.ioloop import IOLoop
+            ioloop = IOLoop.instance()
+
+        self._scenarios_mgr = scenarios_mgr
+        self._trigger = trigger
+        self._ioloop = ioloop
+        self._location = location
+        self._clock = clock
+
+        # entries are (time, sequence, scenario id, generation, rule)
+        self._heap = []
+        self._sequence = itertools.count()
+        # the generation of a scenario changes each time it is rescheduled, which
+        # invalidates its previous entries
+        self._generations = {}
+        self._live_count = {}
+        self._timeout = None
+        self._deadline = None
+        self._started = False
+
+    @property
+    def timers_count(self):
+        """ The number of rules being waited for.
+        """
+        return sum(self._live_count.itervalues())
+
+    def next_run(self, scen_id):
+        """ Returns the time of the next scheduled execution of a scenario, None if none.
+        """
+        generation = self._generations.get(scen_id)
+        times = [e[0] for e in self._heap if e[2] == scen_id and e[3] == generation]
+        return min(times) if times else None
+
+    def start(self):
+        self._scenarios_mgr.add_listener(self.on_scenario_change)
+        self._started = True
+        self._schedule_all()
+
+    def stop(self):
+        if self._started:
+            self._scenarios_mgr.remove_listener(self.on_scenario_change)
+            self._started = False
+        self._cancel_timeout()
+        self._heap = []
+        self._generations.clear()
+        self._live_count.clear()
+
+    def on_scenario_change(self, what, id_):
+        """ Scenarios directory listener, which can be called from any thread.
+        """
+        self._ioloop.add_callback(self._update, id_)
+
+    def _update(self, id_):
+        if not self._started:
+            return
+        if id_ is None:
+            self._schedule_all()
+            return
+        try:
+            rules = self._scenarios_mgr.get_scenario(id_).schedule
+        except KeyError:
+            rules = None
+        self._schedule_rules(id_, rules, self._clock())
+        self._purge()
+        self._arm()
+
+    def _schedule_all(self):
+        self._heap = []
+        self._generations.clear()
+        self._live_count.clear()
+        now = self._clock()
+        for id_, rules in self._scenarios_mgr.iter_schedules():
+            self._schedule_rules(id_, rules, now, push=self._heap.append)
+        heapq.heapify(self._heap)
+        self.log_info('%d schedule rule(s) registered', self.timers_count)
+        self._arm()
+
+    def _schedule_rules(self, id_, rules, now, push=None):
+        generation = self._generations[id_] = self._generations.get(id_, 0) + 1
+        self._live_count.pop(id_, None)
+        if not rules:
+            return
+        push = push or (lambda entry: heapq.heappush(self._heap, entry))
+        count = 0
+        for rule in rules:
+            when = rule.next_after(now, self._location)
+            if when is None:
+                self.log_error('rule %s of scenario %s never triggers', rule.as_dict(), id_)
+                continue
+            push((when, next(self._sequence), id_, generation, rule))
+            count += 1
+        if count:
+            self._live_count[id_] = count
+
+    def _purge(self):
+        live = self.timers_count
+        if len(self._heap) > max(2 * live, self.PURGE_MIN_SIZE):
+            self._heap = [e for e in self._heap if self._generations.get(e[2]) == e[3]]
+            heapq.heapify(self._heap)
+
+    def _arm(self):
+        heap = self._heap
+        # don't wake up for obsolete occurrences
+        while heap and self._generations.get(heap[0][2]) != heap[0][3]:
+            heapq.heappop(heap)
+        when = heap[0][0] if heap else None
+        if when == self._deadline:
+            return
+        self._cancel_timeout()
+        if when is not None:
+            self._timeout = self._ioloop.add_timeout(when, self._on_timeout)
+            self._deadline = when
+
+    def _cancel_timeout(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+        self._timeout = self._deadline = None
+
+    def _on_timeout(self):
+        self._timeout = self._deadline = None
+        now = self._clock()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            when, _, id_, generation, rule = heapq.heappop(heap)
+            if self._generations.get(id_) != generation:
+                continue
+            self.log_info('scheduled execution of scenario %s', id_)
+            try:
+                self._trigger(id_)
+            except Exception as e:
+                self.log_exception(e)
+            # occurrences missed while the box was not running are not replayed
+            when = rule.next_after(max(when, now), self._location)
+            if when is not None:
+                heapq.heappush(heap, (when, next(self._sequence), id_, generation, rule))
+            else:
+                self._live_count[id_] -= 1
+        self._arm()
@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Persistent storage of scenario definitions.
+
+Definitions are stored in a JSON file, which is always replaced atomically (write to
+a temporary file, sync and rename) so that a power loss cannot leave it half written.
+
+Individual changes are appended to a journal file stored next to it, which avoids
+rewriting the whole file for each edit. The journal is replayed on top of the file
+when loading, and compacted into it once it has grown past a given number of records.
+
+Large files can be indexed instead of being parsed as a whole : the position of each
+definition in the file is recorded, and definitions are decoded on demand.
+
+The compiled form of the definitions can be cached in a marshal file stored next to
+the JSON one, which is much faster to load than parsing and validating the JSON data.
+
+Definitions can also be stored in a SQLite database, one row per scenario, so that
+reading or modifying a scenario does not depend on the size of the whole set. The
+backend is selected according to the extension of the storage path (see :py:func:`open_store`).
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import json
+import json.scanner
+import marshal
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from pycstbox.log import Loggable
+
+
+def atomic_write(path, data):
+    """ Replaces the content of a file in an atomic way.
+
+    The data are written to a temporary file in the same directory, which is synced
+    to disk and then renamed to the target path.
+
+    :param str path: the file path
+    :param str data: the new content of the file
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _sync_dir(dir_path)
+
+
+def _sync_dir(dir_path):
+    """ Syncs a directory so that renames and creations in it are persisted.
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def file_signature(path):
+    """ Returns the (mtime, size) pair of a file, or None if it cannot be accessed.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+_WHITESPACES = re.compile(r'[ \t\n\r]*')
+_scan_value = json.scanner.make_scanner(json.JSONDecoder())
+
+
+INDEX_CHUNK_SIZE = 1024 * 1024
+
+
+class _UnexpectedCharacter(ValueError):
+    pass
+
+
+def index_json_object(data, chunk_size=INDEX_CHUNK_SIZE):
+    """ Locates the members of the top level object of a JSON document.
+
+    Member values are skipped using the scanner of the json module, and are not kept.
+    The document is scanned by chunks, so that a memory mapped one is never copied as
+    a whole. A chunk is extended when a member does not fit in it.
+
+    :param data: the document, as a string or a memory map
+    :param int chunk_size: the size of the chunks
+    :return: a list of (key, start, end) tuples, start and end being the offsets
+    of the member value in the document
+    :raise: ValueError if the document is not a JSON object
+    """
+    members = []
+    skip = _WHITESPACES.match
+    size = len(data)
+    base, window = 0, chunk_size
+    started = False
+    while True:
+        chunk = data[base:base + window]
+        # position in the chunk up to which the document has been indexed
+        resume = 0
+        try:
+            if not started:
+                i = skip(chunk, 0).end()
+                if chunk[i] != '{':
+                    raise _UnexpectedCharacter('document is not a JSON object')
+                i = skip(chunk, i + 1).end()
+                if chunk[i] == '}':
+                    return members
+                started = True
+                resume = i
+            while True:
+                i = resume
+                if chunk[i] != '"':
+                    raise _UnexpectedCharacter('member name expected at offset %d' % (base + i))
+                key, i = json.decoder.scanstring(chunk, i + 1)
+                i = skip(chunk, i).end()
+                if chunk[i] != ':':
+                    raise _UnexpectedCharacter("':' expected at offset %d" % (base + i))
+                start = skip(chunk, i + 1).end()
+                _, end = _scan_value(chunk, start)
+
+                # the member is complete only if followed by a separator in the chunk
+                i = skip(chunk, end).end()
+                if chunk[i] == '}':
+                    members.append((key, base + start, base + end))
+                    return members
+                if chunk[i] != ',':
+                    raise _UnexpectedCharacter("',' expected at offset %d" % (base + i))
+                members.append((key, base + start, base + end))
+                resume = skip(chunk, i + 1).end()
+        except _UnexpectedCharacter:
+            raise
+        except (IndexError, StopIteration, ValueError):
+            if base + window >= size:
+                raise ValueError('invalid or truncated JSON document')
+            if resume:
+                base += resume
+            else:
+                window *= 2
+
+
+class IndexedDocument(object):
+    """ A JSON document mapped in memory, the members of its top level object being
+    decoded on demand.
+    """
+    def __init__(self, path):
+        """
+        :param str path: the path of the document
+        :raise: ValueError if the document is not a JSON object
+        """
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size:
+                self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._data = ''
+        self._index = {key: (start, end) for key, start, end in index_json_object(self._data)}
+
+    def keys(self):
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        """ Decodes a member of the document.
+
+        :param key: the key of the member
+        :return: the decoded value
+        :raise: KeyError if not found
+        """
+        start, end = self._index[key]
+        return json.loads(self._data[start:end])
+
+    def iteritems(self):
+        for key in self._index:
+            yield key, self.get(key)
+
+
+def open_store(path):
+    """ Returns the store suited to a storage path, according to its extension.
+
+    :param str path: the storage path
+    :rtype: ScenarioStore
+    """
+    if os.path.splitext(path)[1].lower() in SQLiteStore.SUFFIXES:
+        return SQLiteStore(path)
+    return JSONFileStore(path)
+
+
+def migrate_store(source, target):
+    """ Replaces the content of a store by the definitions of another one, for instance
+    for migrating a JSON file to a SQLite database, or for exporting a database as JSON.
+
+    :param ScenarioStore source: the store the definitions are read from
+    :param ScenarioStore target: the store the definitions are written to
+    :return: the number of copied definitions
+    :rtype: int
+    """
+    data = source.load()
+    target.write_all(data)
+    return len(data)
+
+
+class ScenarioStore(Loggable):
+    """ Interface of the storage backends of scenario definitions.
+
+    Definitions are handled as dictionaries, keyed by scenario id.
+    """
+    @property
+    def path(self):
+        raise NotImplementedError()
+
+    def signature(self):
+        """ Returns the signature of the stored data, which changes each time they are modified.
+        """
+        raise NotImplementedError()
+
+    def load(self):
+        """ Loads the definitions.
+
+        :return: the definitions, keyed by scenario id
+        :rtype: dict
+        :raise: ValueError if the storage does not exist
+        """
+        return dict(self.iter_items())
+
+    def iter_items(self):
+        """ Loads the definitions one at a time.
+
+        :return: a generator of (scenario id, definition) pairs
+        :raise: ValueError if the storage does not exist
+        """
+        raise NotImplementedError()
+
+    def load_indexed(self):
+        """ Returns an object giving access to the definitions by id, decoding them on demand.
+
+        :return: the indexed document (see :py:class:`IndexedDocument` for the expected
+        interface), and the definitions which override the ones of the document
+        :rtype: tuple
+        :raise: ValueError if the storage does not exist
+        """
+        raise NotImplementedError()
+
+    def count_journal(self):
+        """ Returns the number of changes recorded in the journal, if the backend uses one.
+
+        It is used when the definitions are not read from the store, so that the journal
+        is compacted in due time.
+        """
+        return 0
+
+    def write_all(self, data):
+        """ Replaces the stored definitions.
+
+        :param dict data: the definitions, keyed by scenario id
+        """
+        raise NotImplementedError()
+
+    def write_changes(self, changes, get_all):
+        """ Records changes.
+
+        :param dict changes: the new definitions of the modified scenarios, keyed by
+        scenario id, None meaning that the scenario has been removed
+        :param callable get_all: returns the full set of definitions, for backends
+        which need to rewrite them
+        """
+        raise NotImplementedError()
+
+
+class JSONFileStore(ScenarioStore):
+    """ Stores scenario definitions (as dictionaries) in a JSON file and its journal.
+    """
+    JOURNAL_SUFFIX = '.journal'
+    DEFAULT_COMPACT_THRESHOLD = 100
+
+    # files larger than this are parsed one definition at a time
+    STREAMING_THRESHOLD = 4 * 1024 * 1024
+
+    KEY_ID = 'id'
+    KEY_SETTINGS = 'settings'
+
+    def __init__(self, path, compact_threshold=DEFAULT_COMPACT_THRESHOLD):
+        """
+        :param str path: the path of the JSON file
+        :param int compact_threshold: the number of journal records triggering a compaction
+        """
+        if not path:
+            raise ValueError("parameter 'path' is mandatory")
+        super(JSONFileStore, self).__init__()
+
+        self._path = path
+        self._journal_path = path + self.JOURNAL_SUFFIX
+        self._compact_threshold = compact_threshold
+        self._journal_records = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def journal_path(self):
+        return self._journal_path
+
+    def signature(self):
+        """ Returns the signature of the stored data, which changes each time they are modified.
+        """
+        return file_signature(self._path), file_signature(self._journal_path)
+
+    def iter_items(self):
+        """ Loads the definitions one at a time, applying the changes recorded in the journal.
+
+        Large files are decoded one definition at a time, so that the whole document
+        is never held in memory in its decoded form.
+
+        :return: a generator of (scenario id, definition) pairs
+        :raise: ValueError if file not found
+        """
+        self._check_path()
+        changes = self.read_journal()
+
+        if os.path.getsize(self._path) > self.STREAMING_THRESHOLD:
+            items = IndexedDocument(self._path).iteritems()
+        else:
+            with open(self._path, 'rt') as fp:
+                items = json.load(fp).iteritems()
+
+        for scen_id, settings in items:
+            if scen_id not in changes:
+                yield scen_id, settings
+        for scen_id, settings in changes.iteritems():
+            if settings is not None:
+                yield scen_id, settings
+
+    def load_indexed(self):
+        """ Indexes the definitions without decoding them.
+
+        :return: the indexed document, and the changes recorded in the journal (see
+        :py:meth:`read_journal`)
+        :rtype: tuple
+        :raise: ValueError if file not found
+        """
+        self._check_path()
+        return IndexedDocument(self._path), self.read_journal()
+
+    def _check_path(self):
+        if not os.path.isfile(self._path):
+            raise ValueError("path '%s' not found or is not a file" % self._path)
+
+    def read_journal(self):
+        """ Returns the changes recorded in the journal.
+
+        A journal damaged by a power loss (record partially written, to which the next
+        ones may have been appended) is repaired by rewriting it without the records
+        which can't be decoded, so that the following changes are not appended to them.
+
+        :return: the definitions of the modified scenarios, None for removed ones
+        :rtype: OrderedDict
+        """
+        changes = OrderedDict()
+        lines = []
+        damaged = False
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, 'rt') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # can only be a record partially written when the power was lost
+                        self.log_error('ignoring truncated journal record : %s', line)
+                        damaged = True
+                        continue
+                    if not line.endswith('\n'):
+                        damaged = True
+                        line += '\n'
+                    changes[record[self.KEY_ID]] = record[self.KEY_SETTINGS]
+                    lines.append(line)
+        if damaged:
+            self.log_warning('repairing journal %s (%d valid records kept)', self._journal_path, len(lines))
+            atomic_write(self._journal_path, ''.join(lines))
+        self._journal_records = len(lines)
+        return changes
+
+    def count_journal(self):
+        """ Returns the number of changes recorded in the journal, without decoding them
+        unless it must be repaired (see :py:meth:`read_journal`).
+        """
+        count = 0
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, 'rt') as fp:
+                for line in fp:
+                    if not line.endswith('\n'):
+                        # the last record has been partially written
+                        self.read_journal()
+                        return self._journal_records
+                    count += 1
+        self._journal_records = count
+        return count
+
+    def write_all(self, data):
+        """ Replaces the stored definitions, and discards the journal.
+
+        :param dict data: the definitions, keyed by scenario id
+        """
+        atomic_write(self._path, json.dumps(data, indent=4))
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        self._journal_records = 0
+
+    def write_changes(self, changes, get_all):
+        """ Records changes in the journal, compacting it if it has grown too much.
+
+        :param dict changes: the new definitions of the modified scenarios, keyed by
+        scenario id, None meaning that the scenario has been removed
+        :param callable get_all: returns the full set of definitions, used for compaction
+        """
+        if not changes:
+            return
+
+        if self._journal_records + len(changes) >= self._compact_threshold:
+            self.log_info('compacting journal')
+            self.write_all(get_all())
+            return
+
+        with open(self._journal_path, 'at') as fp:
+            for scen_id, settings in changes.iteritems():
+                fp.write(json.dumps({self.KEY_ID: scen_id, self.KEY_SETTINGS: settings}) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        if not self._journal_records:
+            _sync_dir(os.path.dirname(os.path.abspath(self._journal_path)))
+        self._journal_records += len(changes)
+
+
+class SQLiteStore(ScenarioStore):
+    """ Stores scenario definitions in a SQLite database, one row per scenario.
+
+    Definitions are looked up by their primary key, and modifications are done in
+    transactions which also increment a revision number, used as the store signature.
+    """
+    SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS scenarios (id TEXT PRIMARY KEY, settings TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0)",
+    )
+
+    def __init__(self, path):
+        """
+        :param str path: the path of the database
+        """
+        if not path:
+            raise ValueError("parameter 'path' is mandatory")
+        super(SQLiteStore, self).__init__()
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def connect(self, create=False):
+        """ Opens a connection to the database.
+
+        Connections are not shared, so that the store can be used from any thread.
+
+        :param bool create: if True, the database is created if it does not exist yet
+        :raise: ValueError if the database does not exist and must not be created
+        """
+        if not create and not os.path.isfile(self._path):
+            raise ValueError("path '%s' not found or is not a file" % self._path)
+        conn = sqlite3.connect(self._path, check_same_thread=False)
+        if create:
+            with conn:
+                for statement in self._SCHEMA:
+                    conn.execute(statement)
+        return conn
+
+    def signature(self):
+        if not os.path.isfile(self._path):
+            return None, None
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            conn.close()
+        return file_signature(self._path), row[0] if row else None
+
+    def iter_items(self):
+        conn = self.connect()
+        try:
+            for scen_id, settings in conn.execute("SELECT id, settings FROM scenarios"):
+                yield scen_id, json.loads(settings)
+        finally:
+            conn.close()
+
+    def load_indexed(self):
+        return SQLiteDocument(self.connect()), {}
+
+    def get(self, scen_id):
+        """ Returns the definition of a scenario.
+
+        :raise: KeyError if not found
+        """
+        conn = self.connect()
+        try:
+            return SQLiteDocument.fetch(conn, scen_id)
+        finally:
+            conn.close()
+
+    def write_all(self, data):
+        conn = self.connect(create=True)
+        try:
+            with conn:
+                conn.execute("DELETE FROM scenarios")
+                conn.executemany(
+                    "INSERT INTO scenarios (id, settings) VALUES (?, ?)",
+                    ((scen_id, json.dumps(settings)) for scen_id, settings in data.iteritems())
+                )
+                self._bump_revision(conn)
+        finally:
+            conn.close()
+
+    def write_changes(self, changes, get_all):
+        if not changes:
+            return
+        conn = self.connect(create=True)
+        try:
+            with conn:
+                conn.executemany(
+                    "DELETE FROM scenarios WHERE id = ?",
+                    ((scen_id,) for scen_id, settings in changes.iteritems() if settings is None)
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO scenarios (id, settings) VALUES (?, ?)",
+                    ((scen_id, json.dumps(settings)) for scen_id, settings in changes.iteritems()
+                     if settings is not None)
+                )
+                self._bump_revision(conn)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _bump_revision(conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+
+    def import_json(self, json_path):
+        """ Replaces the content of the database by the definitions of a JSON file (and of its journal).
+
+        :return: the number of imported definitions
+        """
+        return migrate_store(JSONFileStore(json_path), self)
+
+    def export_json(self, json_path):
+        """ Writes the definitions to a JSON file, in the format used by :py:class:`JSONFileStore`.
+
+        :return: the number of exported definitions
+        """
+        return migrate_store(self, JSONFileStore(json_path))
+
+
+class SQLiteDocument(object):
+    """ Gives access to the definitions of a SQLite database by id, with the same interface
+    as :py:class:`IndexedDocument`.
+    """
+    def __init__(self, conn):
+        """
+        :param conn: the connection to the database, owned by the document
+        """
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._ids = set(row[0] for row in conn.execute("SELECT id FROM scenarios"))
+
+    @staticmethod
+    def fetch(conn, key):
+        row = conn.execute("SELECT settings FROM scenarios WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def keys(self):
+        return list(self._ids)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, key):
+        """ Decodes a definition.
+
+        :raise: KeyError if not found
+        """
+        with self._lock:
+            return self.fetch(self._conn, key)
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self.get(key)
+
+
+class CompiledCache(Loggable):
+    """ Stores data built from the definitions in a marshal file, together with the
+    signature of the storage files they have been built from.
+
+    The cached data are returned only if the signature still matches, i.e. if neither
+    the storage file nor its journal have been modified since they have been cached.
+    Since the marshal format depends on the Python version, the cache is also ignored
+    if it has been written by another one.
+    """
+    SUFFIX = '.cache'
+    FORMAT_VERSION = 4
+    MARSHAL_VERSION = 2
+
+    def __init__(self, store_path):
+        """
+        :param str store_path: the path of the JSON storage file
+        """
+        super(CompiledCache, self).__init__()
+        self._path = store_path + self.SUFFIX
+
+    @property
+    def path(self):
+        return self._path
+
+    def _header(self, signature):
+        return self.FORMAT_VERSION, sys.version_info[:2], signature
+
+    def load(self, signature):
+        """ Returns the cached data, if they have been built for the given signature.
+
+        :param signature: the current signature of the storage files
+        :return: the cached data, or None if there is no matching cache
+        """
+        try:
+            with open(self._path, 'rb') as fp:
+                header, data = marshal.load(fp)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if header != self._header(signature):
+            return None
+        return data
+
+    def save(self, signature, data):
+        """ Caches data, failures being only logged.
+
+        :param signature: the signature of the storage files the data have been built from
+        :param data: the data, made of built-in types only
+        """
+        try:
+            atomic_write(self._path, marshal.dumps((self._header(signature), data), self.MARSHAL_VERSION))
+        except (IOError, OSError, ValueError) as e:
+            self.log_error('cannot write cache %s : %s', self._path, e)
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
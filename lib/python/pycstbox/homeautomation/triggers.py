@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of CSTBox.
+#
+# CSTBox is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CSTBox is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with CSTBox.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Execution of scenarios in reaction to the events of the CSTBox event bus.
+
+Scenarios can be given triggers, stored with their definition :
+
+    "triggers": [
+        {"var_type": "motion", "var_name": "hallway", "value": true},
+        {"var_type": "temperature", "var_name": "living", "above": 26}
+    ]
+
+A trigger matches the events of the given variable type and name (any variable of
+the type if the name is omitted), and optionally a condition on the event value.
+
+Rules are indexed by variable type and name, so that matching an event costs a
+couple of dictionary lookups whatever the number of rules.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import json
+import threading
+
+from pycstbox.log import Loggable
+from pycstbox.events import DataKeys
+
+KEY_VAR_TYPE = 'var_type'
+KEY_VAR_NAME = 'var_name'
+KEY_VALUE = 'value'
+KEY_ABOVE = 'above'
+KEY_BELOW = 'below'
+
+# the D-Bus signal broadcasting the events of a channel
+EVENT_SIGNAL = 'onCSTBoxEvent'
+
+
+def parse_trigger(d):
+    """ Creates a trigger from its settings.
+
+    :param dict d: the settings
+    :rtype: TriggerRule
+    :raise: ValueError if the settings are not valid
+    """
+    if not isinstance(d, dict) or not d.get(KEY_VAR_TYPE):
+        raise ValueError('invalid trigger : %s' % d)
+    return TriggerRule(
+        d[KEY_VAR_TYPE], d.get(KEY_VAR_NAME), d.get(KEY_VALUE, TriggerRule.ANY),
+        above=d.get(KEY_ABOVE), below=d.get(KEY_BELOW)
+    )
+
+
+class TriggerRule(object):
+    """ A rule matching the events of a variable.
+    """
+    __slots__ = ('var_type', 'var_name', 'value', 'above', 'below', 'has_value')
+
+    # stands for any value
+    ANY = object()
+
+    def __init__(self, var_type, var_name=None, value=ANY, above=None, below=None):
+        """
+        :param str var_type: the type of the variable
+        :param str var_name: the name of the variable (default: any variable of the type)
+        :param value: the value must be equal to this one (default: any value)
+        :param above: the value must be greater than this one
+        :param below: the value must be lower than this one
+        :raise: ValueError if thresholds are not numbers
+        """
+        for threshold in (above, below):
+            if threshold is not None and not isinstance(threshold, (int, long, float)):
+                raise ValueError('invalid threshold : %s' % threshold)
+        self.var_type = var_type
+        self.var_name = var_name or None
+        self.has_value = value is not self.ANY
+        self.value = value if self.has_value else None
+        self.above = above
+        self.below = below
+
+    @property
+    def key(self):
+        """ The key of the rule in the index.
+        """
+        return self.var_type, self.var_name
+
+    @property
+    def conditional(self):
+        return self.has_value or self.above is not None or self.below is not None
+
+    def matches(self, value):
+        """ Tells if the value of an event fulfills the conditions of the rule.
+        """
+        if self.has_value and value != self.value:
+            return False
+        try:
+            if self.above is not None and not value > self.above:
+                return False
+            if self.below is not None and not value < self.below:
+                return False
+        except TypeError:
+            return False
+        return True
+
+    def as_dict(self):
+        d = {KEY_VAR_TYPE: self.var_type}
+        if self.var_name:
+            d[KEY_VAR_NAME] = self.var_name
+        if self.has_value:
+            d[KEY_VALUE] = self.value
+        if self.above is not None:
+            d[KEY_ABOVE] = self.above
+        if self.below is not None:
+            d[KEY_BELOW] = self.below
+        return d
+
+
+class TriggersIndex(object):
+    """ The trigger rules of a set of scenarios, indexed by variable type and name.
+    """
+    def __init__(self):
+        # (var_type, var_name or None) -> list of (scenario id, rule)
+        self._rules = {}
+        # scenario id -> keys of its rules
+        self._keys = {}
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._rules.itervalues())
+
+    def add(self, scen_id, rules):
+        """ Registers the rules of a scenario, replacing the previous ones if any.
+        """
+        self.remove(scen_id)
+        keys = set()
+        for rule in rules:
+            # lists are replaced rather than modified, since the ones returned by
+            # candidates() can be iterated outside of the lock
+            self._rules[rule.key] = self._rules.get(rule.key, []) + [(scen_id, rule)]
+            keys.add(rule.key)
+        if keys:
+            self._keys[scen_id] = keys
+
+    def remove(self, scen_id):
+        for key in self._keys.pop(scen_id, ()):
+            rules = [entry for entry in self._rules[key] if entry[0] != scen_id]
+            if rules:
+                self._rules[key] = rules
+            else:
+                del self._rules[key]
+
+    def clear(self):
+        self._rules.clear()
+        self._keys.clear()
+
+    def candidates(self, var_type, var_name):
+        """ Returns the rules concerning a variable, regardless of their conditions.
+
+        :rtype: list of [(str, TriggerRule)]
+        """
+        specific = self._rules.get((var_type, var_name))
+        generic = self._rules.get((var_type, None))
+        if specific and generic:
+            return specific + generic
+        return specific or generic or []
+
+    def match(self, var_type, var_name, value):
+        """ Returns the ids of the scenarios triggered by an event, without duplicates.
+
+        :rtype: list of [str]
+        """
+        matched = []
+        for scen_id, rule in self.candidates(var_type, var_name):
+            if rule.matches(value) and scen_id not in matched:
+                matched.append(scen_id)
+        return matched
+
+
+class EventTriggers(Loggable):
+    """ Triggers the execution of scenarios when events they react to are received.
+
+    The events are received by subscribing to the signal of an event manager channel.
+    The rules are kept in sync with the scenarios directory by listening to its
+    modifications.
+    """
+    def __init__(self, scenarios_mgr, trigger, event_manager=None):
+        """
+        :param ScenariosManager scenarios_mgr: the scenarios directory
+        :param callable trigger: called with the scenario id when a scenario must be executed
+        :param event_manager: the event manager channel to subscribe to, if any
+        """
+        super(EventTriggers, self).__init__()
+        self._scenarios_mgr = scenarios_mgr
+        self._trigger = trigger
+        self._event_manager = event_manager
+        self._index = TriggersIndex()
+        self._lock = threading.Lock()
+        self._signal_match = None
+
+    @property
+    def rules_count(self):
+        return len(self._index)
+
+    def start(self):
+        self._scenarios_mgr.add_listener(self.on_scenario_change)
+        self._index_all()
+        if self._event_manager is not None:
+            self._signal_match = self._event_manager.connect_to_signal(EVENT_SIGNAL, self.on_event_signal)
+
+    def stop(self):
+        self._scenarios_mgr.remove_listener(self.on_scenario_change)
+        if self._signal_match is not None:
+            self._signal_match.remove()
+            self._signal_match = None
+        with self._lock:
+            self._index.clear()
+
+    def _index_all(self):
+        with self._lock:
+            self._index.clear()
+            for id_, rules in self._scenarios_mgr.iter_triggers():
+                self._index.add(id_, rules)
+        self.log_info('%d trigger rule(s) registered', self.rules_count)
+
+    def on_scenario_change(self, what, id_):
+        """ Scenarios directory listener.
+        """
+        if id_ is None:
+            self._index_all()
+            return
+        try:
+            triggers = self._scenarios_mgr.get_scenario(id_).triggers
+        except KeyError:
+            triggers = ()
+        with self._lock:
+            self._index.add(id_, triggers)
+
+    def on_event_signal(self, timestamp, var_type, var_name, data):
+        """ Handler of the event manager signal.
+
+        :param str data: the JSON encoded event data
+        """
+        with self._lock:
+            candidates = self._index.candidates(var_type, var_name)
+        if not candidates:
+            return
+        # data are decoded only when needed
+        value = None
+        if any(rule.conditional for _, rule in candidates):
+            try:
+                payload = json.loads(data) if data else {}
+            except ValueError:
+                self.log_error('invalid event data : %s', data)
+                return
+            value = payload.get(DataKeys.VALUE) if isinstance(payload, dict) else payload
+        self.process_event(var_type, var_name, value)
+
+    def process_event(self, var_type, var_name, value):
+        """ Executes the scenarios triggered by an event.
+
+        :return: the ids of the triggered scenarios
+        :rtype: list of [str]
+        """
+        with self._lock:
+            matched = self._index.match(var_type, var_name, value)
+        for scen_id in matched:
+            self.log_info('scenario %s triggered by %s.%s', scen_id, var_type, var_name)
+            try:
+                self._trigger(scen_id)
+            except Exception as e:
+                self.log_exception(e)
+        return matched
@@ -4,10 +4,30 @@
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
 import json
+import os
+import time
+import email.utils
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketHandler
 
 from pycstbox.webservices.wsapp import WSHandler
 from pycstbox import log, sysutils, evtmgr
 from pycstbox.homeautomation.core import ScenariosManager, Scenario, BasicAction
+from pycstbox.homeautomation.execution import ScenarioExecutor
+from pycstbox.homeautomation.ratelimit import RateLimiter
+from pycstbox.homeautomation.scheduling import Scheduler
+from pycstbox.homeautomation.triggers import EventTriggers
+from pycstbox.homeautomation.devicestate import DeviceStateCache
+from pycstbox.homeautomation.history import ExecutionHistory, SpillFile
+from pycstbox.homeautomation.storage import open_store, SQLiteStore
+from pycstbox.homeautomation import metrics
+
+DEFAULT_SAVE_DELAY = 1.0
+
+
+def _flag(settings, name, default=False):
+    return str(settings.get(name, default)).lower() in ('1', 'true', 'yes', 'on')
 
 
 def _init_(logger=None, settings=None):
@@ -15,11 +35,43 @@ def _init_(logger=None, settings=None):
     services discovery process.
 
     settings expected content:
-     - config_path : automation scenarios configuration file
+     - config_path : automation scenarios configuration file, which is a SQLite database
+     if its extension is one of .db, .sqlite or .sqlite3, and a JSON file otherwise
+     - migrate_from : (optional) JSON configuration file used for initializing the SQLite
+     database if it does not exist yet
+     - executor_workers : (optional) number of scenario execution threads
+     - coalesce_window : (optional) window (in seconds) used for coalescing the control events
+     sent to a same device by concurrent executions (default: no coalescing)
+     - target_rate : (optional) maximum rate (in events per second) of the control events sent
+     to a same device (default: no rate limiting)
+     - target_burst : (optional) number of control events which can be sent at once to a device
+     - verb_rates : (optional) JSON encoded dictionary giving the [rate, burst] limits of the
+     control events of given verbs (e.g. {"dim": [2, 4]})
+     - save_delay : (optional) delay (in seconds) used to coalesce the writes of
+     successive scenario modifications
+     - compact_storage : (optional) if true, identical actions are shared between scenarios
+     for reducing the memory footprint
+     - lazy_loading : (optional) if true, the configuration file is only indexed at startup,
+     and scenarios are loaded the first time they are used
+     - compiled_cache : (optional, default: true) if true, the scenarios are cached in compiled
+     form next to the configuration file, for speeding up the next startups
+     - latitude, longitude : (optional) the location of the box, in degrees, required by
+     the scenario schedules based on sunrise and sunset
+     - event_triggers : (optional, default: true) if true, scenarios with triggers are executed
+     when the sensor events they react to are received
+     - state_cache : (optional) if true, the last known state of the devices is tracked, and
+     the actions which would not change it are skipped, unless the execution is forced
+     - state_max_age : (optional) the time (in seconds) after which a known state is ignored
+     - history_size : (optional) the number of executions kept in memory in the history
+     (0 disables the history)
+     - history_path : (optional) file receiving the executions evicted from the in-memory history
+     - history_file_size : (optional) the size (in bytes) past which the history file is rotated
     """
 
     if not logger:
         logger = log.getLogger('wsapi.homeautomation')
+    if settings is None:
+        settings = {}
     _handlers_initparms['logger'] = logger
     _handlers_initparms['settings'] = settings
 
@@ -30,6 +82,138 @@ def _init_(logger=None, settings=None):
     _handlers_initparms['events_mgr'] = evt_mgr
     logger.info('success')
 
+    # the scenarios registry is shared by all the requests handlers, and is reloaded only
+    # when the configuration file is modified
+    scenarios_mgr = ScenariosManager(
+        compact=_flag(settings, 'compact_storage'),
+        lazy=_flag(settings, 'lazy_loading'),
+        use_cache=_flag(settings, 'compiled_cache', True)
+    )
+    config_path = settings.get('config_path', None)
+    store = open_store(config_path) if config_path else None
+    if isinstance(store, SQLiteStore) and not os.path.exists(config_path) and settings.get('migrate_from'):
+        logger.info('migrating scenarios from %s to %s', settings['migrate_from'], config_path)
+        count = store.import_json(settings['migrate_from'])
+        logger.info('%d scenario(s) migrated', count)
+    scenarios_mgr.load_scenarios(path=config_path)
+    _handlers_initparms['scenarios_mgr'] = scenarios_mgr
+
+    ha_metrics = metrics.HomeAutomationMetrics()
+    _handlers_initparms['metrics'] = ha_metrics
+
+    # scenarios are executed by worker threads, so that requests don't block the IOLoop
+    workers = int(settings.get('executor_workers', ScenarioExecutor.DEFAULT_WORKERS))
+    rate_limits = None
+    if settings.get('target_rate') or settings.get('verb_rates'):
+        rate_limits = {
+            'target_rate': float(settings.get('target_rate', RateLimiter.DEFAULT_TARGET_RATE)),
+            'target_burst': int(settings.get('target_burst', RateLimiter.DEFAULT_TARGET_BURST)),
+            'verb_rates': json.loads(settings.get('verb_rates') or '{}')
+        }
+    state_cache = None
+    if _flag(settings, 'state_cache'):
+        max_age = settings.get('state_max_age')
+        state_cache = DeviceStateCache(max_age=float(max_age) if max_age else None)
+        ha_metrics.track_state_cache(state_cache)
+    executor = ScenarioExecutor(
+        evt_mgr, workers=workers, tracer=ha_metrics.trace_emission,
+        coalesce_window=float(settings.get('coalesce_window', 0)),
+        rate_limits=rate_limits, state_cache=state_cache
+    )
+    executor.add_listener(ha_metrics.on_execution_progress)
+    ha_metrics.track_queue_depth(executor)
+    if executor.coalescer:
+        ha_metrics.track_coalescer(executor.coalescer)
+    if executor.rate_limiter:
+        ha_metrics.track_rate_limiter(executor.rate_limiter)
+    _handlers_initparms['executor'] = executor
+
+    history = None
+    history_size = int(settings.get('history_size', ExecutionHistory.DEFAULT_CAPACITY))
+    if history_size > 0:
+        spill = None
+        if settings.get('history_path'):
+            spill = SpillFile(
+                settings['history_path'],
+                max_size=int(settings.get('history_file_size', SpillFile.DEFAULT_MAX_SIZE))
+            )
+        history = ExecutionHistory(capacity=history_size, spill=spill)
+        executor.add_listener(history.on_execution_progress)
+    _handlers_initparms['history'] = history
+
+    # changes and executions are pushed to the clients connected to the notifications socket
+    hub = NotificationsHub()
+    scenarios_mgr.add_listener(hub.on_scenario_change)
+    executor.add_listener(hub.on_execution_progress)
+    _handlers_initparms['notifications_hub'] = hub
+
+    # scheduled executions are served by a single timer on the IOLoop
+    location = None
+    if settings.get('latitude') is not None and settings.get('longitude') is not None:
+        location = (float(settings['latitude']), float(settings['longitude']))
+
+    def trigger(scen_id):
+        executor.submit(scen_id, scenarios_mgr.get_scenario(scen_id))
+
+    scheduler = Scheduler(scenarios_mgr, trigger, location=location)
+    scheduler.start()
+    _handlers_initparms['scheduler'] = scheduler
+
+    event_triggers = _flag(settings, 'event_triggers', True)
+    if event_triggers or state_cache is not None:
+        sensor_evt_mgr = evtmgr.get_object(evtmgr.SENSOR_EVENT_CHANNEL)
+        if sensor_evt_mgr:
+            if event_triggers:
+                triggers = EventTriggers(scenarios_mgr, trigger, sensor_evt_mgr)
+                triggers.start()
+                _handlers_initparms['triggers'] = triggers
+            if state_cache is not None:
+                state_cache.attach(sensor_evt_mgr)
+        else:
+            logger.error('cannot get event manager access for channel %s', evtmgr.SENSOR_EVENT_CHANNEL)
+
+    if state_cache is not None:
+        # devices can also be controlled by other components than us
+        state_cache.attach(evt_mgr)
+
+
+class NotificationsHub(object):
+    """ Broadcasts notifications to the connected clients.
+
+    Notifications can be posted from any thread, since they are sent from the IOLoop.
+    """
+    def __init__(self):
+        self._clients = set()
+
+    def register(self, client):
+        self._clients.add(client)
+
+    def unregister(self, client):
+        self._clients.discard(client)
+
+    def on_scenario_change(self, what, scen_id):
+        self.post({'event': what, 'scenario': scen_id})
+
+    def on_execution_progress(self, what, job, details):
+        message = {'event': what, 'scenario': job.scen_id, 'job': job.id}
+        message.update(details)
+        self.post(message)
+
+    def post(self, message):
+        """ Sends a message to all the clients.
+
+        :param dict message: the message
+        """
+        if self._clients:
+            IOLoop.instance().add_callback(lambda: self._broadcast(json.dumps(message)))
+
+    def _broadcast(self, data):
+        for client in list(self._clients):
+            try:
+                client.write_message(data)
+            except Exception:
+                self.unregister(client)
+
 
 class BaseHandler(WSHandler):
     """ Root class for requests handlers.
@@ -37,11 +221,54 @@ class BaseHandler(WSHandler):
     It takes care of storing shared resources retrieved when initializing the service module.
     """
     _scenarios_mgr = None
+    _save_delay = 0
+    _metrics = None
 
-    def initialize(self, logger=None, settings=None, **kwargs):
+    def initialize(self, logger=None, settings=None, scenarios_mgr=None, metrics=None, **kwargs):
         super(BaseHandler, self).initialize(logger, **kwargs)
-        self._scenarios_mgr = ScenariosManager()
-        self._scenarios_mgr.load_scenarios(path=settings.get('config_path', None))
+        self._scenarios_mgr = scenarios_mgr
+        self._save_delay = float(settings.get('save_delay', DEFAULT_SAVE_DELAY))
+        self._metrics = metrics
+        self._scenarios_mgr.reload_if_changed()
+
+    def on_finish(self):
+        if self._metrics:
+            self._metrics.observe_request(
+                self.__class__.__name__, self.request.method, self.get_status(), self.request.request_time()
+            )
+
+    def _not_modified(self):
+        """ Sets the validation headers of the reply according to the revision of the
+        scenarios directory, and checks if the client copy is still valid.
+
+        :return: True if the client copy is valid, in which case the reply status is set to 304
+        :rtype: bool
+        """
+        etag = '"%s"' % self._scenarios_mgr.version
+        last_modified = int(self._scenarios_mgr.last_modified)
+        # dates have a one second resolution, and thus can't tell apart the revisions made
+        # during the current second : only the ETag is used for validating them
+        settled = last_modified < int(time.time())
+        self.set_header('ETag', etag)
+        if settled:
+            self.set_header('Last-Modified', email.utils.formatdate(last_modified, usegmt=True))
+        self.set_header('Cache-Control', 'no-cache')
+
+        headers = self.request.headers
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            valid = '*' in tags or etag in tags or ('W/' + etag) in tags
+        else:
+            if_modified_since = headers.get('If-Modified-Since')
+            if not if_modified_since or not settled:
+                return False
+            date = email.utils.parsedate_tz(if_modified_since)
+            valid = date is not None and last_modified <= email.utils.mktime_tz(date)
+
+        if valid:
+            self.set_status(304)
+        return valid
 
 
 class GetAvailableScenarios(BaseHandler):
@@ -49,13 +276,23 @@ class GetAvailableScenarios(BaseHandler):
 
     The result is a list of pairs (id, label), wrapped in a dictionary keyed by "scenarios" for
     security sake.
+
+    Conditional requests are supported, based on the ETag and Last-Modified headers.
     """
     def do_get(self):
+        if self._not_modified():
+            return
+        # the reply is serialized once per revision of the scenarios directory
+        reply = self._scenarios_mgr.cached('ws.scenarios_list', self._build_reply)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(reply)
+
+    def _build_reply(self):
         result = [
-            {'id': scen_id, 'label': sysutils.to_unicode(scenario.label), 'verb': sysutils.to_unicode(scenario.ui_verb)}
-            for scen_id, scenario in self._scenarios_mgr.scenarios
+            {'id': scen_id, 'label': sysutils.to_unicode(label), 'verb': sysutils.to_unicode(ui_verb)}
+            for scen_id, label, ui_verb in self._scenarios_mgr.summaries
         ]
-        self.write({'scenarios': result})
+        return json.dumps({'scenarios': result})
 
 
 class ScenarioSettings(BaseHandler):
@@ -64,12 +301,14 @@ class ScenarioSettings(BaseHandler):
     def do_get(self, scen_id):
         try:
             scenario = self._scenarios_mgr.get_scenario(scen_id)
-            self.write(scenario.as_dict())
         except KeyError:
             self.set_status(404)
             self.write({
                 'message': 'scenario not found : %s' % scen_id
             })
+        else:
+            if not self._not_modified():
+                self.write(scenario.as_dict())
 
     def do_put(self, scen_id):
         try:
@@ -88,8 +327,15 @@ class ScenarioSettings(BaseHandler):
                     'message': 'invalid JSON data passed in request body'
                 })
             else:
-                scenario.update(new_settings)
-                self._scenarios_mgr.save_scenarios()
+                try:
+                    self._scenarios_mgr.update_scenario(scen_id, new_settings)
+                except (KeyError, ValueError) as e:
+                    self.set_status(400)
+                    self.write({
+                        'message': 'invalid scenario settings : %s' % e
+                    })
+                else:
+                    self._scenarios_mgr.save_changes(delay=self._save_delay)
 
     # def put(self, scen_id):
     #     if scen_id in self._scenarios_mgr:
@@ -116,20 +362,172 @@ class ScenarioSettings(BaseHandler):
             self.write({
                 'message': 'scenario not found : %s' % scen_id
             })
+        except ValueError as e:
+            # the scenario is referenced by other ones
+            self.set_status(409)
+            self.write({
+                'message': str(e)
+            })
+        else:
+            self._scenarios_mgr.save_changes(delay=self._save_delay)
+
+
+class ScenariosBatch(BaseHandler):
+    """ Bulk export and modification of automation scenarios.
+
+    GET returns the settings of all the scenarios (or of the ones listed in the comma
+    separated `ids` argument), keyed by scenario id and wrapped in a dictionary keyed by
+    "scenarios".
+
+    POST applies a set of modifications in a single transaction, and persists them in a
+    single write. The request body is a dictionary with the following optional entries :
+     - create : the settings of the scenarios to be added, keyed by id
+     - update : the new settings of existing scenarios, keyed by id
+     - delete : the list of the ids of the scenarios to be removed
+
+    If any of the modifications is invalid, none of them is applied.
+    """
+    def do_get(self):
+        ids = self.get_argument('ids', '')
+        if ids:
+            try:
+                scenarios = self._scenarios_mgr.export_scenarios(ids.split(','))
+            except KeyError as e:
+                self.set_status(404)
+                self.write({
+                    'message': 'scenario not found : %s' % e.args[0]
+                })
+            else:
+                self.write({'scenarios': scenarios})
+            return
+
+        if self._not_modified():
+            return
+        reply = self._scenarios_mgr.cached('ws.scenarios_export', self._build_export)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(reply)
+
+    def _build_export(self):
+        return json.dumps({'scenarios': self._scenarios_mgr.export_scenarios()})
+
+    def do_post(self):
+        try:
+            batch = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            self.write({
+                'message': 'invalid JSON data passed in request body'
+            })
+            return
+
+        if not isinstance(batch, dict) \
+                or not isinstance(batch.get('create', {}), dict) \
+                or not isinstance(batch.get('update', {}), dict) \
+                or not isinstance(batch.get('delete', []), list):
+            self.set_status(400)
+            self.write({
+                'message': 'invalid batch content'
+            })
+            return
+
+        try:
+            modifications = self._scenarios_mgr.apply_batch(
+                create=batch.get('create'), update=batch.get('update'), delete=batch.get('delete')
+            )
+        except KeyError as e:
+            self.set_status(404)
+            self.write({
+                'message': 'scenario not found : %s' % e.args[0]
+            })
+        except ValueError as e:
+            self.set_status(400)
+            self.write({
+                'message': 'invalid batch : %s' % e
+            })
+        else:
+            self._scenarios_mgr.save_changes()
+            counts = {ScenariosManager.SCENARIO_ADDED: 0, ScenariosManager.SCENARIO_UPDATED: 0,
+                      ScenariosManager.SCENARIO_REMOVED: 0}
+            for what, _ in modifications:
+                counts[what] += 1
+            self.write({
+                'created': counts[ScenariosManager.SCENARIO_ADDED],
+                'updated': counts[ScenariosManager.SCENARIO_UPDATED],
+                'deleted': counts[ScenariosManager.SCENARIO_REMOVED],
+                'version': self._scenarios_mgr.version
+            })
+
+
+class TargetScenarios(BaseHandler):
+    """ Returns the scenarios acting on a device.
+
+    The result is a list of dictionaries giving the id of each scenario and the indices
+    of its actions targeting the device, wrapped in a dictionary keyed by "scenarios".
+    """
+    def do_get(self, target):
+        usages = self._scenarios_mgr.find_target(target)
+        self.write({
+            'target': target,
+            'scenarios': [
+                {'id': scen_id, 'actions': usages[scen_id]} for scen_id in sorted(usages)
+            ]
+        })
+
+
+class TargetRename(BaseHandler):
+    """ Replaces a device by another one in all the scenarios acting on it.
+
+    The request body is a dictionary giving the new target under the "target" key. The
+    modifications are persisted in a single write, and the reply gives the ids of the
+    modified scenarios.
+    """
+    def do_post(self, target):
+        try:
+            new_target = json.loads(self.request.body)['target']
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            self.write({
+                'message': 'invalid JSON data passed in request body'
+            })
+            return
+
+        try:
+            modified = self._scenarios_mgr.rename_target(target, new_target)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({
+                'message': 'invalid target : %s' % e
+            })
         else:
-            self._scenarios_mgr.save_scenarios()
+            if modified:
+                self._scenarios_mgr.save_changes()
+            self.write({'scenarios': modified})
+
+
+class VerbScenarios(BaseHandler):
+    """ Returns the ids of the scenarios using a verb, wrapped in a dictionary keyed
+    by "scenarios".
+    """
+    def do_get(self, verb):
+        self.write({'verb': verb, 'scenarios': self._scenarios_mgr.find_verb(verb)})
 
 
 class ScenarioExecution(BaseHandler):
     """ Triggers the execution of an automation scenario.
+
+    The execution is performed asynchronously, and the reply contains the id of the job
+    which can be used to query its progress.
+
+    If the device state cache is enabled, the actions whose target is already in the
+    requested state are skipped, unless the request includes the `force=1` argument.
     """
-    _evtmgr = None
+    _executor = None
 
     def initialize(self, **kwargs):
         super(ScenarioExecution, self).initialize(**kwargs)
-        self._evtmgr = kwargs['events_mgr']
-        if not self._evtmgr:
-            raise ValueError('no event manager provided')
+        self._executor = kwargs['executor']
+        if not self._executor:
+            raise ValueError('no executor provided')
 
     def do_post(self, scen_id):
         self.do_get(scen_id)
@@ -143,13 +541,124 @@ class ScenarioExecution(BaseHandler):
                 'message': 'scenario not found : %s' % scen_id
             })
         else:
-            scenario.execute(self._evtmgr)
+            force = self.get_argument('force', '').lower() in ('1', 'true', 'yes')
+            job = self._executor.submit(scen_id, scenario, force=force)
+            self.write({'job': job.id})
+
+
+class ExecutionJobStatus(BaseHandler):
+    """ Returns the progress of a scenario execution.
+    """
+    _executor = None
+
+    def initialize(self, **kwargs):
+        super(ExecutionJobStatus, self).initialize(**kwargs)
+        self._executor = kwargs['executor']
+
+    def do_get(self, scen_id, job_id):
+        try:
+            job = self._executor.get_job(job_id)
+            if job.scen_id != scen_id:
+                raise KeyError(job_id)
+        except KeyError:
+            self.set_status(404)
+            self.write({
+                'message': 'job not found : %s' % job_id
+            })
+        else:
+            self.write(job.as_dict())
+
+
+class ScenarioHistory(BaseHandler):
+    """ Returns the last executions of a scenario, the most recent first.
+
+    The page is selected with the "offset" and "limit" arguments.
+    """
+    MAX_PAGE_SIZE = 100
+    _history = None
+
+    def initialize(self, **kwargs):
+        super(ScenarioHistory, self).initialize(**kwargs)
+        self._history = kwargs.get('history')
+
+    def do_get(self, scen_id):
+        if self._history is None:
+            self.set_status(404)
+            self.write({
+                'message': 'execution history is disabled'
+            })
+            return
+
+        if scen_id not in self._scenarios_mgr:
+            self.set_status(404)
+            self.write({
+                'message': 'scenario not found : %s' % scen_id
+            })
+            return
+
+        try:
+            offset = int(self.get_argument('offset', 0))
+            limit = int(self.get_argument('limit', ExecutionHistory.DEFAULT_PAGE_SIZE))
+            if offset < 0 or not 0 < limit <= self.MAX_PAGE_SIZE:
+                raise ValueError()
+        except ValueError:
+            self.set_status(400)
+            self.write({
+                'message': 'invalid offset or limit (max page size : %d)' % self.MAX_PAGE_SIZE
+            })
+            return
+
+        executions, more = self._history.query(scen_id, offset=offset, limit=limit)
+        self.write({
+            'scenario': scen_id,
+            'offset': offset,
+            'limit': limit,
+            'more': more,
+            'executions': executions
+        })
+
+
+class Metrics(BaseHandler):
+    """ Returns the execution and requests metrics, in the Prometheus text format.
+    """
+    def do_get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(self._metrics.registry.render().encode('utf-8'))
+
+
+class NotificationsSocket(WebSocketHandler):
+    """ WebSocket pushing notifications of scenario changes and executions progress.
+
+    Each notification is a JSON message, containing at least the "event" and "scenario" keys.
+    """
+    _hub = None
+
+    def initialize(self, notifications_hub=None, **kwargs):
+        self._hub = notifications_hub
+
+    def open(self):
+        self._hub.register(self)
+
+    def on_message(self, message):
+        # nothing expected from the clients
+        pass
+
+    def on_close(self):
+        self._hub.unregister(self)
 
 
 _handlers_initparms = {}
 
 handlers = [
     (r"/scenarios", GetAvailableScenarios, _handlers_initparms),
+    (r"/scenarios/batch", ScenariosBatch, _handlers_initparms),
+    (r"/target/(?P<target>[^/]+)/scenarios", TargetScenarios, _handlers_initparms),
+    (r"/target/(?P<target>[^/]+)/rename", TargetRename, _handlers_initparms),
+    (r"/verb/(?P<verb>[^/]+)/scenarios", VerbScenarios, _handlers_initparms),
     (r"/scenario/(?P<scen_id>[^/]+)/settings", ScenarioSettings, _handlers_initparms),
     (r"/scenario/(?P<scen_id>[^/]+)/execute", ScenarioExecution, _handlers_initparms),
+    (r"/scenario/(?P<scen_id>[^/]+)/jobs/(?P<job_id>[^/]+)", ExecutionJobStatus, _handlers_initparms),
+    (r"/scenario/(?P<scen_id>[^/]+)/history", ScenarioHistory, _handlers_initparms),
+    (r"/notifications", NotificationsSocket, _handlers_initparms),
+    (r"/metrics", Metrics, _handlers_initparms),
 ]
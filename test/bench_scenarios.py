@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmarks of the scenario engine and of the web services handlers.
+
+Synthetic scenario files are generated for a range of sizes, and the following
+operations are measured:
+
+ - loading and saving the definitions with ScenariosManager, and loading them lazily
+ - the same with the SQLite storage backend, and saving a single change with it
+ - cold start times, when parsing the JSON file and when using the compiled cache
+ - building scenarios with Scenario.from_dict
+ - executing scenarios against an in-process event manager
+ - the memory footprint of scenarios, in regular and compact storage modes
+ - handling requests through a local Tornado server (skipped if Tornado is not available)
+
+Results are stored as JSON, and can be compared to the ones of a previous run, for
+detecting regressions::
+
+    python bench_scenarios.py --output new.json --baseline old.json
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import argparse
+import gc
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import types
+import httplib
+
+from pycstbox.homeautomation.core import Scenario, ScenariosManager, EventEmitter
+from pycstbox.homeautomation.storage import SQLiteStore
+
+from simulation import LocalService
+
+SCENARIOS_COUNTS = (10, 100, 1000, 10000)
+ACTIONS_COUNTS = (1, 10, 100, 500)
+
+DEFAULT_MAX_ACTIONS = 1000000
+DEFAULT_REPEAT = 5
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+SUITES = ('storage', 'startup', 'scenario', 'memory', 'handlers')
+
+
+class FakeEventManager(object):
+    """ In-process event manager, discarding the events.
+    """
+    def __init__(self, batch=False):
+        self.events_count = 0
+        self.round_trips = 0
+        if batch:
+            self.emitEvents = self._emit_events
+
+    def emitEvent(self, var_type, var_name, data):
+        self.events_count += 1
+        self.round_trips += 1
+
+    def _emit_events(self, events):
+        self.events_count += len(events)
+        self.round_trips += 1
+
+
+def make_scenario_settings(index, actions_count):
+    return {
+        "label": "scenario %d" % index,
+        "ui_verb": Scenario.DEFAULT_VERB,
+        "actions": [
+            {
+                "label": "action %d" % i,
+                "verb": "switch" if i % 2 else "dim",
+                "target": "device%04d" % i,
+                "data": i % 100
+            } for i in xrange(actions_count)
+        ]
+    }
+
+
+def make_scenarios_file(path, scenarios_count, actions_count):
+    settings = make_scenario_settings(0, actions_count)
+    data = {}
+    for i in xrange(scenarios_count):
+        data['s%05d' % i] = dict(settings, label="scenario %d" % i)
+    with open(path, 'wt') as fp:
+        json.dump(data, fp, indent=4)
+
+
+def deep_sizeof(root):
+    """ Returns the memory used by a graph of objects, in bytes.
+
+    Classes, modules, functions and loggers are considered as shared, and are not counted.
+    """
+    shared_types = (type, types.ModuleType, types.FunctionType, logging.Logger)
+    seen = set()
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, shared_types):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def measure(func, repeat, number=1):
+    """ Returns the statistics of the execution time of a function, in seconds per call.
+    """
+    timings = sorted(t / number for t in timeit.repeat(func, repeat=repeat, number=number))
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+        'runs': repeat * number
+    }
+
+
+class Benchmark(object):
+    def __init__(self, work_dir, repeat, max_actions):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.max_actions = max_actions
+        self.results = {}
+
+    def record(self, name, stats):
+        self.results[name] = stats
+        print("%-50s median=%10.3fms min=%10.3fms" % (name, stats['median'] * 1e3, stats['min'] * 1e3))
+
+    def sizes(self):
+        for scenarios_count in SCENARIOS_COUNTS:
+            for actions_count in ACTIONS_COUNTS:
+                if scenarios_count * actions_count <= self.max_actions:
+                    yield scenarios_count, actions_count
+
+    def run_storage(self):
+        for scenarios_count, actions_count in self.sizes():
+            path = os.path.join(self.work_dir, 'scenarios-%d-%d.cfg' % (scenarios_count, actions_count))
+            make_scenarios_file(path, scenarios_count, actions_count)
+            suffix = '[%d scenarios x %d actions]' % (scenarios_count, actions_count)
+
+            mgr = ScenariosManager()
+            self.record('load_scenarios' + suffix, measure(lambda: mgr.load_scenarios(path), self.repeat))
+
+            lazy_mgr = ScenariosManager(lazy=True)
+
+            def lazy_load():
+                lazy_mgr.load_scenarios(path)
+                lazy_mgr.get_scenario('s00000')
+
+            self.record('load_scenarios_lazy' + suffix, measure(lazy_load, self.repeat))
+
+            out_path = path + '.out'
+            self.record('save_scenarios' + suffix, measure(lambda: mgr.save_scenarios(out_path), self.repeat))
+
+            db_path = path + '.db'
+            SQLiteStore(db_path).import_json(path)
+            sqlite_mgr = ScenariosManager()
+            self.record('load_scenarios_sqlite' + suffix, measure(lambda: sqlite_mgr.load_scenarios(db_path), self.repeat))
+
+            lazy_sqlite_mgr = ScenariosManager(lazy=True)
+
+            def lazy_load_sqlite():
+                lazy_sqlite_mgr.load_scenarios(db_path)
+                lazy_sqlite_mgr.get_scenario('s00000')
+
+            self.record('load_scenarios_sqlite_lazy' + suffix, measure(lazy_load_sqlite, self.repeat))
+
+            settings = sqlite_mgr.get_scenario('s00000').as_dict()
+
+            def save_change():
+                sqlite_mgr.update_scenario('s00000', settings)
+                sqlite_mgr.save_changes()
+
+            self.record('save_change_sqlite' + suffix, measure(save_change, self.repeat))
+
+    def run_startup(self):
+        def cold_start(path, **kwargs):
+            mgr = ScenariosManager(**kwargs)
+            mgr.load_scenarios(path)
+            return mgr
+
+        for scenarios_count, actions_count in self.sizes():
+            path = os.path.join(self.work_dir, 'startup-%d-%d.cfg' % (scenarios_count, actions_count))
+            make_scenarios_file(path, scenarios_count, actions_count)
+            suffix = '[%d scenarios x %d actions]' % (scenarios_count, actions_count)
+
+            self.record('cold_start_json' + suffix, measure(lambda: cold_start(path), self.repeat))
+            # builds the cache
+            cold_start(path, use_cache=True)
+            self.record('cold_start_cache' + suffix, measure(lambda: cold_start(path, use_cache=True), self.repeat))
+            self.record('cold_start_lazy' + suffix, measure(lambda: cold_start(path, lazy=True), self.repeat))
+
+    def run_scenario(self):
+        for actions_count in ACTIONS_COUNTS:
+            settings = make_scenario_settings(0, actions_count)
+            suffix = '[%d actions]' % actions_count
+
+            self.record('from_dict' + suffix, measure(lambda: Scenario.from_dict(settings), self.repeat, 100))
+
+            scenario = Scenario.from_dict(settings)
+            for batch in (False, True):
+                emitter = EventEmitter(FakeEventManager(batch=batch))
+                self.record(
+                    'execute%s' % ('_batch' if batch else '') + suffix,
+                    measure(lambda: scenario.execute(emitter), self.repeat, 10)
+                )
+
+    def run_memory(self):
+        scenarios_count = 1000
+        for actions_count in (1, 10, 100):
+            path = os.path.join(self.work_dir, 'mem-scenarios-%d.cfg' % actions_count)
+            make_scenarios_file(path, scenarios_count, actions_count)
+
+            for compact in (False, True):
+                mgr = ScenariosManager(compact=compact)
+                mgr.load_scenarios(path)
+                footprint = deep_sizeof(mgr._scenarios) / float(scenarios_count)
+                name = 'scenario_footprint%s[%d actions]' % ('_compact' if compact else '', actions_count)
+                # memory is stored in the same structure as timings, for the comparison
+                self.results[name] = {'min': footprint, 'median': footprint, 'max': footprint, 'runs': 1}
+                print("%-50s %10d bytes" % (name, footprint))
+
+    def run_handlers(self):
+        # the local service imports them when started
+        try:
+            import tornado.web
+            import pycstbox.webservices.services.homeautomation
+        except ImportError as e:
+            print("handlers benchmark skipped (%s)" % e)
+            return
+
+        for scenarios_count in SCENARIOS_COUNTS:
+            path = os.path.join(self.work_dir, 'ws-scenarios-%d.cfg' % scenarios_count)
+            make_scenarios_file(path, scenarios_count, 10)
+
+            with LocalService(path, FakeEventManager()) as service:
+                conn = httplib.HTTPConnection('127.0.0.1', service.port)
+
+                def get(url):
+                    conn.request('GET', url)
+                    reply = conn.getresponse()
+                    reply.read()
+
+                suffix = '[%d scenarios]' % scenarios_count
+                self.record('GET /scenarios' + suffix, measure(lambda: get('/scenarios'), self.repeat, 20))
+                self.record(
+                    'GET /scenario/<id>/settings' + suffix,
+                    measure(lambda: get('/scenario/s00000/settings'), self.repeat, 20)
+                )
+                self.record(
+                    'GET /scenario/<id>/execute' + suffix,
+                    measure(lambda: get('/scenario/s00000/execute'), self.repeat, 20)
+                )
+                conn.close()
+
+
+def compare(results, baseline, threshold):
+    """ Compares results to a baseline, and returns the names of the benchmarks which
+    have regressed by more than the given ratio.
+    """
+    regressions = []
+    print("\n%-50s %12s %12s %8s" % ('benchmark', 'baseline', 'current', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], results[name]['median']
+        change = (new - old) / old if old else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' <<<'
+        print("%-50s %10.3fms %10.3fms %+7.1f%%%s" % (name, old * 1e3, new * 1e3, change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default='bench_results.json', help='results file')
+    parser.add_argument('-b', '--baseline', help='results of a previous run to compare with')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help='number of measures')
+    parser.add_argument(
+        '--max-actions', type=int, default=DEFAULT_MAX_ACTIONS,
+        help='maximum total number of actions of the generated files'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+        help='relative slowdown reported as a regression'
+    )
+    parser.add_argument('suites', nargs='*', help='suites to be run, among %s (default: all)' % ', '.join(SUITES))
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error('invalid suite : %s' % suite)
+
+    work_dir = tempfile.mkdtemp(prefix='ha-bench-')
+    bench = Benchmark(work_dir, args.repeat, args.max_actions)
+    try:
+        for suite in args.suites or SUITES:
+            getattr(bench, 'run_' + suite)()
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output, 'wt') as fp:
+        json.dump({
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'results': bench.results
+        }, fp, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'rt') as fp:
+            baseline = json.load(fp)['results']
+        if compare(bench.results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
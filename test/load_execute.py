@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Load generator for the scenario execution service.
+
+Concurrent clients fire /scenario/<id>/execute requests, and the throughput and latency
+percentiles of the requests are reported for each concurrency level.
+
+By default, the service is started locally on a synthetic scenarios file, and executes
+the scenarios on a simulated event manager, so that the scaling behavior of the handlers
+and of the executor can be measured without a box. The end-to-end execution latencies
+(from the submission of the job to the end of its execution) are then reported too::
+
+    python load_execute.py --concurrency 1,4,16 --latency 0.005 --jitter 0.002
+
+A running service can be targeted instead with --url, in which case only the requests
+are measured::
+
+    python load_execute.py --url http://cbx-virtual.local:8888/api/homeautomation
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import argparse
+import httplib
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+
+from pycstbox.homeautomation.execution import ExecutionJob
+
+from bench_scenarios import make_scenarios_file
+from simulation import SimulatedEventManager, LocalService
+
+DEFAULT_REQUESTS = 500
+DEFAULT_CONCURRENCY = '1,4,16'
+DEFAULT_SCENARIOS = 100
+DEFAULT_ACTIONS = 10
+DEFAULT_WAIT_TIMEOUT = 60
+
+
+def percentile(values, p):
+    """ Returns the p-th percentile of sorted values, using the nearest rank method.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100. * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None
+    }
+
+
+class ExecutionsRecorder(object):
+    """ Executor listener collecting the end-to-end latencies of the executions.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.failures = 0
+        self.first_submitted = self.last_ended = None
+
+    def reset(self):
+        with self._lock:
+            self.latencies = []
+            self.failures = 0
+            self.first_submitted = self.last_ended = None
+
+    def on_execution_progress(self, what, job, details):
+        if what != ExecutionJob.FINISHED:
+            return
+        d = job.as_dict()
+        with self._lock:
+            self.latencies.append(d['ended'] - d['submitted'])
+            if d['status'] == ExecutionJob.FAILED:
+                self.failures += 1
+            if self.first_submitted is None or d['submitted'] < self.first_submitted:
+                self.first_submitted = d['submitted']
+            if self.last_ended is None or d['ended'] > self.last_ended:
+                self.last_ended = d['ended']
+
+    def wait(self, count, timeout):
+        limit = time.time() + timeout
+        while len(self.latencies) < count and time.time() < limit:
+            time.sleep(0.01)
+        return len(self.latencies) >= count
+
+
+def fire(host, port, paths, concurrency):
+    """ Sends the requests from concurrent clients, each one using its own connection.
+
+    :return: the latencies of the successful requests, the number of errors and the
+    total elapsed time
+    :rtype: tuple
+    """
+    lock = threading.Lock()
+    pending = list(reversed(paths))
+    latencies, errors = [], [0]
+
+    def client():
+        conn = httplib.HTTPConnection(host, port)
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    path = pending.pop()
+                t0 = time.time()
+                try:
+                    conn.request('GET', path)
+                    reply = conn.getresponse()
+                    reply.read()
+                    ok = reply.status == 200
+                except (httplib.HTTPException, IOError):
+                    conn.close()
+                    conn = httplib.HTTPConnection(host, port)
+                    ok = False
+                elapsed = time.time() - t0
+                with lock:
+                    if ok:
+                        latencies.append(elapsed)
+                    else:
+                        errors[0] += 1
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0], time.time() - t0
+
+
+def report(name, stats):
+    if not stats['count']:
+        print("%-32s no successful request" % name)
+        return
+    print("%-32s %6d in %7.3fs  %9.1f/s  p50=%8.3fms  p99=%8.3fms  max=%8.3fms" % (
+        name, stats['count'], stats['count'] / stats['throughput'], stats['throughput'],
+        stats['p50'] * 1e3, stats['p99'] * 1e3, stats['max'] * 1e3
+    ))
+
+
+def run(base_url, scen_ids, requests_count, levels, recorder=None, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+    url = urlparse.urlparse(base_url)
+    prefix = url.path.rstrip('/')
+    paths = [
+        '%s/scenario/%s/execute' % (prefix, scen_ids[i % len(scen_ids)])
+        for i in xrange(requests_count)
+    ]
+    results = {}
+    for concurrency in levels:
+        if recorder:
+            recorder.reset()
+        latencies, errors, elapsed = fire(url.hostname, url.port or 80, paths, concurrency)
+        result = {'requests': summarize(latencies, elapsed), 'errors': errors}
+        report('requests[c=%d]' % concurrency, result['requests'])
+        if errors:
+            print("%-32s %6d failed request(s)" % ('', errors))
+
+        if recorder:
+            if not recorder.wait(len(latencies), wait_timeout):
+                print("%-32s executions still pending after %ds" % ('', wait_timeout))
+            elapsed = (recorder.last_ended - recorder.first_submitted) if recorder.latencies else 0
+            result['executions'] = summarize(recorder.latencies, elapsed)
+            result['execution_failures'] = recorder.failures
+            report('executions[c=%d]' % concurrency, result['executions'])
+        results[concurrency] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base URL of a running service (default: start a local one)')
+    parser.add_argument('-n', '--requests', type=int, default=DEFAULT_REQUESTS, help='requests per level')
+    parser.add_argument(
+        '-c', '--concurrency', default=DEFAULT_CONCURRENCY,
+        help='comma separated numbers of concurrent clients (default: %s)' % DEFAULT_CONCURRENCY
+    )
+    parser.add_argument('--ids', help='comma separated ids of the executed scenarios')
+    parser.add_argument('-o', '--output', help='JSON results file')
+
+    local = parser.add_argument_group('local service')
+    local.add_argument('--scenarios', type=int, default=DEFAULT_SCENARIOS, help='number of scenarios')
+    local.add_argument('--actions', type=int, default=DEFAULT_ACTIONS, help='number of actions per scenario')
+    local.add_argument('--workers', type=int, help='number of execution threads')
+    local.add_argument('--latency', type=float, default=0., help='latency of the events, in seconds')
+    local.add_argument('--jitter', type=float, default=0., help='jitter of the events latency, in seconds')
+    local.add_argument('--failure-rate', type=float, default=0., help='probability of an emission to fail')
+    local.add_argument('--batch', action='store_true', help='simulate an event manager supporting batches')
+    local.add_argument('--seed', type=int, help='seed of the simulation random generator')
+    local.add_argument(
+        '--wait-timeout', type=float, default=DEFAULT_WAIT_TIMEOUT,
+        help='maximum time to wait for the end of the executions, in seconds'
+    )
+    args = parser.parse_args()
+
+    try:
+        levels = [int(c) for c in args.concurrency.split(',')]
+        if any(c < 1 for c in levels):
+            raise ValueError()
+    except ValueError:
+        parser.error('invalid concurrency : %s' % args.concurrency)
+
+    if args.url:
+        scen_ids = args.ids.split(',') if args.ids else ['s01']
+        results = run(args.url, scen_ids, args.requests, levels)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='ha-load-')
+        try:
+            path = os.path.join(work_dir, 'scenarios.cfg')
+            make_scenarios_file(path, args.scenarios, args.actions)
+            scen_ids = args.ids.split(',') if args.ids else ['s%05d' % i for i in xrange(args.scenarios)]
+            evtmgr = SimulatedEventManager(
+                latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                batch=args.batch, seed=args.seed
+            )
+            options = {'workers': args.workers} if args.workers else {}
+            recorder = ExecutionsRecorder()
+            with LocalService(path, evtmgr, **options) as service:
+                service.executor.add_listener(recorder.on_execution_progress)
+                results = run(service.url, scen_ids, args.requests, levels, recorder, args.wait_timeout)
+            print("%d events emitted, %d failed, %d round trips" % (
+                evtmgr.events_count, evtmgr.failures_count, evtmgr.round_trips
+            ))
+        finally:
+            shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, 'wt') as fp:
+            json.dump({
+                'timestamp': time.time(),
+                'url': args.url,
+                'results': results
+            }, fp, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
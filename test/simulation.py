@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Simulation helpers for testing and measuring the home automation services offline.
+
+ - SimulatedEventManager stands for the control events channel of a box, with configurable
+   per-target latency, jitter and failure rate
+ - LocalService runs the web services handlers on a local Tornado server, using a given
+   event manager
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import random
+import threading
+import time
+
+
+class SimulatedFailure(Exception):
+    """ Raised by the simulated event manager when an emission fails.
+    """
+
+
+class SimulatedEventManager(object):
+    """ Event manager simulating the delays and failures of the devices.
+
+    Each emission takes the latency configured for the target of the event, plus or minus
+    a random jitter, and fails with the configured probability, in which case
+    SimulatedFailure is raised after the delay has elapsed.
+
+    When batches are enabled, a batch of events costs the largest delay of its events,
+    and fails as a whole if any of its events fails.
+    """
+    def __init__(self, latency=0., jitter=0., failure_rate=0., batch=False, seed=None, sleep=time.sleep):
+        """
+        :param float latency: the default latency of an emission, in seconds
+        :param float jitter: the default maximum deviation from the latency, in seconds
+        :param float failure_rate: the default probability of an emission to fail
+        :param bool batch: if True, the emitEvents batch method is provided
+        :param seed: optional seed of the random generator, for reproducible runs
+        :param callable sleep: the function used for waiting
+        """
+        self._default = (latency, jitter, failure_rate)
+        self._targets = {}
+        self._random = random.Random(seed)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.events_count = 0
+        self.failures_count = 0
+        self.round_trips = 0
+        self.last_event = None
+        if batch:
+            self.emitEvents = self._emit_events
+
+    def set_target(self, target, latency=None, jitter=None, failure_rate=None):
+        """ Configures the behavior of a given target, the omitted parameters keeping
+        their default value.
+        """
+        default = self._default
+        self._targets[target] = (
+            default[0] if latency is None else latency,
+            default[1] if jitter is None else jitter,
+            default[2] if failure_rate is None else failure_rate
+        )
+
+    def profile(self, target):
+        """ Returns the (latency, jitter, failure_rate) of a target.
+        """
+        return self._targets.get(target, self._default)
+
+    def _draw(self, target):
+        latency, jitter, failure_rate = self.profile(target)
+        # the random generator is shared by the emitting threads
+        with self._lock:
+            delay = latency + self._random.uniform(-jitter, jitter) if jitter else latency
+            failed = failure_rate > 0 and self._random.random() < failure_rate
+        return max(delay, 0.), failed
+
+    def _record(self, events, failed):
+        with self._lock:
+            self.round_trips += 1
+            if failed:
+                self.failures_count += len(events)
+            else:
+                self.events_count += len(events)
+                self.last_event = events[-1]
+
+    def emitEvent(self, var_type, var_name, data):
+        delay, failed = self._draw(var_name)
+        if delay:
+            self._sleep(delay)
+        self._record([(var_type, var_name, data)], failed)
+        if failed:
+            raise SimulatedFailure('simulated failure of %s' % var_name)
+
+    def _emit_events(self, events):
+        if not events:
+            return
+        draws = [self._draw(var_name) for _, var_name, _ in events]
+        delay = max(d for d, _ in draws)
+        if delay:
+            self._sleep(delay)
+        failed = any(f for _, f in draws)
+        self._record([tuple(e) for e in events], failed)
+        if failed:
+            raise SimulatedFailure('simulated failure of a batch of %d events' % len(events))
+
+
+class LocalService(object):
+    """ The home automation web services, served by a local Tornado server.
+
+    The IOLoop runs in a separate thread, so that the service can be used by clients
+    running in the calling one.
+
+    Requires Tornado, which is imported when the service is started.
+    """
+    def __init__(self, config_path, event_manager, manager_options=None, **executor_options):
+        """
+        :param str config_path: the scenarios configuration file
+        :param event_manager: the event manager used for executing the scenarios
+        :param dict manager_options: the options passed to the scenarios manager
+        :param executor_options: the options passed to the scenario executor
+        """
+        self.config_path = config_path
+        self.event_manager = event_manager
+        self.manager_options = manager_options or {}
+        self.executor_options = executor_options
+        self.scenarios_mgr = None
+        self.executor = None
+        self.port = None
+        self._server = None
+        self._ioloop = None
+        self._loop_thread = None
+
+    def start(self):
+        import tornado.web
+        from tornado.httpserver import HTTPServer
+        from tornado.ioloop import IOLoop
+        from tornado.testing import bind_unused_port
+        from pycstbox.webservices.services import homeautomation as ws
+        from pycstbox.homeautomation.core import ScenariosManager
+        from pycstbox.homeautomation.execution import ScenarioExecutor
+
+        self.scenarios_mgr = ScenariosManager(**self.manager_options)
+        self.scenarios_mgr.load_scenarios(self.config_path)
+        self.executor = ScenarioExecutor(self.event_manager, **self.executor_options)
+        ws._handlers_initparms.update({
+            'settings': {'config_path': self.config_path},
+            'scenarios_mgr': self.scenarios_mgr,
+            'executor': self.executor,
+            'events_mgr': self.event_manager,
+            'notifications_hub': ws.NotificationsHub()
+        })
+
+        sock, self.port = bind_unused_port()
+        self._ioloop = IOLoop.instance()
+        self._server = HTTPServer(tornado.web.Application(ws.handlers))
+        self._server.add_sockets([sock])
+        self._loop_thread = threading.Thread(target=self._ioloop.start)
+        self._loop_thread.start()
+
+    def stop(self):
+        if self._loop_thread is None:
+            return
+        self._ioloop.add_callback(self._ioloop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
+        self._server.stop()
+        self.executor.shutdown()
+        # writes the changes whose save was deferred
+        self.scenarios_mgr.save_changes()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
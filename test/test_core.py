@@ -6,9 +6,12 @@ __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 import unittest
 import os.path
 import json
+import shutil
+import threading
+import time
 
 from pycstbox.log import Loggable
-from pycstbox.homeautomation.core import Scenario, BasicAction, ScenariosManager
+from pycstbox.homeautomation.core import Scenario, BasicAction, ScenarioRef, ScenariosManager, EventEmitter
 
 
 class BaseTestCase(unittest.TestCase, Loggable):
@@ -95,6 +98,103 @@ class TestScenario(BaseTestCase):
         self.assertEqual(self.scenario.label, 'test scenario 01')
         self.assertEqual(len(self.scenario.actions), 2)
 
+    def test08_batch(self):
+        for i in range(250):
+            self.scenario.add_action(BasicAction('switch', 'light%03d' % i, 0))
+
+        evtmgr = BatchingMockUpEventManager()
+        self.scenario.execute(EventEmitter(evtmgr, batch_size=100))
+        self.assertEqual(evtmgr.events_count, 250)
+        self.assertEqual(evtmgr.round_trips, 3)
+        self.assertEqual(evtmgr.last_event, ('switch', 'light249', json.dumps({"value": 0})))
+
+        # no batch support => one round trip per action
+        self.scenario.execute(self.evtmgr)
+        self.assertEqual(self.evtmgr.events_count, 250)
+
+    def test09_batch_not_supported(self):
+        class UnknownMethodError(Exception):
+            def get_dbus_name(self):
+                return EventEmitter.DBUS_UNKNOWN_METHOD
+
+        class ProxyLikeEventManager(BatchingMockUpEventManager):
+            def emitEvents(self, events):
+                self.round_trips += 1
+                raise UnknownMethodError()
+
+        for i in range(5):
+            self.scenario.add_action(BasicAction('switch', 'light%03d' % i, 0))
+
+        evtmgr = ProxyLikeEventManager()
+        emitter = EventEmitter(evtmgr)
+        self.scenario.execute(emitter)
+        self.assertFalse(emitter.batch_supported)
+        self.assertEqual(evtmgr.events_count, 5)
+        self.assertEqual(evtmgr.round_trips, 6)
+
+    def test10_compiled(self):
+        action = BasicAction('switch', 'kitchen', 1)
+        self.scenario.add_action(action)
+        self.assertIs(self.scenario._get_compiled(), self.scenario._get_compiled())
+
+        self.scenario.execute(self.evtmgr)
+        self.assertEqual(self.evtmgr.last_event, ('switch', 'kitchen', self.JSON_VALUE_1))
+
+        self.scenario.add_action(BasicAction('switch', 'living', 0))
+        self.scenario.execute(self.evtmgr)
+        self.assertEqual(self.evtmgr.last_event[1], 'living')
+
+        self.scenario.clear()
+        self.scenario.execute(self.evtmgr)
+        self.assertEqual(self.evtmgr.events_count, 3)
+
+    def test11_parallel_steps(self):
+        d = {
+            "label": "test scenario 01",
+            "actions": [
+                {"verb": "switch", "target": "kitchen", "data": 0},
+                {"verb": "switch", "target": "living", "data": 0, "parallel": True},
+                {"verb": "dim", "target": "bedroom", "data": 50, "parallel": True},
+                {"verb": "switch", "target": "garden", "data": 1}
+            ]
+        }
+        s = Scenario.from_dict(d)
+        self.assertEqual([len(step) for step in s.steps], [3, 1])
+        self.assertEqual([a.get('parallel', False) for a in s.as_dict()['actions']], [False, True, True, False])
+
+        class SlowEventManager(MockUpEventManager):
+            def emitEvent(self, var_type, var_name, data):
+                time.sleep(0.2)
+                super(SlowEventManager, self).emitEvent(var_type, var_name, data)
+
+        evtmgr = SlowEventManager()
+        done = []
+        t0 = time.time()
+        s.execute(evtmgr, progress=lambda i, action, error: done.append(i))
+        elapsed = time.time() - t0
+        self.assertEqual(evtmgr.events_count, 4)
+        self.assertEqual(evtmgr.last_event[1], 'garden')
+        self.assertEqual(sorted(done[:3]), [0, 1, 2])
+        self.assertLess(elapsed, 0.6)
+
+        # the threads of the emitters created for plain event managers are released
+        threads_count = threading.active_count()
+        for _ in range(5):
+            s.execute(MockUpEventManager())
+        self.assertEqual(threading.active_count(), threads_count)
+
+    def test12_lazy_label(self):
+        action = BasicAction('dim', 'bedroom', 50)
+        self.assertIsNone(tuple.__getitem__(action, 3))
+        self.assertEqual(action.label, 'dim bedroom 50%')
+        self.assertEqual(action._asdict()['label'], 'dim bedroom 50%')
+        self.assertEqual(BasicAction('dim', 'bedroom', 50, 'my label').label, 'my label')
+
+    def test13_action_validation(self):
+        self.assertRaises(TypeError, BasicAction, 'switch', 5, 1)
+        self.assertRaises(ValueError, BasicAction, 'dim', 'bedroom', 'abc')
+        self.assertRaises(ValueError, BasicAction.from_dict, {'verb': 'dim', 'target': 'bedroom', 'data': 'abc'})
+
 
 class TestScenariosManager(BaseTestCase):
     SCENARIO_CFG_FILE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'home-automation-scenarios.cfg')
@@ -145,6 +245,202 @@ class TestScenariosManager(BaseTestCase):
         d_out = json.load(file(out_path, 'rt'))
         self.assertDictEqual(d_in, d_out)
 
+    def test05_reload_if_changed(self):
+        path = "/tmp/scenarios-reload.cfg"
+        shutil.copy(self.SCENARIO_CFG_FILE_PATH, path)
+        self.mgr.load_scenarios(path)
+        self.assertFalse(self.mgr.reload_if_changed())
+
+        self.mgr.remove_scenario('s02')
+        self.mgr.save_scenarios()
+        self.assertFalse(self.mgr.reload_if_changed())
+
+        d = json.load(file(path, 'rt'))
+        d['s03'] = d['s01']
+        json.dump(d, file(path, 'wt'), indent=4)
+        self.assertTrue(self.mgr.reload_if_changed())
+        self.assertIn('s03', self.mgr)
+        self.assertNotIn('s02', self.mgr)
+
+    def test06_sorted_index(self):
+        for scen_id in ('s05', 's01', 's03'):
+            self.mgr.add_scenario(scen_id, Scenario(scen_id))
+        self.assertEqual([id_ for id_, _ in self.mgr.scenarios], ['s01', 's03', 's05'])
+        self.assertIs(self.mgr.scenarios, self.mgr.scenarios)
+
+        revision = self.mgr.revision
+        self.mgr.add_scenario('s02', Scenario('s02'))
+        self.mgr.remove_scenario('s03')
+        self.assertEqual(self.mgr.revision, revision + 2)
+        self.assertEqual([id_ for id_, _ in self.mgr.scenarios], ['s01', 's02', 's05'])
+
+        self.mgr.update_scenario('s01', {'label': 'modified', 'actions': []})
+        self.assertEqual(self.mgr.scenarios[0][1].label, 'modified')
+
+    def test07_listeners(self):
+        notifications = []
+        self.mgr.add_listener(lambda what, id_: notifications.append((what, id_)))
+
+        self.mgr.add_scenario('s01', Scenario('scenario 1'))
+        self.mgr.add_scenario('s01', Scenario('scenario 1'))
+        self.mgr.update_scenario('s01', {'label': 'modified', 'actions': []})
+        self.mgr.remove_scenario('s01')
+        self.mgr.load_scenarios(self.SCENARIO_CFG_FILE_PATH)
+        self.assertListEqual(notifications, [
+            (ScenariosManager.SCENARIO_ADDED, 's01'),
+            (ScenariosManager.SCENARIO_UPDATED, 's01'),
+            (ScenariosManager.SCENARIO_UPDATED, 's01'),
+            (ScenariosManager.SCENARIO_REMOVED, 's01'),
+            (ScenariosManager.SCENARIOS_RELOADED, None),
+        ])
+
+    def test08_compact(self):
+        mgr = ScenariosManager(compact=True)
+        mgr.load_scenarios(self.SCENARIO_CFG_FILE_PATH)
+        self.mgr.load_scenarios(self.SCENARIO_CFG_FILE_PATH)
+
+        for scen_id, scenario in self.mgr.scenarios:
+            self.assertDictEqual(mgr.get_scenario(scen_id).as_dict(), scenario.as_dict())
+
+        d = mgr.get_scenario('s01').as_dict()
+        mgr.add_scenario('s03', Scenario.from_dict(d, mgr._pool))
+        self.assertIs(mgr.get_scenario('s03').actions[0], mgr.get_scenario('s01').actions[0])
+
+    def test09_batch(self):
+        self.mgr.load_scenarios(self.SCENARIO_CFG_FILE_PATH)
+        settings = self.mgr.get_scenario('s01').as_dict()
+        notifications = []
+        self.mgr.add_listener(lambda what, id_: notifications.append((what, id_)))
+        revision = self.mgr.revision
+
+        copies = {'s1%02d' % i: dict(settings, label='copy %d' % i) for i in range(20)}
+        modifications = self.mgr.apply_batch(
+            create=copies, update={'s01': dict(settings, label='modified')}, delete=['s02']
+        )
+        self.assertEqual(len(modifications), 22)
+        self.assertListEqual(notifications, modifications)
+        self.assertEqual(self.mgr.revision, revision + 1)
+        self.assertEqual(len(self.mgr.scenarios), 21)
+        self.assertEqual([id_ for id_, _ in self.mgr.scenarios], sorted(copies.keys() + ['s01']))
+        self.assertEqual(self.mgr.get_scenario('s01').label, 'modified')
+        self.assertDictEqual(self.mgr.export_scenarios(['s100'])['s100'], copies['s100'])
+
+        # invalid batches are not applied at all
+        revision = self.mgr.revision
+        for batch in ({'create': {'s03': settings}, 'delete': ['s02']},
+                      {'create': {'s01': settings}},
+                      {'update': {'s01': {'label': 'no actions'}}},
+                      {'update': {'s01': settings}, 'delete': ['s01']}):
+            self.assertRaises((KeyError, ValueError), self.mgr.apply_batch, **batch)
+        for batch in ({'delete': [['s02']]}, {'delete': [{}]}, {'delete': [2]}, {'create': {'': settings}}):
+            self.assertRaises(ValueError, self.mgr.apply_batch, **batch)
+        self.assertNotIn('s03', self.mgr)
+        self.assertEqual(self.mgr.revision, revision)
+
+    def test10_invalid_update(self):
+        self.mgr.load_scenarios(self.SCENARIO_CFG_FILE_PATH)
+        settings = self.mgr.get_scenario('s01').as_dict()
+        revision = self.mgr.revision
+        for action in ({'verb': 'switch', 'target': 5, 'data': 1}, {'verb': 'dim', 'target': 'x', 'data': 'abc'}):
+            self.assertRaises(ValueError, self.mgr.update_scenario, 's01', dict(settings, actions=[action]))
+        self.assertEqual(self.mgr.revision, revision)
+        self.assertDictEqual(self.mgr.get_scenario('s01').as_dict(), settings)
+
+
+class TestCompositeScenarios(BaseTestCase):
+    def setUp(self):
+        super(TestCompositeScenarios, self).setUp()
+        self.mgr = ScenariosManager()
+        self.mgr.add_scenario('lights_off', Scenario('lights off', [
+            BasicAction('switch', 'kitchen', 0), BasicAction('switch', 'living', 0)
+        ]))
+        self.mgr.add_scenario('shutters', Scenario('close shutters', [
+            BasicAction('shutter', 'living', 'close'), BasicAction('shutter', 'bedroom', 'close')
+        ], parallel=[False, True]))
+        self.mgr.add_scenario('goodnight', Scenario('goodnight', [
+            ScenarioRef('lights_off'), ScenarioRef('shutters'), BasicAction('switch', 'kitchen', 0)
+        ]))
+
+    def plan(self, id_):
+        return [(a.verb, a.target, a.data) for a in self.mgr.get_scenario(id_).plan]
+
+    def test01_settings(self):
+        settings = {
+            'label': 'goodnight',
+            'ui_verb': Scenario.DEFAULT_VERB,
+            'actions': [
+                {'scenario': 'lights_off', 'label': 'lights'},
+                {'verb': 'switch', 'target': 'hall', 'data': 0, 'label': 'hall', 'parallel': True}
+            ]
+        }
+        scenario = Scenario.from_dict(settings)
+        self.assertEqual(scenario.as_dict(), settings)
+        self.assertEqual(Scenario.from_record(scenario.as_record()).as_dict(), settings)
+        self.assertListEqual(scenario.references, ['lights_off'])
+        # references are resolved by the directory only
+        self.assertRaises(ValueError, lambda: scenario.plan)
+
+    def test02_flattened_plan(self):
+        # the final kitchen action is dropped, since requesting the state already requested
+        self.assertListEqual(self.plan('goodnight'), [
+            ('switch', 'kitchen', 0), ('switch', 'living', 0),
+            ('shutter', 'living', 'close'), ('shutter', 'bedroom', 'close')
+        ])
+        self.assertEqual([len(step) for step in self.mgr.get_scenario('goodnight').steps], [1, 1, 2])
+
+        evtmgr = MockUpEventManager()
+        self.mgr.get_scenario('goodnight').execute(evtmgr)
+        self.assertEqual(evtmgr.events_count, 4)
+
+    def test03_incremental_recompilation(self):
+        self.mgr.update_scenario('lights_off', {
+            'label': 'lights off', 'actions': [{'verb': 'switch', 'target': 'hall', 'data': 0}]
+        })
+        self.assertListEqual(self.plan('goodnight'), [
+            ('switch', 'hall', 0), ('shutter', 'living', 'close'), ('shutter', 'bedroom', 'close'),
+            ('switch', 'kitchen', 0)
+        ])
+        self.mgr.add_scenario('evening', Scenario('evening', [ScenarioRef('goodnight')]))
+        self.mgr.update_scenario('shutters', {'label': 'no shutters', 'actions': []})
+        self.assertListEqual(self.plan('evening'), [('switch', 'hall', 0), ('switch', 'kitchen', 0)])
+
+    def test04_invalid_references(self):
+        self.assertRaises(ValueError, self.mgr.update_scenario, 'lights_off', {
+            'label': 'cycle', 'actions': [{'scenario': 'goodnight'}]
+        })
+        self.assertRaises(ValueError, self.mgr.add_scenario, 'loop', Scenario('loop', [ScenarioRef('loop')]))
+        self.assertRaises(ValueError, self.mgr.add_scenario, 'dangling', Scenario('dangling', [ScenarioRef('s42')]))
+        self.assertRaises(ValueError, self.mgr.remove_scenario, 'shutters')
+        self.assertEqual(len(self.plan('goodnight')), 4)
+
+        # consistent batches are accepted
+        self.mgr.apply_batch(delete=['goodnight', 'shutters'])
+        self.assertEqual(len(self.mgr.scenarios), 1)
+
+    def test05_load(self):
+        path = '/tmp/scenarios-composite.cfg'
+        self.mgr.save_scenarios(path)
+        for lazy in (False, True):
+            mgr = ScenariosManager(lazy=lazy)
+            mgr.load_scenarios(path)
+            self.assertEqual(len(mgr.get_scenario('goodnight').plan), 4)
+
+    def test06_lazy_references(self):
+        path = '/tmp/scenarios-composite-lazy.cfg'
+        self.mgr.add_scenario('weekend', Scenario('weekend', [ScenarioRef('goodnight')]))
+        self.mgr.add_scenario('unused', Scenario('unused', [BasicAction('switch', 'garage', 0)]))
+        self.mgr.save_scenarios(path)
+
+        mgr = ScenariosManager(lazy=True)
+        mgr.load_scenarios(path)
+        self.assertEqual(mgr._scenarios.loaded_count, 0)
+        # the composite scenarios depending on them have not been used yet
+        self.assertRaises(ValueError, mgr.remove_scenario, 'shutters')
+        self.assertRaises(ValueError, mgr.remove_scenario, 'goodnight')
+        self.assertRaises(ValueError, mgr.apply_batch, delete=['lights_off'])
+        mgr.remove_scenario('unused')
+        self.assertEqual(len(mgr.get_scenario('weekend').plan), 4)
+
 
 class MockUpEventManager(Loggable):
     def __init__(self):
@@ -161,5 +457,22 @@ class MockUpEventManager(Loggable):
         self.last_event = (var_type, var_name, data)
 
 
+class BatchingMockUpEventManager(MockUpEventManager):
+    """ An event manager supporting batches, and counting the IPC round trips.
+    """
+    def __init__(self):
+        super(BatchingMockUpEventManager, self).__init__()
+        self.round_trips = 0
+
+    def emitEvent(self, var_type, var_name, data):
+        self.round_trips += 1
+        super(BatchingMockUpEventManager, self).emitEvent(var_type, var_name, data)
+
+    def emitEvents(self, events):
+        self.round_trips += 1
+        for var_type, var_name, data in events:
+            super(BatchingMockUpEventManager, self).emitEvent(var_type, var_name, data)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+
+from pycstbox.homeautomation.core import Scenario, BasicAction
+from pycstbox.homeautomation.execution import ScenarioExecutor, ExecutionJob
+from pycstbox.homeautomation.devicestate import DeviceStateCache, decode_value
+
+from test_core import BaseTestCase
+from test_execution import RecordingEventManager
+from test_triggers import SignalingEventManager
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeviceStateCache(BaseTestCase):
+    def setUp(self):
+        super(TestDeviceStateCache, self).setUp()
+        self.clock = FakeClock()
+        self.cache = DeviceStateCache(clock=self.clock)
+
+    def test01_decode(self):
+        self.assertEqual(decode_value('{"value": 1, "unit": "%"}'), 1)
+        self.assertEqual(decode_value('"on"'), 'on')
+        self.assertIsNone(decode_value(''))
+        self.assertRaises(ValueError, decode_value, '{')
+
+    def test02_states(self):
+        on = BasicAction('switch', 'kitchen', 1).as_event()
+        self.assertFalse(self.cache.is_in_state(*on))
+        self.cache.record_events([on])
+        self.assertEqual(self.cache.get('switch', 'kitchen'), 1)
+        self.assertTrue(self.cache.is_in_state(*on))
+        self.assertFalse(self.cache.is_in_state(*BasicAction('switch', 'kitchen', 0).as_event()))
+        self.assertEqual(self.cache.hits_count, 1)
+
+        # failed emissions don't change the known state
+        self.cache.trace_emission([BasicAction('switch', 'kitchen', 0).as_event()], 0, 'timeout')
+        self.assertEqual(self.cache.get('switch', 'kitchen'), 1)
+
+    def test03_max_age(self):
+        cache = DeviceStateCache(max_age=10, clock=self.clock)
+        cache.update('switch', 'kitchen', 1)
+        self.clock.now = 10
+        self.assertEqual(cache.get('switch', 'kitchen'), 1)
+        self.clock.now = 10.5
+        self.assertIsNone(cache.get('switch', 'kitchen'))
+
+    def test04_bus_events(self):
+        evtmgr = SignalingEventManager()
+        self.cache.attach(evtmgr)
+        evtmgr.emit('switch', 'kitchen', 1)
+        self.assertTrue(self.cache.is_in_state(*BasicAction('switch', 'kitchen', 1).as_event()))
+
+
+class TestSkippedActions(BaseTestCase):
+    def setUp(self):
+        super(TestSkippedActions, self).setUp()
+        self.evtmgr = RecordingEventManager()
+        self.cache = DeviceStateCache()
+        self.scenario = Scenario('leave home', actions=[
+            BasicAction('switch', 'kitchen', 0),
+            BasicAction('switch', 'living', 0),
+            BasicAction('switch', 'hall', 0)
+        ], parallel=[False, True, False])
+
+    def test01_execute(self):
+        self.cache.update('switch', 'living', 0)
+        self.cache.update('switch', 'hall', 1)
+        progress, skipped = [], []
+        self.scenario.execute(
+            self.evtmgr, progress=lambda i, a, e: progress.append(i),
+            state_cache=self.cache, on_skip=lambda i, a: skipped.append(i)
+        )
+        self.assertListEqual([e[1] for e in self.evtmgr.events], ['kitchen', 'hall'])
+        self.assertListEqual(progress, [0, 2])
+        self.assertListEqual(skipped, [1])
+
+        del self.evtmgr.events[:]
+        self.scenario.execute(self.evtmgr, state_cache=self.cache, force=True)
+        self.assertEqual(len(self.evtmgr.events), 3)
+
+    def test02_filter_steps(self):
+        steps = [(0, 2), (2, 3), (3, 6)]
+        self.assertListEqual(Scenario._filter_steps(steps, [1, 3, 5]), [(0, 1), (1, 3)])
+        self.assertListEqual(Scenario._filter_steps(steps, [2]), [(0, 1)])
+        self.assertIsNone(Scenario._filter_steps(None, [0]))
+
+    def test03_executor(self):
+        executor = ScenarioExecutor(self.evtmgr, state_cache=self.cache)
+        try:
+            job = executor.submit('s01', self.scenario)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(self.evtmgr.events_count, 3)
+
+            # the states set by the first execution are known by now
+            job = executor.submit('s01', self.scenario)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(self.evtmgr.events_count, 3)
+            self.assertEqual(job.status, ExecutionJob.DONE)
+            self.assertTrue(all(a['status'] == ExecutionJob.SKIPPED for a in job.as_dict()['actions']))
+
+            job = executor.submit('s01', self.scenario, force=True)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(self.evtmgr.events_count, 6)
+        finally:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
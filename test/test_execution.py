@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import json
+
+from pycstbox.homeautomation.core import Scenario, BasicAction, EventEmitter
+from pycstbox.homeautomation.execution import ScenarioExecutor, ExecutionJob, ActionCoalescer
+
+from test_core import BaseTestCase, MockUpEventManager
+
+
+class FailingEventManager(MockUpEventManager):
+    def __init__(self, failing_target):
+        super(FailingEventManager, self).__init__()
+        self.failing_target = failing_target
+
+    def emitEvent(self, var_type, var_name, data):
+        if var_name == self.failing_target:
+            raise IOError('cannot reach %s' % var_name)
+        super(FailingEventManager, self).emitEvent(var_type, var_name, data)
+
+
+class RecordingEventManager(MockUpEventManager):
+    def __init__(self):
+        super(RecordingEventManager, self).__init__()
+        self.events = []
+
+    def emitEvent(self, var_type, var_name, data):
+        super(RecordingEventManager, self).emitEvent(var_type, var_name, data)
+        self.events.append((var_type, var_name, data))
+
+
+class TestScenarioExecutor(BaseTestCase):
+    def setUp(self):
+        super(TestScenarioExecutor, self).setUp()
+        self.scenario = Scenario('scenario 1', actions=[
+            BasicAction('switch', 'kitchen', 0),
+            BasicAction('switch', 'living', 0),
+            BasicAction('dim', 'bedroom', 50),
+        ])
+
+    def test01_submit(self):
+        evtmgr = MockUpEventManager()
+        executor = ScenarioExecutor(evtmgr)
+        try:
+            job = executor.submit('s01', self.scenario)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(job.status, ExecutionJob.DONE)
+            self.assertEqual(evtmgr.events_count, 3)
+
+            status = executor.get_job(job.id).as_dict()
+            self.assertEqual(status['scenario'], 's01')
+            self.assertEqual([a['status'] for a in status['actions']], [ExecutionJob.DONE] * 3)
+        finally:
+            executor.shutdown()
+
+    def test02_failure(self):
+        executor = ScenarioExecutor(FailingEventManager('living'))
+        try:
+            job = executor.submit('s01', self.scenario)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(job.status, ExecutionJob.FAILED)
+
+            status = job.as_dict()
+            self.assertEqual(
+                [a['status'] for a in status['actions']],
+                [ExecutionJob.DONE, ExecutionJob.FAILED, ExecutionJob.PENDING]
+            )
+        finally:
+            executor.shutdown()
+
+    def test03_notifications(self):
+        executor = ScenarioExecutor(MockUpEventManager())
+        notifications = []
+        executor.add_listener(lambda what, job, details: notifications.append((what, details)))
+        try:
+            executor.submit('s01', self.scenario).wait(5)
+            self.assertEqual(
+                [what for what, _ in notifications],
+                [ExecutionJob.STARTED] + [ExecutionJob.ACTION_DONE] * 3 + [ExecutionJob.FINISHED]
+            )
+            self.assertEqual(notifications[1][1]['index'], 0)
+            self.assertEqual(notifications[-1][1]['status'], ExecutionJob.DONE)
+        finally:
+            executor.shutdown()
+
+    def test04_jobs_purge(self):
+        executor = ScenarioExecutor(MockUpEventManager(), workers=1, max_jobs=5)
+        try:
+            jobs = [executor.submit('s01', self.scenario) for _ in range(10)]
+            for job in jobs:
+                job.wait(5)
+            executor.submit('s01', self.scenario).wait(5)
+            self.assertRaises(KeyError, executor.get_job, jobs[0].id)
+            self.assertIsNotNone(executor.get_job(jobs[-1].id))
+        finally:
+            executor.shutdown()
+
+
+class TestActionCoalescer(BaseTestCase):
+    def setUp(self):
+        super(TestActionCoalescer, self).setUp()
+        self.now = 1000.
+        self.evtmgr = RecordingEventManager()
+        self.coalescer = ActionCoalescer(EventEmitter(self.evtmgr), window=10, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.coalescer.flush()
+        super(TestActionCoalescer, self).tearDown()
+
+    def sent(self):
+        return [(e[1], json.loads(e[2])['value']) for e in self.evtmgr.events]
+
+    def test01_coalescing(self):
+        events = lambda *values: [BasicAction('dim', t, v).as_event() for t, v in values]
+
+        self.coalescer.emitEvents(events(('kitchen', 50), ('living', 20)))
+        self.assertListEqual(self.sent(), [('kitchen', 50), ('living', 20)])
+
+        # repeats are dropped, changes are held
+        self.coalescer.emitEvents(events(('kitchen', 50), ('living', 30), ('bedroom', 0)))
+        self.coalescer.emitEvents(events(('living', 40)))
+        self.assertListEqual(self.sent()[2:], [('bedroom', 0)])
+        self.assertEqual(self.coalescer.held_count, 1)
+
+        # only the last value of a held event is sent
+        self.coalescer.flush()
+        self.assertListEqual(self.sent()[3:], [('living', 40)])
+        self.assertEqual(
+            (self.coalescer.sent_count, self.coalescer.dropped_count, self.coalescer.coalesced_count), (4, 1, 1)
+        )
+
+        # held events going back to the value last sent are dropped
+        self.coalescer.emitEvents(events(('kitchen', 60), ('kitchen', 50)))
+        self.coalescer.flush()
+        self.assertEqual(len(self.sent()), 4)
+
+        # past the window, events are forwarded again
+        self.now += 11
+        self.coalescer.emitEvents(events(('kitchen', 50)))
+        self.assertListEqual(self.sent()[4:], [('kitchen', 50)])
+
+    def test02_concurrent_executions(self):
+        executor = ScenarioExecutor(self.evtmgr, workers=2, coalesce_window=0.2)
+        try:
+            leave_home = Scenario('leave home', actions=[
+                BasicAction('switch', 'kitchen', 0),
+                BasicAction('switch', 'living', 0),
+            ])
+            night_mode = Scenario('night mode', actions=[
+                BasicAction('switch', 'living', 0),
+                BasicAction('dim', 'bedroom', 10),
+            ])
+            jobs = [executor.submit('s01', leave_home), executor.submit('s02', night_mode)]
+            for job in jobs:
+                self.assertTrue(job.wait(5))
+                self.assertEqual(job.status, ExecutionJob.DONE)
+        finally:
+            executor.shutdown()
+        self.assertEqual(self.evtmgr.events_count, 3)
+        self.assertEqual(executor.coalescer.dropped_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import email.utils
+import httplib
+import json
+import time
+
+try:
+    import tornado.web
+except ImportError:
+    tornado = None
+
+from pycstbox.homeautomation.history import ExecutionHistory
+
+from test_storage import StorageTestCase
+from simulation import SimulatedEventManager, LocalService
+
+
+@unittest.skipIf(tornado is None, 'Tornado is not available')
+class HandlersTestCase(StorageTestCase):
+    """ Runs the requests handlers on a local server, using a copy of the fixture
+    configuration file.
+    """
+    manager_options = None
+
+    def setUp(self):
+        super(HandlersTestCase, self).setUp()
+        self.service = LocalService(self.path, SimulatedEventManager(), self.manager_options)
+        self.service.start()
+        self.conn = httplib.HTTPConnection('127.0.0.1', self.service.port)
+
+    def tearDown(self):
+        self.conn.close()
+        self.service.stop()
+        super(HandlersTestCase, self).tearDown()
+
+    def request(self, method, url, body=None, headers=None):
+        """ Sends a request and returns the status, the headers and the decoded JSON
+        content of the reply.
+        """
+        self.conn.request(method, url, body=json.dumps(body) if body is not None else None, headers=headers or {})
+        reply = self.conn.getresponse()
+        data = reply.read()
+        return reply.status, dict(reply.getheaders()), json.loads(data) if data else None
+
+    def edit_file(self, func):
+        with open(self.path, 'rt') as fp:
+            data = json.load(fp)
+        func(data)
+        with open(self.path, 'wt') as fp:
+            json.dump(data, fp, indent=4)
+
+
+class TestReload(HandlersTestCase):
+    def test01_file_edited(self):
+        status, headers, data = self.request('GET', '/scenarios')
+        self.assertEqual(status, 200)
+        etag = headers['etag']
+
+        self.edit_file(lambda data: data['s01'].update(label='edited on disk'))
+        status, headers, data = self.request('GET', '/scenarios', headers={'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['etag'], etag)
+        labels = {s['id']: s['label'] for s in data['scenarios']}
+        self.assertEqual(labels['s01'], 'edited on disk')
+
+        status, _, data = self.request('GET', '/scenario/s01/settings')
+        self.assertEqual(data['label'], 'edited on disk')
+
+
+class TestConditionalRequests(HandlersTestCase):
+    def test01_if_modified_since(self):
+        mgr = self.service.scenarios_mgr
+        mgr._last_modified = time.time() - 10
+        status, headers, _ = self.request('GET', '/scenarios')
+        last_modified = headers['last-modified']
+        status, _, _ = self.request('GET', '/scenarios', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(status, 304)
+
+        _, _, settings = self.request('GET', '/scenario/s01/settings')
+        self.request('PUT', '/scenario/s01/settings', dict(settings, label='modified'))
+        status, _, _ = self.request('GET', '/scenarios', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(status, 200)
+
+    def test02_same_second(self):
+        # modifications made during the current second can't be told apart by their date
+        mgr = self.service.scenarios_mgr
+        mgr._last_modified = time.time() + 60
+        date = email.utils.formatdate(int(mgr.last_modified), usegmt=True)
+        status, headers, _ = self.request('GET', '/scenarios', headers={'If-Modified-Since': date})
+        self.assertEqual(status, 200)
+        self.assertNotIn('last-modified', headers)
+        status, _, _ = self.request('GET', '/scenarios', headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, 304)
+
+
+class TestSettings(HandlersTestCase):
+    def test01_invalid_actions(self):
+        _, _, settings = self.request('GET', '/scenario/s01/settings')
+        for action in ({'verb': 'switch', 'target': 5, 'data': 1}, {'verb': 'dim', 'target': 'x', 'data': 'abc'}):
+            status, _, _ = self.request('PUT', '/scenario/s01/settings', dict(settings, actions=[action]))
+            self.assertEqual(status, 400)
+            status, _, _ = self.request('POST', '/scenarios/batch', {'update': {'s01': dict(settings, actions=[action])}})
+            self.assertEqual(status, 400)
+
+        status, _, data = self.request('GET', '/scenario/s01/settings')
+        self.assertEqual(status, 200)
+        self.assertDictEqual(data, settings)
+
+
+    def test02_delete_referenced(self):
+        composite = {'label': 'composite', 'actions': [{'scenario': 's01'}]}
+        status, _, _ = self.request('POST', '/scenarios/batch', {'create': {'s03': composite}})
+        self.assertEqual(status, 200)
+
+        status, _, data = self.request('DELETE', '/scenario/s01/settings')
+        self.assertEqual(status, 409)
+        self.assertIn('s03', data['message'])
+        status, _, _ = self.request('GET', '/scenario/s01/settings')
+        self.assertEqual(status, 200)
+
+        self.request('DELETE', '/scenario/s03/settings')
+        status, _, _ = self.request('DELETE', '/scenario/s01/settings')
+        self.assertEqual(status, 200)
+
+
+class TestBatch(HandlersTestCase):
+    def test01_invalid_ids(self):
+        for batch in ({'delete': [['s01']]}, {'delete': [{}]}, {'delete': [1]}, {'update': {'': {}}}):
+            status, _, data = self.request('POST', '/scenarios/batch', batch)
+            self.assertEqual(status, 400)
+            self.assertIn('ids must be non empty strings', data['message'])
+
+        status, _, data = self.request('GET', '/scenarios/batch')
+        self.assertListEqual(sorted(data['scenarios']), ['s01', 's02'])
+
+
+class TestHistory(HandlersTestCase):
+    def test01_unknown_scenario(self):
+        from pycstbox.webservices.services import homeautomation as ws
+        ws._handlers_initparms['history'] = ExecutionHistory()
+        try:
+            status, _, data = self.request('GET', '/scenario/s01/history')
+            self.assertEqual(status, 200)
+            self.assertListEqual(data['executions'], [])
+            status, _, _ = self.request('GET', '/scenario/s42/history')
+            self.assertEqual(status, 404)
+        finally:
+            del ws._handlers_initparms['history']
+
+
+class TestTargets(HandlersTestCase):
+    def test01_invalid_rename(self):
+        _, _, settings = self.request('GET', '/scenario/s01/settings')
+        target = settings['actions'][0]['target']
+        for body in ({'target': 5}, {'target': ''}, {'target': None}, {}):
+            status, _, _ = self.request('POST', '/target/%s/rename' % target, body)
+            self.assertEqual(status, 400)
+
+        status, _, data = self.request('GET', '/scenario/s01/settings')
+        self.assertEqual(status, 200)
+        self.assertDictEqual(data, settings)
+
+
+class TestLazyLoading(HandlersTestCase):
+    manager_options = {'lazy': True}
+
+    def test01_listing(self):
+        status, _, data = self.request('GET', '/scenarios')
+        self.assertEqual(status, 200)
+        self.assertListEqual(sorted(s['id'] for s in data['scenarios']), ['s01', 's02'])
+        self.assertEqual(self.service.scenarios_mgr._scenarios.loaded_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
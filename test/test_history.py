@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from pycstbox.homeautomation.core import Scenario, BasicAction
+from pycstbox.homeautomation.execution import ScenarioExecutor, ExecutionJob
+from pycstbox.homeautomation.history import ExecutionHistory, ExecutionRecord, SpillFile, _reversed_lines
+
+from test_core import BaseTestCase
+from test_execution import RecordingEventManager
+
+
+def make_record(n, scen_id='s01'):
+    return ExecutionRecord('job%03d' % n, scen_id, float(n), n + 0.5, ExecutionJob.DONE)
+
+
+class TestExecutionHistory(BaseTestCase):
+    def setUp(self):
+        super(TestExecutionHistory, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test01_record_job(self):
+        evtmgr = RecordingEventManager()
+        history = ExecutionHistory()
+        executor = ScenarioExecutor(evtmgr)
+        executor.add_listener(history.on_execution_progress)
+        scenario = Scenario('scenario 1', actions=[
+            BasicAction('switch', 'kitchen', 0),
+            BasicAction('dim', 'bedroom', 50),
+        ])
+        try:
+            job = executor.submit('s01', scenario)
+            self.assertTrue(job.wait(5))
+        finally:
+            executor.shutdown()
+
+        executions, more = history.query('s01')
+        self.assertFalse(more)
+        self.assertEqual(len(executions), 1)
+        execution = executions[0]
+        self.assertEqual(execution['job'], job.id)
+        self.assertEqual(execution['status'], ExecutionJob.DONE)
+        self.assertAlmostEqual(execution['duration'], job.duration, places=6)
+        self.assertListEqual([a['status'] for a in execution['actions']], [ExecutionJob.DONE] * 2)
+        self.assertTrue(all(a['duration'] >= 0 for a in execution['actions']))
+        self.assertListEqual(history.query('s02')[0], [])
+
+    def test02_ring(self):
+        history = ExecutionHistory(capacity=10)
+        for n in range(25):
+            history.record(make_record(n, 's01' if n % 2 else 's02'))
+        self.assertEqual(len(history), 10)
+
+        executions, more = history.query(limit=3)
+        self.assertListEqual([e['job'] for e in executions], ['job024', 'job023', 'job022'])
+        self.assertTrue(more)
+        executions, more = history.query('s01', offset=3, limit=3)
+        self.assertListEqual([e['job'] for e in executions], ['job017', 'job015'])
+        self.assertFalse(more)
+
+    def test03_spill(self):
+        path = os.path.join(self.tmpdir, 'history.log')
+        history = ExecutionHistory(capacity=5, spill=SpillFile(path, max_size=1000, segments=2))
+        for n in range(40):
+            history.record(make_record(n))
+        self.assertTrue(os.path.exists(path + '.1'))
+        self.assertFalse(os.path.exists(path + '.2'))
+
+        # pages continue from memory to disk without gap nor overlap
+        jobs = []
+        offset, more = 0, True
+        while more:
+            executions, more = history.query('s01', offset=offset, limit=4)
+            jobs.extend(e['job'] for e in executions)
+            offset += 4
+        expected = ['job%03d' % n for n in range(39, -1, -1)][:len(jobs)]
+        self.assertListEqual(jobs, expected)
+        self.assertGreater(len(jobs), 5)
+        self.assertLess(len(jobs), 40)
+
+    def test05_reversed_lines(self):
+        path = os.path.join(self.tmpdir, 'lines')
+        lines = ['line %d %s' % (n, 'x' * n) for n in range(30)]
+        with open(path, 'wb') as fp:
+            fp.write('\n'.join(lines) + '\n\npartial')
+        with open(path, 'rb') as fp:
+            self.assertListEqual(list(_reversed_lines(fp, block_size=7)), ['partial'] + lines[::-1])
+
+    def test06_record_while_querying(self):
+        path = os.path.join(self.tmpdir, 'history.log')
+        history = ExecutionHistory(capacity=5, spill=SpillFile(path))
+        for n in range(10):
+            history.record(make_record(n))
+
+        # executions are recorded while the spill file is read, evicting records from
+        # the queried snapshot
+        iter_records = history.spill.iter_records
+
+        def recording_iter():
+            for n in range(10, 13):
+                history.record(make_record(n))
+            return iter_records()
+
+        history.spill.iter_records = recording_iter
+        executions, more = history.query(limit=20)
+        self.assertListEqual([e['job'] for e in executions], ['job%03d' % n for n in range(9, -1, -1)])
+        self.assertFalse(more)
+
+    def test04_action_details(self):
+        record = ExecutionRecord(
+            'job', 's01', 100., 100.5, ExecutionJob.FAILED, error='x' * 500,
+            outcomes='dsf-', errors=((2, 'timeout'),)
+        )
+        record.offsets.extend([0.1, 0.1, 0.4, -1])
+        d = record.as_dict()
+        self.assertEqual(len(d['error']), 200)
+        self.assertListEqual(
+            [(a['status'], a['duration'], a['error']) for a in d['actions']],
+            [(ExecutionJob.DONE, 0.1, None), (ExecutionJob.SKIPPED, 0., None),
+             (ExecutionJob.FAILED, 0.3, 'timeout'), (ExecutionJob.PENDING, None, None)]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+
+from pycstbox.homeautomation.core import Scenario, ScenariosManager, BasicAction, ScenarioRef
+from pycstbox.homeautomation.index import ActionsIndex
+
+from test_core import BaseTestCase
+from test_storage import StorageTestCase
+
+
+class TestActionsIndex(BaseTestCase):
+    def test01_index(self):
+        index = ActionsIndex()
+        index.add('s01', [('switch', 'kitchen'), ('dim', 'living'), ('switch', 'kitchen')])
+        index.add('s02', [None, ('switch', 'kitchen')])
+        self.assertEqual(len(index), 2)
+        self.assertDictEqual(index.by_target('kitchen'), {'s01': [0, 2], 's02': [1]})
+        self.assertListEqual(index.by_verb('switch'), ['s01', 's02'])
+        self.assertListEqual(index.targets(), ['kitchen', 'living'])
+
+        index.add('s01', [('dim', 'living')])
+        self.assertDictEqual(index.by_target('kitchen'), {'s02': [1]})
+        index.remove('s02')
+        self.assertDictEqual(index.by_target('kitchen'), {})
+        self.assertListEqual(index.by_verb('switch'), [])
+        self.assertListEqual(index.targets(), ['living'])
+
+
+class TestScenariosManagerIndex(StorageTestCase):
+    def setUp(self):
+        super(TestScenariosManagerIndex, self).setUp()
+        self.mgr = ScenariosManager()
+        self.mgr.load_scenarios(self.path)
+        self.settings = self.mgr.get_scenario('s01').as_dict()
+        self.target = self.settings['actions'][0]['target']
+
+    def test01_incremental(self):
+        usages = self.mgr.find_target(self.target)
+        self.assertIn('s01', usages)
+
+        self.mgr.add_scenario('s10', Scenario('s10', [
+            ScenarioRef('s01'), BasicAction('shutter', 'hall', 'close')
+        ]))
+        self.assertDictEqual(self.mgr.find_target('hall'), {'s10': [1]})
+        self.assertListEqual(self.mgr.find_verb('shutter'), ['s10'])
+
+        self.mgr.remove_scenario('s10')
+        self.assertDictEqual(self.mgr.find_target('hall'), {})
+        self.mgr.apply_batch(create={'s11': self.settings})
+        self.assertListEqual(self.mgr.find_target(self.target)['s11'], usages['s01'])
+
+    def test02_rename(self):
+        usages = self.mgr.find_target(self.target)
+        writes = []
+        write_changes = self.mgr._store.write_changes
+        self.mgr._store.write_changes = \
+            lambda changes, get_all: writes.append(changes) or write_changes(changes, get_all)
+
+        revision = self.mgr.revision
+        modified = self.mgr.rename_target(self.target, 'new_device')
+        self.mgr.save_changes()
+        self.assertListEqual(modified, sorted(usages))
+        self.assertEqual(self.mgr.revision, revision + 1)
+        self.assertEqual(len(writes), 1)
+        self.assertDictEqual(self.mgr.find_target(self.target), {})
+        self.assertDictEqual(self.mgr.find_target('new_device'), usages)
+
+        other = ScenariosManager(lazy=True)
+        other.load_scenarios(self.path)
+        self.assertDictEqual(other.find_target('new_device'), usages)
+        self.assertEqual(other.get_scenario('s01').actions[usages['s01'][0]].target, 'new_device')
+
+    def test03_invalid_rename(self):
+        revision = self.mgr.revision
+        for new_target in ('', None, 5, ['x']):
+            self.assertRaises(ValueError, self.mgr.rename_target, self.target, new_target)
+        self.assertEqual(self.mgr.revision, revision)
+        self.assertIn('s01', self.mgr.find_target(self.target))
+
+
+if __name__ == '__main__':
+    unittest.main()
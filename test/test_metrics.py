@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+
+from pycstbox.homeautomation.core import Scenario, BasicAction, EventEmitter
+from pycstbox.homeautomation.execution import ScenarioExecutor
+from pycstbox.homeautomation.metrics import MetricsRegistry, HomeAutomationMetrics
+from pycstbox.homeautomation.devicestate import DeviceStateCache
+
+from test_core import BaseTestCase, MockUpEventManager, BatchingMockUpEventManager
+
+
+class TestMetrics(BaseTestCase):
+    def test01_render(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('events_total', 'Events.', ('kind',))
+        histogram = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        registry.gauge('depth', 'Depth.', lambda: 3)
+        registry.counter_func('sent_total', 'Sent.', lambda: 7)
+
+        counter.labels('a"b').inc()
+        counter.labels('a"b').inc(2)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE events_total counter', lines)
+        self.assertIn('events_total{kind="a\\"b"} 3.0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_count 3', lines)
+        self.assertIn('depth 3.0', lines)
+        self.assertIn('# TYPE sent_total counter', lines)
+        self.assertIn('sent_total 7.0', lines)
+
+    def test02_hooks(self):
+        ha_metrics = HomeAutomationMetrics()
+        scenario = Scenario('scenario 1', actions=[
+            BasicAction('switch', 'kitchen', 0),
+            BasicAction('switch', 'living', 0),
+        ])
+
+        scenario.execute(EventEmitter(MockUpEventManager(), tracer=ha_metrics.trace_emission))
+        self.assertEqual(ha_metrics.action_duration.labels('switch', 'kitchen').count, 1)
+
+        scenario.execute(EventEmitter(BatchingMockUpEventManager(), tracer=ha_metrics.trace_emission))
+        self.assertEqual(ha_metrics.batch_duration.labels().count, 1)
+        self.assertEqual(ha_metrics.action_duration.labels('switch', 'kitchen').count, 2)
+        self.assertEqual(ha_metrics.action_duration.labels('switch', 'living').count, 2)
+
+        executor = ScenarioExecutor(MockUpEventManager(), tracer=ha_metrics.trace_emission)
+        executor.add_listener(ha_metrics.on_execution_progress)
+        ha_metrics.track_queue_depth(executor)
+        try:
+            executor.submit('s01', scenario).wait(5)
+        finally:
+            executor.shutdown()
+        self.assertEqual(ha_metrics.executions.labels('s01', 'done').value, 1)
+        self.assertIn('homeautomation_execution_queue_depth 0.0', ha_metrics.registry.render().splitlines())
+
+    def test03_tracked_counts(self):
+        ha_metrics = HomeAutomationMetrics()
+        ha_metrics.track_coalescer(Counts(sent_count=5, dropped_count=2, coalesced_count=1, held_count=3))
+        lines = ha_metrics.registry.render().splitlines()
+        for name in ('sent_events', 'dropped_events', 'coalesced_events'):
+            self.assertIn('# TYPE homeautomation_coalescer_%s_total counter' % name, lines)
+        self.assertIn('homeautomation_coalescer_sent_events_total 5.0', lines)
+        self.assertIn('# TYPE homeautomation_coalescer_held_events gauge', lines)
+
+        ha_metrics.track_rate_limiter(Counts(queue_depth=4, sent_count=10, dropped_count=1))
+        lines = ha_metrics.registry.render().splitlines()
+        self.assertIn('# TYPE homeautomation_rate_limiter_sent_events_total counter', lines)
+        self.assertIn('homeautomation_rate_limiter_dropped_events_total 1.0', lines)
+        self.assertIn('# TYPE homeautomation_rate_limiter_queue_depth gauge', lines)
+
+        ha_metrics.track_state_cache(DeviceStateCache())
+        lines = ha_metrics.registry.render().splitlines()
+        self.assertIn('# TYPE homeautomation_state_cache_skipped_actions_total counter', lines)
+        self.assertIn('homeautomation_state_cache_devices 0.0', lines)
+
+
+class Counts(object):
+    """ Stands for the components whose counts are tracked.
+    """
+    def __init__(self, **counts):
+        self.__dict__.update(counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
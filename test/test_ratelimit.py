@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import threading
+import time
+
+from pycstbox.homeautomation.core import EventEmitter, BasicAction, Scenario
+from pycstbox.homeautomation.execution import ScenarioExecutor, ExecutionJob
+from pycstbox.homeautomation.ratelimit import TokenBucket, RateLimiter
+
+from test_core import BaseTestCase
+from test_execution import RecordingEventManager
+
+
+class TimestampingEventManager(RecordingEventManager):
+    def __init__(self):
+        super(TimestampingEventManager, self).__init__()
+        self.times = []
+
+    def emitEvent(self, var_type, var_name, data):
+        super(TimestampingEventManager, self).emitEvent(var_type, var_name, data)
+        self.times.append(time.time())
+
+
+class TestTokenBucket(BaseTestCase):
+    def test01_bucket(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        for _ in range(3):
+            self.assertEqual(bucket.delay(0), 0)
+            bucket.consume(0)
+        self.assertAlmostEqual(bucket.delay(0), 0.5)
+        self.assertAlmostEqual(bucket.delay(0.25), 0.25)
+        self.assertEqual(bucket.delay(0.5), 0)
+        # refilling is capped by the burst size
+        bucket.consume(0.5)
+        self.assertEqual(bucket.delay(100), 0)
+        for _ in range(3):
+            bucket.consume(100)
+        self.assertGreater(bucket.delay(100), 0)
+
+
+class TestRateLimiter(BaseTestCase):
+    def setUp(self):
+        super(TestRateLimiter, self).setUp()
+        self.evtmgr = TimestampingEventManager()
+        self.limiter = None
+
+    def tearDown(self):
+        if self.limiter:
+            self.limiter.close(drain=False)
+        super(TestRateLimiter, self).tearDown()
+
+    @staticmethod
+    def events(target, count, verb='switch'):
+        return [BasicAction(verb, target, i % 2).as_event() for i in range(count)]
+
+    def test01_smoothing(self):
+        self.limiter = RateLimiter(EventEmitter(self.evtmgr), target_rate=50, target_burst=2)
+        self.limiter.emitEvents(self.events('kitchen', 6) + self.events('living', 2))
+        self.limiter.close()
+
+        self.assertEqual(self.limiter.sent_count, 8)
+        kitchen = [t for (_, target, _), t in zip(self.evtmgr.events, self.evtmgr.times) if target == 'kitchen']
+        # 2 events sent at once, then one every 20ms
+        self.assertGreaterEqual(kitchen[-1] - kitchen[0], 0.07)
+        # events of other targets are not delayed by the kitchen ones
+        self.assertEqual([target for _, target, _ in self.evtmgr.events[:4]].count('living'), 2)
+        # order is preserved for a given target
+        self.assertEqual([e[2] for e in self.evtmgr.events if e[1] == 'kitchen'],
+                         [e[2] for e in self.events('kitchen', 6)])
+
+    def test02_verb_rate(self):
+        self.limiter = RateLimiter(
+            EventEmitter(self.evtmgr), target_rate=1000, target_burst=10, verb_rates={'dim': (50, 1)}
+        )
+        t0 = time.time()
+        self.limiter.emitEvents([BasicAction('dim', 'd%d' % i, 50).as_event() for i in range(5)])
+        self.limiter.close()
+        self.assertGreaterEqual(time.time() - t0, 0.07)
+        self.assertEqual(self.evtmgr.events_count, 5)
+
+    def test03_bounded_queues(self):
+        self.limiter = RateLimiter(EventEmitter(self.evtmgr), target_rate=0.01, target_burst=1, max_queue=2)
+        self.limiter.emitEvents(self.events('kitchen', 1))
+        time.sleep(0.05)
+        self.limiter.emitEvents(self.events('kitchen', 3))
+        self.assertEqual(self.limiter.dropped_count, 1)
+        self.assertEqual(self.limiter.queue_depths(), {'kitchen': 2})
+
+        self.limiter.close(drain=False)
+        self.assertEqual(self.evtmgr.events_count, 1)
+        self.assertEqual(self.limiter.dropped_count, 3)
+
+    def test04_back_pressure(self):
+        self.limiter = RateLimiter(EventEmitter(self.evtmgr), target_rate=0.01, target_burst=1, max_pending=2)
+        errors = []
+
+        def produce():
+            try:
+                self.limiter.emitEvents(self.events('kitchen', 5))
+            except RuntimeError as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(self.limiter.queue_depth, 2)
+
+        self.limiter.close(drain=False)
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    def test05_executor(self):
+        executor = ScenarioExecutor(self.evtmgr, rate_limits={'target_rate': 100, 'target_burst': 1})
+        scenario = Scenario('big', actions=[BasicAction('switch', 'kitchen', i % 2) for i in range(5)])
+        try:
+            job = executor.submit('s01', scenario)
+            self.assertTrue(job.wait(5))
+            self.assertEqual(job.status, ExecutionJob.DONE)
+        finally:
+            executor.shutdown()
+        self.assertEqual(self.evtmgr.events_count, 5)
+        self.assertGreaterEqual(self.evtmgr.times[-1] - self.evtmgr.times[0], 0.035)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import calendar
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from pycstbox.homeautomation.core import Scenario, ScenariosManager, BasicAction
+from pycstbox.homeautomation.scheduling import CronRule, SunRule, Scheduler, parse_rule, sun_event
+
+from test_core import BaseTestCase
+
+
+def local_time(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class FakeIOLoop(object):
+    """ Runs callbacks immediately, and records timeouts instead of waiting for them.
+    """
+    def __init__(self):
+        self.timeouts = []
+
+    def add_callback(self, callback, *args):
+        callback(*args)
+
+    def add_timeout(self, deadline, callback):
+        handle = (deadline, callback)
+        self.timeouts.append(handle)
+        return handle
+
+    def remove_timeout(self, handle):
+        self.timeouts.remove(handle)
+
+
+class TestRules(BaseTestCase):
+    def test01_parse(self):
+        self.assertIsInstance(parse_rule({'cron': '*/5 * * * *'}), CronRule)
+        rule = parse_rule({'sun': 'sunset', 'offset': -15})
+        self.assertEqual(rule.as_dict(), {'sun': 'sunset', 'offset': -15})
+        for invalid in ({}, {'cron': '* * *'}, {'cron': '60 * * * *'}, {'cron': '*/0 * * * *'},
+                        {'sun': 'noon'}, {'sun': 'sunrise', 'offset': 'x'}, 'cron'):
+            self.assertRaises(ValueError, parse_rule, invalid)
+
+    def test02_cron_next(self):
+        # 2015-06-01 is a monday
+        start = local_time(2015, 6, 1, 7, 30)
+        rule = CronRule('30 7 * * 1-5')
+        self.assertEqual(rule.next_after(start), local_time(2015, 6, 2, 7, 30))
+        self.assertEqual(rule.next_after(local_time(2015, 6, 5, 8, 0)), local_time(2015, 6, 8, 7, 30))
+
+        self.assertEqual(CronRule('*/20 * * * *').next_after(start), local_time(2015, 6, 1, 7, 40))
+        self.assertEqual(CronRule('0 0 1 1 *').next_after(start), local_time(2016, 1, 1, 0, 0))
+        # day of month or day of week
+        self.assertEqual(CronRule('0 12 15 * 0').next_after(start), local_time(2015, 6, 7, 12, 0))
+        self.assertEqual(CronRule('0 0 29 2 *').next_after(start), local_time(2016, 2, 29, 0, 0))
+        self.assertIsNone(CronRule('0 0 30 2 *').next_after(start))
+
+    def test03_sun(self):
+        # Sophia Antipolis, where sunrise is at 03:51 UTC and sunset at 19:16 UTC on June 21st
+        location = (43.62, 7.05)
+        day = datetime.date(2015, 6, 21)
+        midnight = calendar.timegm(day.timetuple())
+        self.assertAlmostEqual((sun_event(day, location[0], location[1], True) - midnight) / 60, 231, delta=5)
+        self.assertAlmostEqual((sun_event(day, location[0], location[1], False) - midnight) / 60, 1156, delta=5)
+        # no sunset during the polar day
+        self.assertIsNone(sun_event(day, 80., 0., False))
+
+        rule = SunRule('sunset', -30)
+        self.assertIsNone(rule.next_after(midnight))
+        next_time = rule.next_after(midnight, location)
+        self.assertAlmostEqual((next_time - midnight) / 60, 1126, delta=5)
+        self.assertAlmostEqual((rule.next_after(next_time, location) - next_time) / 3600., 24, delta=0.1)
+
+    def test04_scenario_settings(self):
+        settings = {
+            'label': 'scheduled',
+            'ui_verb': Scenario.DEFAULT_VERB,
+            'actions': [{'verb': 'switch', 'target': 'kitchen', 'data': 1, 'label': 'on'}],
+            'schedule': [{'cron': '0 7 * * *'}, {'sun': 'sunrise'}]
+        }
+        scenario = Scenario.from_dict(settings)
+        self.assertEqual(len(scenario.schedule), 2)
+        self.assertEqual(scenario.as_dict(), settings)
+        self.assertEqual(Scenario.from_record(scenario.as_record()).as_dict(), settings)
+        self.assertNotIn('schedule', Scenario('no schedule', [BasicAction('switch', 'kitchen', 1)]).as_dict())
+
+
+class TestScheduler(BaseTestCase):
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.now = local_time(2015, 6, 1, 7, 0)
+        self.ioloop = FakeIOLoop()
+        self.mgr = ScenariosManager()
+        self.triggered = []
+        self.scheduler = Scheduler(
+            self.mgr, self.triggered.append, ioloop=self.ioloop, clock=lambda: self.now
+        )
+
+    @staticmethod
+    def make_scenario(*crons):
+        return Scenario(
+            'scheduled', [BasicAction('switch', 'kitchen', 1)], schedule=[CronRule(c) for c in crons]
+        )
+
+    def fire(self):
+        self.assertEqual(len(self.ioloop.timeouts), 1)
+        deadline, callback = self.ioloop.timeouts.pop()
+        self.now = deadline
+        callback()
+
+    def test01_single_timer(self):
+        for i in range(100):
+            self.mgr.add_scenario('s%03d' % i, self.make_scenario('%d 8 * * *' % (i % 60)))
+        self.mgr.add_scenario('manual', Scenario('manual', [BasicAction('switch', 'kitchen', 1)]))
+        self.scheduler.start()
+
+        self.assertEqual(self.scheduler.timers_count, 100)
+        self.assertEqual(self.ioloop.timeouts[0][0], local_time(2015, 6, 1, 8, 0))
+        self.fire()
+        self.assertListEqual(sorted(self.triggered), ['s000', 's060'])
+        self.assertEqual(self.ioloop.timeouts[0][0], local_time(2015, 6, 1, 8, 1))
+        self.assertEqual(self.scheduler.next_run('s000'), local_time(2015, 6, 2, 8, 0))
+        self.assertIsNone(self.scheduler.next_run('manual'))
+
+    def test02_modifications(self):
+        self.mgr.add_scenario('s01', self.make_scenario('30 7 * * *'))
+        self.scheduler.start()
+
+        self.mgr.add_scenario('s02', self.make_scenario('15 7 * * *'))
+        self.assertEqual(self.ioloop.timeouts[0][0], local_time(2015, 6, 1, 7, 15))
+
+        self.mgr.update_scenario('s02', dict(self.mgr.get_scenario('s02').as_dict(), schedule=[]))
+        self.assertEqual(self.ioloop.timeouts[0][0], local_time(2015, 6, 1, 7, 30))
+
+        self.mgr.remove_scenario('s01')
+        self.assertListEqual(self.ioloop.timeouts, [])
+        self.assertEqual(self.scheduler.timers_count, 0)
+
+        self.scheduler.stop()
+        self.mgr.add_scenario('s03', self.make_scenario('15 7 * * *'))
+        self.assertListEqual(self.ioloop.timeouts, [])
+
+    def test03_trigger_failure(self):
+        def failing_trigger(scen_id):
+            raise KeyError(scen_id)
+
+        self.scheduler._trigger = failing_trigger
+        self.mgr.add_scenario('s01', self.make_scenario('*/10 * * * *'))
+        self.scheduler.start()
+        self.fire()
+        self.assertEqual(self.ioloop.timeouts[0][0], local_time(2015, 6, 1, 7, 20))
+
+    def test04_lazy_loading(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'scenarios.cfg')
+            for i in range(10):
+                self.mgr.add_scenario('s%02d' % i, self.make_scenario('%d 8 * * *' % i))
+            self.mgr.add_scenario('manual', Scenario('manual', [BasicAction('switch', 'kitchen', 1)]))
+            self.mgr.save_scenarios(path)
+
+            mgr = ScenariosManager(lazy=True)
+            mgr.load_scenarios(path)
+            scheduler = Scheduler(mgr, self.triggered.append, ioloop=self.ioloop, clock=lambda: self.now)
+            scheduler.start()
+            self.assertEqual(scheduler.timers_count, 10)
+            self.assertEqual(mgr._scenarios.loaded_count, 0)
+            self.fire()
+            self.assertListEqual(self.triggered, ['s00'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
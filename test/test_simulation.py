@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+
+from pycstbox.homeautomation.core import Scenario, BasicAction
+from pycstbox.homeautomation.execution import ScenarioExecutor, ExecutionJob
+
+from test_core import BaseTestCase
+from simulation import SimulatedEventManager, SimulatedFailure
+from load_execute import percentile
+
+
+class RecordingSleep(object):
+    def __init__(self):
+        self.delays = []
+
+    def __call__(self, delay):
+        self.delays.append(delay)
+
+
+class TestSimulatedEventManager(BaseTestCase):
+    def setUp(self):
+        super(TestSimulatedEventManager, self).setUp()
+        self.sleep = RecordingSleep()
+
+    def test01_latency(self):
+        evtmgr = SimulatedEventManager(latency=0.01, jitter=0.005, seed=1, sleep=self.sleep)
+        evtmgr.set_target('hall', latency=0.1, jitter=0)
+        for _ in range(100):
+            evtmgr.emitEvent('switch', 'kitchen', '{"value": 1}')
+        self.assertTrue(all(0.005 <= d <= 0.015 for d in self.sleep.delays))
+        self.assertGreater(len(set(self.sleep.delays)), 1)
+
+        del self.sleep.delays[:]
+        evtmgr.emitEvent('switch', 'hall', '{"value": 1}')
+        self.assertListEqual(self.sleep.delays, [0.1])
+        self.assertEqual(evtmgr.events_count, 101)
+        self.assertEqual(evtmgr.last_event, ('switch', 'hall', '{"value": 1}'))
+
+    def test02_failures(self):
+        evtmgr = SimulatedEventManager(seed=1, sleep=self.sleep)
+        evtmgr.set_target('broken', failure_rate=1)
+        self.assertRaises(SimulatedFailure, evtmgr.emitEvent, 'switch', 'broken', '')
+        evtmgr.emitEvent('switch', 'kitchen', '')
+        self.assertEqual((evtmgr.events_count, evtmgr.failures_count), (1, 1))
+
+        flaky = SimulatedEventManager(failure_rate=0.2, seed=1, sleep=self.sleep)
+        for _ in range(1000):
+            try:
+                flaky.emitEvent('switch', 'kitchen', '')
+            except SimulatedFailure:
+                pass
+        self.assertTrue(150 < flaky.failures_count < 250)
+        self.assertListEqual(self.sleep.delays, [])
+
+    def test03_batch(self):
+        evtmgr = SimulatedEventManager(latency=0.01, batch=True, sleep=self.sleep)
+        evtmgr.set_target('hall', latency=0.05)
+        evtmgr.emitEvents([('switch', 'kitchen', ''), ('switch', 'hall', '')])
+        self.assertListEqual(self.sleep.delays, [0.05])
+        self.assertEqual((evtmgr.events_count, evtmgr.round_trips), (2, 1))
+
+        evtmgr.set_target('broken', failure_rate=1)
+        self.assertRaises(SimulatedFailure, evtmgr.emitEvents, [('switch', 'kitchen', ''), ('switch', 'broken', '')])
+        self.assertEqual(evtmgr.failures_count, 2)
+
+    def test04_executor(self):
+        evtmgr = SimulatedEventManager(latency=0.001)
+        evtmgr.set_target('broken', failure_rate=1)
+        executor = ScenarioExecutor(evtmgr)
+        try:
+            job = executor.submit('s01', Scenario('scenario 1', actions=[
+                BasicAction('switch', 'kitchen', 0),
+                BasicAction('switch', 'broken', 0),
+            ]))
+            self.assertTrue(job.wait(5))
+        finally:
+            executor.shutdown()
+        actions = job.as_dict()['actions']
+        self.assertEqual(actions[0]['status'], ExecutionJob.DONE)
+        self.assertEqual(actions[1]['status'], ExecutionJob.FAILED)
+
+    def test05_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertIsNone(percentile([], 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import time
+
+from pycstbox.homeautomation.core import Scenario, ScenariosManager, LazyScenarios
+from pycstbox.homeautomation.storage import JSONFileStore, IndexedDocument, CompiledCache, atomic_write, \
+    index_json_object, SQLiteStore, open_store
+
+from test_core import BaseTestCase
+
+
+class StorageTestCase(BaseTestCase):
+    SCENARIO_CFG_FILE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'home-automation-scenarios.cfg')
+
+    def setUp(self):
+        super(StorageTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'scenarios.cfg')
+        shutil.copy(self.SCENARIO_CFG_FILE_PATH, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(StorageTestCase, self).tearDown()
+
+
+class TestJSONFileStore(StorageTestCase):
+    def test01_atomic_write(self):
+        atomic_write(self.path, '{}')
+        self.assertEqual(json.load(file(self.path, 'rt')), {})
+        self.assertEqual(os.listdir(self.tmp_dir), ['scenarios.cfg'])
+
+    def test02_journal(self):
+        store = JSONFileStore(self.path, compact_threshold=3)
+        data = store.load()
+        data['s03'] = data['s01']
+        store.write_changes({'s03': data['s01'], 's02': None}, lambda: data)
+        self.assertTrue(os.path.exists(store.journal_path))
+
+        data = JSONFileStore(self.path).load()
+        self.assertListEqual(sorted(data), ['s01', 's03'])
+
+        # the threshold is reached => the journal is compacted in the file
+        store.write_changes({'s04': data['s01']}, lambda: dict(data, s04=data['s01']))
+        self.assertFalse(os.path.exists(store.journal_path))
+        self.assertListEqual(sorted(json.load(file(self.path, 'rt'))), ['s01', 's03', 's04'])
+
+    def test03_truncated_journal(self):
+        store = JSONFileStore(self.path)
+        store.write_changes({'s02': None}, None)
+        with open(store.journal_path, 'at') as fp:
+            fp.write('{"id": "s01", "sett')
+
+        data = JSONFileStore(self.path).load()
+        self.assertListEqual(sorted(data), ['s01'])
+
+    def test04_index(self):
+        doc = '{"a": {"x": "}, \\"{[", "y": [1, {"z": 2}]}, "b\\u00e9" : 12 , "c": []}'
+        members = {key: json.loads(doc[start:end]) for key, start, end in index_json_object(doc)}
+        self.assertEqual(members, json.loads(doc))
+        self.assertListEqual(index_json_object(' { } '), [])
+        self.assertRaises(ValueError, index_json_object, '[1, 2]')
+        self.assertRaises(ValueError, index_json_object, '{"a": {"b": 1}')
+        self.assertRaises(ValueError, index_json_object, '{"a": }')
+
+        # members are located the same whatever the chunks they are split across
+        expected = index_json_object(doc)
+        for chunk_size in (1, 5, 16, 1024):
+            self.assertListEqual(index_json_object(doc, chunk_size), expected)
+            self.assertListEqual(index_json_object(' { } ', chunk_size), [])
+            self.assertRaises(ValueError, index_json_object, '{"a": {"b": 1}', chunk_size)
+            self.assertRaises(ValueError, index_json_object, '{"a": 12', chunk_size)
+
+    def test05_indexed_document(self):
+        document = IndexedDocument(self.path)
+        expected = json.load(file(self.path, 'rt'))
+        self.assertListEqual(sorted(document.keys()), sorted(expected))
+        self.assertEqual(document.get('s01'), expected['s01'])
+        self.assertRaises(KeyError, document.get, 'none')
+
+    def test06_streaming(self):
+        store = JSONFileStore(self.path)
+        store.write_changes({'s02': None}, None)
+        expected = store.load()
+
+        store.STREAMING_THRESHOLD = 0
+        self.assertEqual(dict(store.iter_items()), expected)
+
+    def test07_compiled_cache(self):
+        cache = CompiledCache(self.path)
+        signature = JSONFileStore(self.path).signature()
+        self.assertIsNone(cache.load(signature))
+
+        cache.save(signature, {u's01': (u'label', None, [(u'switch', u'living', 0, None)], None)})
+        self.assertEqual(cache.load(signature)[u's01'][0], u'label')
+        self.assertIsNone(cache.load(((0, 0), None)))
+
+        with open(cache.path, 'wb') as fp:
+            fp.write('garbage')
+        self.assertIsNone(cache.load(signature))
+
+    def test08_save_after_truncated_record(self):
+        store = JSONFileStore(self.path)
+        data = store.load()
+        store.write_changes({'s02': None}, None)
+        with open(store.journal_path, 'at') as fp:
+            fp.write('{"id": "s01", "sett')
+
+        store = JSONFileStore(self.path)
+        store.load()
+        store.write_changes({'s03': data['s01']}, None)
+        data = JSONFileStore(self.path).load()
+        self.assertListEqual(sorted(data), ['s01', 's03'])
+        self.assertEqual(len(open(store.journal_path).readlines()), 2)
+
+        # journals damaged by a previous version are repaired too
+        with open(store.journal_path, 'at') as fp:
+            fp.write('{"id": "s01", "sett')
+            fp.write(json.dumps({'id': 's04', 'settings': data['s01']}) + '\n')
+            fp.write(json.dumps({'id': 's05', 'settings': data['s01']}) + '\n')
+        data = JSONFileStore(self.path).load()
+        self.assertListEqual(sorted(data), ['s01', 's03', 's05'])
+        store = JSONFileStore(self.path)
+        store.load()
+        store.write_changes({'s01': None}, None)
+        self.assertListEqual(sorted(JSONFileStore(self.path).load()), ['s03', 's05'])
+
+
+class TestScenariosManagerPersistence(StorageTestCase):
+    def test01_deferred_changes(self):
+        mgr = ScenariosManager()
+        mgr.load_scenarios(self.path)
+        settings = mgr.get_scenario('s01').as_dict()
+        settings['label'] = 'modified'
+        mgr.update_scenario('s01', settings)
+        mgr.remove_scenario('s02')
+        mgr.save_changes(delay=0.1)
+        self.assertTrue(mgr.has_pending_changes)
+
+        time.sleep(0.3)
+        self.assertFalse(mgr.has_pending_changes)
+        self.assertFalse(mgr.reload_if_changed())
+
+        other = ScenariosManager()
+        other.load_scenarios(self.path)
+        self.assertEqual(other.get_scenario('s01').label, 'modified')
+        self.assertNotIn('s02', other)
+
+    def test02_lazy_loading(self):
+        store = JSONFileStore(self.path)
+        settings = store.load()['s01']
+        store.write_changes({'s03': settings, 's02': None}, None)
+
+        mgr = ScenariosManager(lazy=True)
+        mgr.load_scenarios(self.path)
+        self.assertIsInstance(mgr._scenarios, LazyScenarios)
+        self.assertEqual(mgr._scenarios.loaded_count, 0)
+        self.assertIn('s03', mgr)
+        self.assertNotIn('s02', mgr)
+        self.assertListEqual([id_ for id_, _, _ in mgr.summaries], ['s01', 's03'])
+        self.assertEqual(mgr._scenarios.loaded_count, 0)
+
+        expected = Scenario.from_dict(settings).as_dict()
+        self.assertEqual(mgr.get_scenario('s01').as_dict(), expected)
+        self.assertEqual(mgr._scenarios.loaded_count, 1)
+        self.assertRaises(KeyError, mgr.get_scenario, 's02')
+
+        mgr.remove_scenario('s03')
+        mgr.save_scenarios()
+        self.assertEqual(mgr._scenarios.loaded_count, 1)
+        self.assertEqual(json.load(file(self.path, 'rt')), {'s01': expected})
+
+        self.assertListEqual([id_ for id_, _ in mgr.scenarios], ['s01'])
+
+    def test03_compiled_cache(self):
+        mgr = ScenariosManager(use_cache=True)
+        mgr.load_scenarios(self.path)
+        self.assertTrue(os.path.exists(self.path + CompiledCache.SUFFIX))
+        expected = mgr._as_dicts()
+
+        def no_parsing(*args):
+            self.fail('JSON file parsed while the cache is up to date')
+
+        for compact in (False, True):
+            cached = ScenariosManager(compact=compact, use_cache=True)
+            cached._load_from_store = no_parsing
+            cached.load_scenarios(self.path)
+            self.assertEqual(cached._as_dicts(), expected)
+
+        # the cache is ignored and rebuilt once the definitions are modified
+        mgr.remove_scenario('s02')
+        mgr.save_changes()
+        other = ScenariosManager(use_cache=True)
+        other.load_scenarios(self.path)
+        self.assertNotIn('s02', other)
+        self.assertEqual(
+            CompiledCache(self.path).load(JSONFileStore(self.path).signature()).keys(), ['s01']
+        )
+
+        # the journal records are accounted for on cache hits too
+        cached = ScenariosManager(use_cache=True)
+        cached._load_from_store = no_parsing
+        cached.load_scenarios(self.path)
+        self.assertEqual(cached._store._journal_records, 1)
+
+    def test04_batch(self):
+        mgr = ScenariosManager()
+        mgr.load_scenarios(self.path)
+        writes = []
+        write_changes = mgr._store.write_changes
+        mgr._store.write_changes = lambda changes, get_all: writes.append(changes) or write_changes(changes, get_all)
+
+        settings = mgr.get_scenario('s01').as_dict()
+        mgr.apply_batch(create={'s1%02d' % i: settings for i in range(50)}, delete=['s02'])
+        mgr.save_changes()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(len(writes[0]), 51)
+
+        other = ScenariosManager()
+        other.load_scenarios(self.path)
+        self.assertEqual(len(other.scenarios), 51)
+        self.assertNotIn('s02', other)
+
+
+class TestSQLiteStore(StorageTestCase):
+    def setUp(self):
+        super(TestSQLiteStore, self).setUp()
+        self.db_path = os.path.join(self.tmp_dir, 'scenarios.db')
+        self.store = SQLiteStore(self.db_path)
+
+    def test01_open_store(self):
+        self.assertIsInstance(open_store(self.db_path), SQLiteStore)
+        self.assertIsInstance(open_store(self.path), JSONFileStore)
+
+    def test02_migration(self):
+        self.assertRaises(ValueError, self.store.load)
+        expected = JSONFileStore(self.path).load()
+        self.assertEqual(self.store.import_json(self.path), len(expected))
+        self.assertDictEqual(self.store.load(), expected)
+
+        json_path = os.path.join(self.tmp_dir, 'export.cfg')
+        self.store.export_json(json_path)
+        self.assertDictEqual(json.load(open(json_path)), expected)
+
+    def test03_changes(self):
+        self.store.import_json(self.path)
+        signature = self.store.signature()
+        settings = self.store.get('s01')
+        self.store.write_changes({'s03': settings, 's02': None}, None)
+        self.assertNotEqual(self.store.signature(), signature)
+
+        self.assertListEqual(sorted(self.store.load()), ['s01', 's03'])
+        self.assertRaises(KeyError, self.store.get, 's02')
+        document, changes = self.store.load_indexed()
+        self.assertEqual(len(document), 2)
+        self.assertDictEqual(document.get('s03'), settings)
+        self.assertRaises(KeyError, document.get, 's02')
+
+    def test04_scenarios_manager(self):
+        self.store.import_json(self.path)
+        for lazy in (False, True):
+            mgr = ScenariosManager(lazy=lazy)
+            mgr.load_scenarios(self.db_path)
+            self.assertFalse(mgr.reload_if_changed())
+            settings = mgr.get_scenario('s01').as_dict()
+            mgr.update_scenario('s01', dict(settings, label='modified %s' % lazy))
+            mgr.save_changes()
+            self.assertFalse(mgr.reload_if_changed())
+
+            other = ScenariosManager()
+            other.load_scenarios(self.db_path)
+            self.assertEqual(other.get_scenario('s01').label, 'modified %s' % lazy)
+
+            other.remove_scenario('s02' if not lazy else 's03')
+            other.add_scenario('s03', Scenario.from_dict(settings))
+            other.save_changes()
+            self.assertTrue(mgr.reload_if_changed())
+            self.assertIn('s03', mgr)
+
+    def test05_missing_database(self):
+        self.assertEqual(self.store.signature(), (None, None))
+        self.store.import_json(self.path)
+        mgr = ScenariosManager()
+        mgr.load_scenarios(self.db_path)
+        os.remove(self.db_path)
+        self.assertFalse(mgr.reload_if_changed())
+        self.assertIn('s01', mgr)
+
+
+if __name__ == '__main__':
+    unittest.main()
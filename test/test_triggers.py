@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from pycstbox.homeautomation.core import Scenario, ScenariosManager, BasicAction
+from pycstbox.homeautomation.triggers import TriggerRule, TriggersIndex, EventTriggers, parse_trigger
+
+from test_core import BaseTestCase
+
+
+class SignalingEventManager(object):
+    """ Event manager proxy on which signal handlers can be connected.
+    """
+    class Match(object):
+        def __init__(self, handlers, handler):
+            self._handlers = handlers
+            self._handler = handler
+
+        def remove(self):
+            self._handlers.remove(self._handler)
+
+    def __init__(self):
+        self.handlers = []
+
+    def connect_to_signal(self, signal_name, handler):
+        self.handlers.append(handler)
+        return self.Match(self.handlers, handler)
+
+    def emit(self, var_type, var_name, value):
+        for handler in self.handlers:
+            handler(0, var_type, var_name, json.dumps({'value': value}))
+
+
+class TestTriggerRules(BaseTestCase):
+    def test01_parse(self):
+        for d in ({'var_type': 'motion'},
+                  {'var_type': 'motion', 'var_name': 'hallway', 'value': True},
+                  {'var_type': 'temperature', 'var_name': 'living', 'above': 26, 'below': 30}):
+            self.assertEqual(parse_trigger(d).as_dict(), d)
+        for invalid in ({}, {'var_name': 'hallway'}, {'var_type': 'temperature', 'above': '26'}, 'motion'):
+            self.assertRaises(ValueError, parse_trigger, invalid)
+
+    def test02_matches(self):
+        self.assertTrue(TriggerRule('motion').matches(None))
+        self.assertTrue(TriggerRule('motion', value=True).matches(True))
+        self.assertFalse(TriggerRule('motion', value=True).matches(False))
+        rule = TriggerRule('temperature', above=20, below=25)
+        self.assertTrue(rule.matches(22.5))
+        self.assertFalse(rule.matches(25))
+        self.assertFalse(rule.matches(None))
+
+    def test03_index(self):
+        index = TriggersIndex()
+        for i in range(500):
+            index.add('s%03d' % i, [TriggerRule('motion', 'room%03d' % i, value=True)])
+        index.add('any', [TriggerRule('motion'), TriggerRule('motion', 'room001')])
+        self.assertEqual(len(index), 502)
+
+        self.assertEqual(len(index.candidates('motion', 'room001')), 3)
+        self.assertListEqual(index.match('motion', 'room001', True), ['s001', 'any'])
+        self.assertListEqual(index.match('motion', 'room001', False), ['any'])
+        self.assertListEqual(index.match('temperature', 'room001', 20), [])
+
+        index.remove('any')
+        self.assertListEqual(index.match('motion', 'room001', False), [])
+        index.add('s001', [])
+        self.assertEqual(len(index), 499)
+
+
+class TestEventTriggers(BaseTestCase):
+    def setUp(self):
+        super(TestEventTriggers, self).setUp()
+        self.mgr = ScenariosManager()
+        self.evtmgr = SignalingEventManager()
+        self.triggered = []
+        self.triggers = EventTriggers(self.mgr, self.triggered.append, self.evtmgr)
+
+    @staticmethod
+    def make_scenario(*triggers):
+        return Scenario('triggered', [BasicAction('switch', 'hall', 1)], triggers=list(triggers))
+
+    def test01_events(self):
+        self.mgr.add_scenario('s_hall_light', self.make_scenario(TriggerRule('motion', 'hallway', value=True)))
+        self.triggers.start()
+        self.assertEqual(self.triggers.rules_count, 1)
+
+        self.evtmgr.emit('motion', 'hallway', False)
+        self.evtmgr.emit('motion', 'kitchen', True)
+        self.assertListEqual(self.triggered, [])
+        self.evtmgr.emit('motion', 'hallway', True)
+        self.assertListEqual(self.triggered, ['s_hall_light'])
+
+        self.triggers.stop()
+        self.evtmgr.emit('motion', 'hallway', True)
+        self.assertListEqual(self.triggered, ['s_hall_light'])
+
+    def test02_modifications(self):
+        self.triggers.start()
+        self.mgr.add_scenario('s01', self.make_scenario(TriggerRule('motion', 'hallway')))
+        self.assertListEqual(self.triggers.process_event('motion', 'hallway', True), ['s01'])
+
+        settings = self.mgr.get_scenario('s01').as_dict()
+        settings['triggers'] = [{'var_type': 'motion', 'var_name': 'kitchen'}]
+        self.mgr.update_scenario('s01', settings)
+        self.assertListEqual(self.triggers.process_event('motion', 'hallway', True), [])
+        self.assertListEqual(self.triggers.process_event('motion', 'kitchen', True), ['s01'])
+
+        self.mgr.remove_scenario('s01')
+        self.assertEqual(self.triggers.rules_count, 0)
+
+    def test03_scenario_settings(self):
+        settings = {
+            'label': 'triggered',
+            'ui_verb': Scenario.DEFAULT_VERB,
+            'actions': [{'verb': 'switch', 'target': 'hall', 'data': 1, 'label': 'on'}],
+            'triggers': [{'var_type': 'motion', 'var_name': 'hallway', 'value': True}]
+        }
+        scenario = Scenario.from_dict(settings)
+        self.assertEqual(scenario.as_dict(), settings)
+        self.assertEqual(Scenario.from_record(scenario.as_record()).as_dict(), settings)
+
+    def test04_lazy_loading(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'scenarios.cfg')
+            self.mgr.add_scenario('s01', self.make_scenario(TriggerRule('motion', 'hallway', value=True)))
+            self.mgr.add_scenario('manual', Scenario('manual', [BasicAction('switch', 'kitchen', 1)]))
+            self.mgr.save_scenarios(path)
+
+            mgr = ScenariosManager(lazy=True)
+            mgr.load_scenarios(path)
+            triggers = EventTriggers(mgr, self.triggered.append, self.evtmgr)
+            triggers.start()
+            self.assertEqual(triggers.rules_count, 1)
+            self.assertEqual(mgr._scenarios.loaded_count, 0)
+            self.evtmgr.emit('motion', 'hallway', True)
+            self.assertListEqual(self.triggered, ['s01'])
+            triggers.stop()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -86,10 +86,52 @@ class TestWebServices(unittest.TestCase):
         r = requests.get(url)
         self.assertEqual(r.status_code, 404)
 
+    def test05_conditional_get(self):
+        for url in (self.URL_BASE + "/scenarios", self.URL_BASE + "/scenario/s01/settings"):
+            r = requests.get(url)
+            self.assertEqual(r.status_code, 200)
+            etag = r.headers['ETag']
+
+            r = requests.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.content, '')
+
+            r = requests.get(url, headers={'If-None-Match': '"outdated"'})
+            self.assertEqual(r.status_code, 200)
+
+    def test06_batch(self):
+        url = self.URL_BASE + "/scenarios/batch"
+        r = requests.get(url)
+        self.assertEqual(r.status_code, 200)
+        scenarios = r.json()['scenarios']
+        self.assertListEqual(sorted(scenarios), ['s01', 's02'])
+
+        copies = {'s1%02d' % i: dict(scenarios['s01'], label='copy %d' % i) for i in range(10)}
+        r = requests.post(url, data=json.dumps({'create': copies}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['created'], 10)
+
+        # nothing is applied if any of the modifications is invalid
+        r = requests.post(url, data=json.dumps({'delete': list(copies) + ['s42']}))
+        self.assertEqual(r.status_code, 404)
+        r = requests.get(url, params={'ids': ','.join(copies)})
+        self.assertEqual(r.status_code, 200)
+
+        r = requests.post(url, data=json.dumps({'delete': list(copies)}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['deleted'], 10)
+
     def test10_execute_scenario(self):
         r = requests.get(self.URL_BASE + "/scenario/s01/execute")
         self.assertEqual(r.status_code, 200)
 
+    def test11_history(self):
+        r = requests.get(self.URL_BASE + "/scenario/s01/history", params={'limit': 5})
+        self.assertEqual(r.status_code, 200)
+        self.assertLessEqual(len(r.json()['executions']), 5)
+        r = requests.get(self.URL_BASE + "/scenario/s01/history", params={'limit': 1000})
+        self.assertEqual(r.status_code, 400)
+
 
 class ReplyData(object):
     def __init__(self, attrs):